@@ -3,10 +3,66 @@ from flask_sqlalchemy import SQLAlchemy
 from flask_script import Manager
 from flask_migrate import Migrate, MigrateCommand
 from timetabler import app, db, config
+from timetabler.models import init_db_indexes, upgrade_db
 
 migrate = Migrate(app, db)
 manager = Manager(app)
 manager.add_command('db', MigrateCommand)
 
+
+@manager.command
+def upgrade():
+    '''Add the tables, columns and indexes added since the database was made, e.g. the jobs table, to it.'''
+    created = upgrade_db()
+    print("Created indexes: " + (", ".join(created) if created else "none"))
+
+
+@manager.command
+def create_indexes():
+    '''Create the indexes declared on the models that the database does not have yet.'''
+    created = init_db_indexes()
+    print("Created indexes: " + (", ".join(created) if created else "none"))
+
+
+@manager.command
+def benchmark_indexes(students=5000, subjects=400, tutors=100, samples=50):
+    '''Time lookups on a generated semester without and with the indexes, and show their query plans.'''
+    import timetabler.benchmark
+    timetabler.benchmark.benchmark_indexes(students=int(students), subjects=int(subjects), tutors=int(tutors),
+                                           samples=int(samples))
+
+
+# The options are declared rather than taken from the arguments, whose first letters (e.g. of students and subjects)
+# would give clashing short options
+@manager.option('--students', dest='students', type=int, default=2000)
+@manager.option('--subjects', dest='subjects', type=int, default=200)
+@manager.option('--tutors', dest='tutors', type=int, default=50)
+@manager.option('--timeslots', dest='timeslots', type=int, default=20)
+@manager.option('--rooms', dest='rooms', type=int, default=20)
+@manager.option('--density', dest='density', type=float, default=4)
+@manager.option('--programs', dest='programs', type=int, default=None)
+@manager.option('--backend', dest='backend', default=None)
+@manager.option('--output', dest='output', default=None)
+@manager.option('--tight', dest='tight', action='store_true', help='Use the tight formulation')
+@manager.option('--symmetry-breaking', dest='symmetry_breaking', action='store_true',
+                help='Break symmetry between interchangeable students')
+@manager.option('--compare', dest='compare', action='store_true',
+                help='Run the loose and the tight formulation on the same semester')
+def benchmark(students, subjects, tutors, timeslots, rooms, density, programs, backend, output, tight,
+              symmetry_breaking, compare):
+    '''Time each stage of timetabling a generated semester, and print the results as JSON or write them to output.'''
+    import json
+    import timetabler.benchmark
+    kwargs = dict(output=output, backend=backend, symmetry_breaking=symmetry_breaking or None, students=students,
+                  subjects=subjects, tutors=tutors, timeslots=timeslots, rooms=rooms, density=density,
+                  programs=programs)
+    if compare:
+        results = timetabler.benchmark.compare_formulations(**kwargs)
+    else:
+        results = timetabler.benchmark.run_benchmark(tight_formulation=tight or None, **kwargs)
+    if output is None:
+        print(json.dumps(results, indent=2))
+
+
 if __name__ == '__main__':
     manager.run()
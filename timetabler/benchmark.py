@@ -0,0 +1,366 @@
+'''
+Benchmarks on a generated semester.
+
+The benchmarks run on a separate database (a temporary SQLite file unless another is given), which is filled with a
+random semester of students, subjects, tutors, timeslots and rooms by generate_semester. run_benchmark times each
+stage of timetabling it and gives the results as JSON, so that runs of different versions can be compared.
+'''
+import datetime
+import json
+import os
+import platform
+import shutil
+import tempfile
+from contextlib import contextmanager
+from random import Random
+from time import perf_counter
+from timetabler import app, db
+from timetabler.config import appcfg
+from timetabler.models import *
+import timetabler.helpers
+import timetabler.solver
+
+DAYS = ["Monday", "Tuesday", "Wednesday", "Thursday", "Friday"]
+
+
+@contextmanager
+def benchmark_database(uri=None):
+    '''
+    Point the app at a separate database for a benchmark, set up as for a new install, for the duration of a with
+    block. The app's own database is restored afterwards.
+
+    :param uri: The SQLAlchemy database URI. A temporary SQLite database is used, and removed afterwards, if not given.
+    :return: A context manager giving the database URI.
+    '''
+    previous = app.config['SQLALCHEMY_DATABASE_URI']
+    directory = None
+    if uri is None:
+        directory = tempfile.mkdtemp()
+        uri = 'sqlite:///' + os.path.join(directory, 'benchmark.db')
+    db.session.remove()
+    app.config['SQLALCHEMY_DATABASE_URI'] = uri
+    try:
+        db.create_all()
+        init_db()
+        yield uri
+    finally:
+        db.session.remove()
+        app.config['SQLALCHEMY_DATABASE_URI'] = previous
+        if directory is not None:
+            shutil.rmtree(directory)
+
+
+def generate_semester(students=2000, subjects=200, tutors=50, timeslots=20, rooms=20, density=4, availability=0.5,
+                      classes=True, seed=0, programs=None):
+    '''
+    Fill the current year and studyperiod with a random semester. This replaces the timeslots of the current
+    timetable and all of the rooms, so it is meant for a benchmark database.
+
+    :param students: Number of students.
+    :param subjects: Number of subjects, each taught by one tutor, with enough classes for its students to fit.
+    :param tutors: Number of tutors.
+    :param timeslots: Number of timeslots, spread over the weekdays.
+    :param rooms: Number of rooms.
+    :param density: Average number of subjects each student is enrolled in.
+    :param availability: Share of the timeslots each tutor is available in. Tutors are always available for at least
+                         as many timeslots as they have classes.
+    :param classes: Whether to also put one class for each subject on the timetable, at a random time the tutor is
+                    available, with all of its students.
+    :param seed: Seed for the random numbers, so that the same semester is generated each time.
+    :param programs: Number of programs, each a random set of subjects, with each student taking all of the subjects
+                     of one of them (as in a first year intake). Students choose their own subjects if None.
+    :return: Dictionary of the number of rows generated by kind.
+    '''
+    random = Random(seed)
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    timetable = get_current_timetable_id()
+    current = {'year': year, 'studyperiod': studyperiod}
+    Timeslot.query.filter_by(timetable=timetable).delete()
+    Room.query.delete()
+
+    studentrows = [dict(current, studentcode=str(100000 + i), name='Student %05d' % i, email='')
+                   for i in range(students)]
+    enrolled = {i: [] for i in range(subjects)}
+    programsubjects = [random.sample(range(subjects), min(max(1, int(round(random.gauss(density, 1)))), subjects))
+                       for _ in range(programs or 0)]
+    for i in range(students):
+        if programs:
+            chosen = random.choice(programsubjects)
+        else:
+            chosen = random.sample(range(subjects), min(max(1, int(round(random.gauss(density, 1)))), subjects))
+        for subject in chosen:
+            enrolled[subject].append(i)
+    # Enough classes of each subject for its students to fit
+    subjectrows = [dict(current, subcode='SUBJ%05d' % i, subname='Subject %d' % i,
+                        repeats=max(1, -(-len(enrolled[i]) // appcfg['max_class_size'])),
+                        needsprojector=random.random() < 0.2) for i in range(subjects)]
+    tutorrows = [dict(current, name='Tutor %04d' % i, email='') for i in range(tutors)]
+    timeslotrows = [dict(current, timetable=timetable, day=DAYS[i % len(DAYS)], daynumeric=i % len(DAYS),
+                         time='%d:30' % (8 + i // len(DAYS)), preferredtime=random.random() < 0.8)
+                    for i in range(timeslots)]
+    roomrows = [{'name': 'Room %d' % i, 'projector': random.random() < 0.3, 'capacity': random.choice([12, 16, 20])}
+                for i in range(rooms)]
+    for model, rows in [(Subject, subjectrows), (Student, studentrows), (Tutor, tutorrows),
+                        (Timeslot, timeslotrows), (Room, roomrows)]:
+        db.session.bulk_insert_mappings(model, rows, return_defaults=True)
+
+    subjecttutor = {subject['id']: tutorrows[i % tutors]['id'] for i, subject in enumerate(subjectrows)}
+    classcount = {tutor['id']: 0 for tutor in tutorrows}
+    for subject in subjectrows:
+        classcount[subjecttutor[subject['id']]] += subject['repeats']
+    timeslotids = [timeslot['id'] for timeslot in timeslotrows]
+    available = {}
+    for tutorid in classcount:
+        count = max(int(round(availability * timeslots)), min(classcount[tutorid], timeslots))
+        available[tutorid] = random.sample(timeslotids, count)
+    enrolled = {subjectrows[i]['id']: [studentrows[j]['id'] for j in members] for i, members in enrolled.items()}
+
+    db.session.execute(subtutmap.insert(), [{'tutor_id': tutorid, 'subject_id': subjectid}
+                                            for subjectid, tutorid in subjecttutor.items()])
+    db.session.execute(tutoravailabilitymap.insert(), [{'tutor_id': tutorid, 'timeslot_id': timeslotid}
+                                                       for tutorid, times in available.items() for timeslotid in times])
+    db.session.execute(substumap.insert(), [{'student_id': studentid, 'subject_id': subjectid}
+                                            for subjectid, studentids in enrolled.items() for studentid in studentids])
+    counts = {'students': students, 'subjects': subjects, 'tutors': tutors, 'timeslots': timeslots, 'rooms': rooms,
+              'enrolments': sum(len(studentids) for studentids in enrolled.values()), 'classes': 0}
+    if classes:
+        classrows = [dict(current, subjectid=subjectid, timetable=timetable, tutorid=tutorid,
+                          time=random.choice(available[tutorid]), roomid=random.choice(roomrows)['id'])
+                     for subjectid, tutorid in subjecttutor.items()]
+        db.session.bulk_insert_mappings(TimetabledClass, classrows, return_defaults=True)
+        db.session.execute(stutimetable.insert(), [{'timetabledclass_id': row['id'], 'student_id': studentid}
+                                                   for row in classrows for studentid in enrolled[row['subjectid']]])
+        counts['classes'] = len(classrows)
+    db.session.commit()
+    return counts
+
+
+def get_query_plan(query):
+    '''
+    Get the database's plan for a query.
+
+    :param query: A SQLAlchemy query.
+    :return: A list of the lines of the plan.
+    '''
+    sql = str(query.statement.compile(dialect=db.engine.dialect, compile_kwargs={'literal_binds': True}))
+    if db.engine.dialect.name == 'sqlite':
+        return [row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + sql)]
+    return [' '.join(str(value) for value in row) for row in db.session.execute('EXPLAIN ' + sql)]
+
+
+def get_index_queries(samples=50):
+    '''
+    Get the lookups the indexes are for, as the app makes them.
+
+    :param samples: Number of values looked up for each.
+    :return: A list of (name, function giving the query for a value, values) triples.
+    '''
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    current = {'year': year, 'studyperiod': studyperiod}
+    subjects = db.session.query(Subject.id, Subject.subcode).filter_by(**current).limit(samples).all()
+    students = db.session.query(Student.id, Student.name, Student.studentcode).filter_by(**current) \
+        .limit(samples).all()
+    tutors = db.session.query(Tutor.id, Tutor.name).filter_by(**current).limit(samples).all()
+    return [
+        ('subject by subcode', lambda subcode: Subject.query.filter_by(subcode=subcode, **current),
+         [subject.subcode for subject in subjects]),
+        ('student by name', lambda name: Student.query.filter_by(name=name, **current),
+         [student.name for student in students]),
+        ('student by studentcode', lambda studentcode: Student.query.filter_by(studentcode=studentcode, **current),
+         [student.studentcode for student in students]),
+        ('tutor by name', lambda name: Tutor.query.filter_by(name=name, **current), [tutor.name for tutor in tutors]),
+        ('students of a subject', lambda subjectid: db.session.query(substumap.c.student_id)
+         .filter(substumap.c.subject_id == subjectid), [subject.id for subject in subjects]),
+        ('subjects of a student', lambda studentid: db.session.query(substumap.c.subject_id)
+         .filter(substumap.c.student_id == studentid), [student.id for student in students]),
+        ('classes of a student', lambda studentid: db.session.query(stutimetable.c.timetabledclass_id)
+         .filter(stutimetable.c.student_id == studentid), [student.id for student in students]),
+        ('availability of a tutor', lambda tutorid: db.session.query(tutoravailabilitymap.c.timeslot_id)
+         .filter(tutoravailabilitymap.c.tutor_id == tutorid), [tutor.id for tutor in tutors]),
+        ('classes on the timetable', lambda timetable: TimetabledClass.query.filter_by(timetable=timetable, **current),
+         [get_current_timetable_id()]),
+    ]
+
+
+def time_index_queries(queries, repeat=3):
+    '''
+    Time the lookups and get their plans. The rows are fetched without making objects of them, so that the time is
+    mostly the database's.
+
+    :param queries: The lookups, as from get_index_queries.
+    :param repeat: Number of times to run each lookup for each value. The fastest run is kept.
+    :return: Dictionary by name of lookup of the time in milliseconds for all of its values, and its plan.
+    '''
+    results = {}
+    for name, make_query, values in queries:
+        best = None
+        for i in range(repeat):
+            start = perf_counter()
+            for value in values:
+                db.session.execute(make_query(value).statement).fetchall()
+            elapsed = perf_counter() - start
+            best = elapsed if best is None else min(best, elapsed)
+        results[name] = {'ms': round(best * 1000, 3), 'plan': get_query_plan(make_query(values[0]))}
+    return results
+
+
+def drop_indexes():
+    '''
+    Drop the indexes declared on the models, to compare with a database from before they were added.
+
+    :return: Nil.
+    '''
+    inspector = db.inspect(db.engine)
+    for table in db.metadata.sorted_tables:
+        existing = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name in existing:
+                index.drop(db.engine)
+
+
+def benchmark_indexes(uri=None, samples=50, repeat=3, **kwargs):
+    '''
+    Time the lookups by year and studyperiod and through the association tables on a generated semester, without the
+    indexes and then with them.
+
+    :param uri: The database to run on, as for benchmark_database.
+    :param samples: Number of values looked up for each kind of lookup.
+    :param repeat: Number of times each lookup is run, keeping the fastest.
+    :param kwargs: Sizes of the semester, as for generate_semester.
+    :return: Dictionary with the semester's counts and, by lookup, the time and plan before and after.
+    '''
+    with benchmark_database(uri):
+        counts = generate_semester(**kwargs)
+        queries = get_index_queries(samples)
+        # The indexes are dropped and created on another connection, which the session's only sees once it commits
+        db.session.commit()
+        drop_indexes()
+        db.session.commit()
+        before = time_index_queries(queries, repeat)
+        db.session.commit()
+        init_db_indexes()
+        db.session.commit()
+        after = time_index_queries(queries, repeat)
+    results = {'semester': counts, 'queries': {}}
+    for name in before:
+        results['queries'][name] = {'before': before[name], 'after': after[name]}
+        print("{:<26} {:>10.1f}ms -> {:>8.1f}ms".format(name, before[name]['ms'], after[name]['ms']))
+        print("    before: " + "; ".join(before[name]['plan']))
+        print("    after:  " + "; ".join(after[name]['plan']))
+    return results
+
+
+def time_stage(stages, name, function, *args, **kwargs):
+    '''
+    Run a stage of the benchmark and record how long it took.
+
+    :param stages: Dictionary of stage times in seconds, which the time is added to under name.
+    :param name: The name of the stage.
+    :param function: The function to run, with args and kwargs.
+    :return: What the function returns.
+    '''
+    started = perf_counter()
+    result = function(*args, **kwargs)
+    stages[name] = perf_counter() - started
+    return result
+
+
+def run_benchmark(uri=None, output=None, backend=None, solver_options=None, decompose=None, symmetry_breaking=None,
+                  tight_formulation=None, **kwargs):
+    '''
+    Time each stage of timetabling a generated semester: reading the timetable data, building the model, solving it
+    with CBC, allocating rooms, writing the classes to the database, the clash report and the exports.
+
+    :param uri: The database to run on, as for benchmark_database.
+    :param output: Path to write the results to as JSON. They are only returned if not given.
+    :param backend: The model backend, as for solve_timetable_two_step.
+    :param solver_options: Dictionary of solver settings, as for get_solver_options. A time limit of 60 seconds is
+                           used unless another is given.
+    :param decompose: Whether to solve independent groups of subjects separately, as for solve_timetable_two_step.
+    :param symmetry_breaking: Whether to break symmetry between students, as for solve_timetable_two_step.
+    :param tight_formulation: Whether to use the tight formulation of the days worked and clashes, as for
+                              solve_timetable_two_step.
+    :param kwargs: Sizes of the semester, as for generate_semester. No classes are generated, as they are solved.
+    :return: Dictionary with the settings, the semester's counts, the stage times in seconds and the model's size
+             and result.
+    '''
+    solver_options = timetabler.solver.get_solver_options(dict({'time_limit': 60}, **(solver_options or {})))
+    kwargs['classes'] = False
+    stages = {}
+    report = {}
+    previous = app.config['UPLOAD_FOLDER']
+    directory = tempfile.mkdtemp()
+    app.config['UPLOAD_FOLDER'] = directory
+    try:
+        with benchmark_database(uri):
+            semester = time_stage(stages, 'generate', generate_semester, **kwargs)
+            data = time_stage(stages, 'timetable_data', get_timetable_data, rooms=True)
+            status, room_values, assign_values, classpop = timetabler.helpers.solve_timetable_two_step(
+                *data, report=report, backend=backend, solver_options=solver_options, decompose=decompose,
+                symmetry_breaking=symmetry_breaking, tight_formulation=tight_formulation)
+            timetabler.helpers.add_timetable_solution(data, room_values, assign_values, classpop, report)
+            for stage in ['build', 'solve', 'rooms', 'writeback']:
+                if stage in report:
+                    stages[stage] = report[stage]
+            classes = TimetabledClass.query.filter_by(timetable=get_current_timetable_id()).count()
+            clash_report_cache.clear()
+            clashes = time_stage(stages, 'clash_report', get_clash_report)
+            time_stage(stages, 'export_timetable',
+                       lambda: timetabler.helpers.create_excel(timetabler.helpers.format_timetable_data_for_export()))
+            time_stage(stages, 'export_student_timetables', lambda: timetabler.helpers.create_excel(
+                timetabler.helpers.format_student_timetable_data_for_export()))
+            time_stage(stages, 'export_rolls', get_all_rolls)
+    finally:
+        app.config['UPLOAD_FOLDER'] = previous
+        shutil.rmtree(directory)
+    results = {'created': datetime.datetime.now().isoformat(timespec='seconds'),
+               'python': platform.python_version(), 'platform': platform.platform(),
+               'settings': {'backend': backend or appcfg.get('model_backend', 'pulp'),
+                            'decompose': appcfg.get('decompose', False) if decompose is None else decompose,
+                            'prune_unavailable_times': appcfg.get('prune_unavailable_times', True),
+                            'lazy_clash_constraints': appcfg.get('lazy_clash_constraints', False),
+                            'tight_formulation': appcfg.get('tight_formulation', False)
+                            if tight_formulation is None else tight_formulation,
+                            'symmetry_breaking': appcfg.get('symmetry_breaking', False)
+                            if symmetry_breaking is None else symmetry_breaking,
+                            'solver_options': solver_options},
+               'semester': semester,
+               'stages': {stage: round(seconds, 4) for stage, seconds in stages.items()},
+               'model': {'status': status, 'variables': report.get('variables'),
+                         'constraints': report.get('constraints'),
+                         'variables_before_pruning': report.get('variables_before_pruning'),
+                         'constraints_before_pruning': report.get('constraints_before_pruning'),
+                         'objective': report.get('objective'), 'root_bound': report.get('root_bound'),
+                         'gap': report.get('gap'), 'nodes': report.get('nodes'),
+                         'clash_rounds': report.get('clash_rounds'),
+                         'symmetry_constraints': report.get('symmetry_constraints'), 'classes': classes,
+                         'clashes': len(clashes)}}
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
+
+
+def compare_formulations(output=None, **kwargs):
+    '''
+    Run run_benchmark with the loose and then the tight formulation of the days worked and clashes, on the same
+    generated semester, to compare their root bounds, nodes and solve times.
+
+    :param output: Path to write both results to as JSON. They are only returned if not given.
+    :param kwargs: Arguments for run_benchmark, other than output and tight_formulation. Both semesters are generated
+                   from the same seed, so they are the same.
+    :return: Dictionary with the results of run_benchmark for the 'loose' and the 'tight' formulation.
+    '''
+    results = {}
+    for name, tight in [('loose', False), ('tight', True)]:
+        results[name] = run_benchmark(tight_formulation=tight, **kwargs)
+    for name, result in results.items():
+        print("{:<6} root bound {}, {} nodes, objective {}, solve {:.1f}s".format(
+            name, result['model']['root_bound'], result['model']['nodes'], result['model']['objective'],
+            result['stages'].get('solve', 0)))
+    if output is not None:
+        with open(output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return results
@@ -52,6 +52,43 @@ appcfg = {
         "subject_name": "Final Subject Name",
         "study_period": "Study Period"
     },
+    # Number of rows of an uploaded CSV or xlsx file imported at a time
+    "upload_chunk_size": 5000,
+    # Folder for the solver logs of background timetabling jobs (the system temporary folder if empty)
+    "job_folder": '',
+    # Where background jobs solve: "thread" in the web process, or "process" in a pool of worker processes
+    "job_execution": 'thread',
+    "solver_processes": 1,
+    # Solver defaults, which can be changed for each run on the Run Timetabler page. The solver is "cbc" for the
+    # bundled CBC or the name of another PuLP solver. A time limit (seconds), relative gap or thread count of None
+    # leaves it to the solver. A run stopped by a limit keeps the best timetable found so far.
+    "solver": 'cbc',
+    "solver_time_limit": None,
+    "solver_gap": None,
+    "solver_threads": None,
+    # Start the solver from the classes already on the timetable, which are then replaced by the new solution
+    "solver_warm_start": False,
+    # How the timetabling model is built: "pulp" for PuLP expressions, "matrix" for sparse arrays, or "cohort" for PuLP
+    # with the students who take the same classes grouped into cohorts, which is much smaller for large intakes
+    "model_backend": "pulp",
+    # Solve groups of subjects that share no students or tutors separately, at the same time. The number of groups
+    # solved at once is decompose_workers, or the number of CPUs if None.
+    "decompose": False,
+    "decompose_workers": None,
+    # Only create the timetabling variables for the times each tutor is available, rather than creating them for every
+    # time and constraining the unavailable ones to 0
+    "prune_unavailable_times": True,
+    # Start the timetabling model with clash constraints only for the students with two or more classes that only run
+    # once, then add them for the students that have clashes in the solution and solve again until none do. This gives
+    # the same timetable from a much smaller model when most students cannot clash.
+    "lazy_clash_constraints": False,
+    # Link the days tutors work to each of their classes, and count the classes students have at a time beyond their
+    # first as their clashes, instead of linking both to a fraction of a sum. This gives the solver a much better
+    # bound, but a student with three classes at once counts as two clashes rather than one.
+    "tight_formulation": False,
+    # Order the repeats attended by students who take the same classes, so the solver does not search through
+    # timetables that only differ by swapping them
+    "symmetry_breaking": False,
     "max_class_size": 16,
     "min_class_size": 0,
     "default_room_capacity": 20
@@ -0,0 +1,76 @@
+'''
+Indexes of the students' enrolments shared by the timetabling model backends.
+
+These only look at the names in the timetable data, so both helpers.solve_timetable_pulp and the sparse matrix
+backend can use them without importing each other.
+'''
+
+
+def build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING):
+    '''
+    Index each student by the (subject, tutor) pairs they are enrolled in.
+
+    The student clash constraints only ever look at a student's own classes, so building this once
+    saves scanning every subject of every tutor for each student and timeslot.
+
+    :param TEACHERS: an array of the names of the tutors
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param SUBJECTMAPPING: A dictionary of the students enrolled in each subject
+    :return: A dictionary indexed by student name with a list of (subject, tutor) tuples.
+    '''
+    STUDENTENROLMENTS = {}
+    for m in TEACHERS:
+        for j in TEACHERMAPPING[m]:
+            for i in SUBJECTMAPPING[j]:
+                STUDENTENROLMENTS.setdefault(i, []).append((j, m))
+    return STUDENTENROLMENTS
+
+
+def group_cohorts(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, FIXED=None):
+    '''
+    Group the students that take exactly the same classes (and have the same fixed classes) into cohorts.
+
+    :param STUDENTS: The names of the students.
+    :param TIMES: The timeslots.
+    :param TEACHERS: an array of the names of the tutors
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param SUBJECTMAPPING: A dictionary of the students enrolled in each subject
+    :param FIXED: Optional fixed classes, as for solve_timetable_pulp.
+    :return: A dictionary of the students in each cohort, indexed by the name of the cohort's first student, in the
+             order of STUDENTS.
+    '''
+    FIXED = FIXED or {}
+    STUDENTENROLMENTS = build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+    cohorts = {}
+    for i in STUDENTS:
+        key = (tuple(sorted(STUDENTENROLMENTS.get(i, []))),
+               tuple(FIXED.get('students', {}).get((i, k), 0) for k in TIMES))
+        cohorts.setdefault(key, []).append(i)
+    return {members[0]: members for members in cohorts.values()}
+
+
+def get_symmetric_students(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, REPEATS, FIXED=None):
+    '''
+    Find the students that are interchangeable in the first stage model.
+
+    Students who take the same classes (see group_cohorts) can swap the repeats they attend without changing the
+    objective, so for each such group the one class of theirs with the most repeats is used to put them in order:
+    each student attends a repeat at the same or an earlier time than the next student in the group.
+
+    :param STUDENTS: The names of the students.
+    :param TIMES: The timeslots.
+    :param TEACHERS: an array of the names of the tutors
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param SUBJECTMAPPING: A dictionary of the students enrolled in each subject
+    :param REPEATS: A dictionary of the number of classes of each subject.
+    :param FIXED: Optional fixed classes, as for solve_timetable_pulp.
+    :return: A list of (student, next student, subject, tutor) tuples.
+    '''
+    STUDENTENROLMENTS = build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+    SYMMETRIC = []
+    for members in group_cohorts(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, FIXED).values():
+        enrolments = STUDENTENROLMENTS.get(members[0], [])
+        if len(members) > 1 and any(REPEATS[j] > 1 for (j, m) in enrolments):
+            j, m = max(enrolments, key=lambda enrolment: REPEATS[enrolment[0]])
+            SYMMETRIC += [(a, b, j, m) for a, b in zip(members, members[1:])]
+    return SYMMETRIC
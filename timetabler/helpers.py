@@ -2,53 +2,148 @@ import os
 import pandas
 from docx import Document
 from pandas import ExcelFile
-from pulp import LpProblem, LpMinimize, lpSum, LpVariable, LpStatus, LpInteger, LpBinary
+from pulp import LpProblem, LpMinimize, lpSum, LpVariable, LpStatus, LpInteger, LpBinary, listSolvers
 import datetime
+import itertools
+import json
 import time
+from concurrent.futures import ThreadPoolExecutor
+from operator import attrgetter
 from timetabler import app, db, executor
+from timetabler.config import appcfg
+from timetabler.enrolments import build_student_enrolments, group_cohorts, get_symmetric_students
 from timetabler.models import *
 import timetabler.models
+import timetabler.jobs
+import timetabler.matrix
+import timetabler.solver
 from timetabler.forms import AddTimetableForm
 
 #TIMETABLE CODE
-def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
-                                     TEACHERMAPPING,
-                                     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES):
-    '''
-    Run the timetabling process and input into the database.
 
-    This process calls the CBCSolver using the PuLP package and then adds the classes to the database.
+# Statuses with a solution to use. "Feasible" is a solve stopped by the time limit with a solution found.
+SOLVED_STATES = ['Optimal', 'Feasible']
 
 
-    :param STUDENTS: should be an array of student names
-    :param SUBJECTS: should be an array of subject codes
-    :param TIMES: an array of strings representing possible timeslots
-    :param day:
-    :param DAYS: the days corresponding to the timeslots above
+def get_tutor_times(TIMES, TEACHERS, TUTORAVAILABILITY, prune=None):
+    '''
+    Get the times each tutor's classes are given variables for in the first stage model.
+
+    A class can only run when its tutor is available, so by default there are no variables for the other times
+    rather than variables that are constrained to be 0.
+
+    :param TIMES: The timeslots.
     :param TEACHERS: an array of the names of the tutors
-    :param SUBJECTMAPPING: This is a dictionary representing the subjects
-                            each tutor is taking
-    :param REPEATS: A dictionary of how many repeats each subject has
-    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
-    :param TUTORAVAILABILITY:
-    :param maxclasssize: An integer representing the maximum class size
-    :param minclasssize: An integer representing the minimum class size
-    :param nrooms: An integer representing the max allowable concurrent classes
-    :param CAPACITIES: A dictionary indexed by room name with the amount of people that each room can contain
-    :return: A string representing model status.
+    :param TUTORAVAILABILITY: A dictionary of the times each tutor is available
+    :param prune: Whether to leave out the times a tutor is not available. Defaults to
+                  appcfg["prune_unavailable_times"].
+    :return: A dictionary indexed by tutor of the list of times, in the order of TIMES.
     '''
-    print("Running solver")
+    if prune is None:
+        prune = appcfg.get("prune_unavailable_times", True)
+    if not prune:
+        return {m: list(TIMES) for m in TEACHERS}
+    return {m: [k for k in TIMES if k in TUTORAVAILABILITY[m]] for m in TEACHERS}
+
+
+def format_build_report(report):
+    '''
+    Format the timings collected by runtimetable_with_rooms_two_step for the log.
+
+    :param report: Dictionary of phase timings in seconds, plus variable and constraint counts (and the counts
+                   before pruning the times tutors are not available), and the final gap,
+                   the objective of the warm start, the limit that stopped the solver, the number of components
+                   solved separately and the classes a repair kept, created and deleted if known.
+    :return: A one line summary string.
+    '''
+    phases = ['build', 'solve', 'rooms', 'writeback']
+    summary = ', '.join('%s %.2fs' % (phase, report[phase]) for phase in phases if phase in report)
+    text = 'Timetable report: %s; %d variables, %d constraints' % (summary, report.get('variables', 0),
+                                                                   report.get('constraints', 0))
+    if report.get('variables_before_pruning', report.get('variables')) != report.get('variables'):
+        text += ' (%d variables, %d constraints before pruning unavailable times)' % (
+            report['variables_before_pruning'], report['constraints_before_pruning'])
+    if report.get('gap') is not None:
+        text += '; gap %.2f%%' % (100 * report['gap'])
+    if report.get('start_objective') is not None:
+        text += '; warm start objective %g' % report['start_objective']
+    if report.get('stopped_by'):
+        text += '; stopped by the ' + report['stopped_by']
+    if 'clash_rounds' in report:
+        text += '; clash constraints for %d students added in %d rounds' % (report['clash_students'],
+                                                                            report['clash_rounds'])
+    if report.get('lazy_clash_constraints_ignored'):
+        text += '; lazy clash constraints not supported by the backend, all added'
+    if report.get('symmetry_constraints'):
+        text += '; %d symmetry breaking constraints' % report['symmetry_constraints']
+    if 'cohorts' in report:
+        text += '; %d cohorts of students' % report['cohorts']
+    if 'components' in report:
+        text += '; %d components, %d re-solved to share rooms' % (report['components'], report.get('coordinated', 0))
+    if 'kept' in report:
+        text += '; repair kept %d, created %d, deleted %d classes' % (report['kept'], report['created'],
+                                                                      report['deleted'])
+    return text
+
+
+def solve_timetable_pulp(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                         TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                         NONPREFERREDTIMES, report, solver_options=None, warm_start=None, FIXED=None,
+                         COHORTSIZES=None, symmetry_breaking=False, tight_formulation=None):
+    '''
+    Build and solve the first stage timetabling model with PuLP.
+
+    With the tight formulation, a tutor works a day if any of their classes run on it, with a constraint for
+    each class, and a student's clashes at a time are counted as the classes beyond their first, rather than both
+    being linked to a fraction of a sum, which gives a much weaker LP relaxation.
+
+    The parameters are as for runtimetable_with_rooms_two_step.
+
+    :param report: Dictionary filled with build and solve times, the variable and constraint counts (and the counts
+                   the model would have without pruning the times tutors are not available, see get_tutor_times) and
+                   the statistics CBC logged for the solve. If the clash constraints are added lazily
+                   (appcfg["lazy_clash_constraints"]), the number of solves and of students given them, and the
+                   solve time covers every solve.
+    :param solver_options: Dictionary of solver settings, as for timetabler.solver.solve_pulp_model.
+    :param warm_start: Optional starting solution for the solver, as a tuple of subject and assignment values keyed
+                       like the ones returned (see models.get_timetable_solution). Missing keys start at 0.
+    :param FIXED: Optional classes that are already on the timetable and are not part of this model, when only part
+                  of the timetable is being solved (see restrict_timetable_data). A dictionary with 'times' and
+                  'projectors', the number of fixed classes (needing a projector) at each time, 'students', the
+                  number of fixed classes of each (student, time), and 'days', the (tutor, day) pairs tutors
+                  already work.
+    :param COHORTSIZES: Optional dictionary of the number of students each cohort in STUDENTS stands for (see
+                        solve_timetable_cohorts). A cohort's assignment variables count how many of its students
+                        attend each class, and its clashes count the classes its students have at a time beyond
+                        their first. Students not in it are single students.
+    :param symmetry_breaking: Whether to order the repeats attended by students who are interchangeable (see
+                              get_symmetric_students), so the solver does not search through swapping them.
+    :param tight_formulation: Whether to use the tight formulation of the days worked and clashes. Defaults to
+                              appcfg["tight_formulation"].
+    :return: A tuple of the model status, the values of the subject variables indexed by (subject, time, tutor)
+             and the values of the assignment variables indexed by (student, subject, time, tutor). Pruned
+             variables are given as 0.
+    '''
+    started = time.perf_counter()
+    FIXED = FIXED or {}
+    COHORTSIZES = COHORTSIZES or {}
+    tight = appcfg.get("tight_formulation", False) if tight_formulation is None else tight_formulation
+    TUTORTIMES = get_tutor_times(TIMES, TEACHERS, TUTORAVAILABILITY)
     model = LpProblem('Timetabling', LpMinimize)
     # Create Variables
     print("Creating Variables")
     app.logger.info('Assignment Variables')
     assign_vars = LpVariable.dicts("StudentVariables",
                                    [(i, j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for i in SUBJECTMAPPING[j]
-                                    for k in TIMES], 0, 1, LpBinary)
+                                    if i not in COHORTSIZES for k in TUTORTIMES[m]], 0, 1, LpBinary)
+    assign_vars.update(LpVariable.dicts("CohortVariables",
+                                        [(i, j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m]
+                                         for i in SUBJECTMAPPING[j] if i in COHORTSIZES for k in TUTORTIMES[m]],
+                                        0, None, LpInteger))
     app.logger.info('Subject Variables')
     subject_vars = LpVariable.dicts("SubjectVariables",
-                                    [(j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for k in TIMES], 0, 1,
-                                    LpBinary)
+                                    [(j, k, m) for m in TEACHERS for j in TEACHERMAPPING[m] for k in TUTORTIMES[m]],
+                                    0, 1, LpBinary)
 
     # c
     app.logger.info('9:30 classes')
@@ -60,8 +155,11 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     # p
     daysforteacherssum = LpVariable.dicts("numdaysforteacherssum", [(i) for i in TEACHERS], 0, cat=LpInteger)
     # variables for student clashes
-    studenttime = LpVariable.dicts("StudentTime", [(i, j) for i in STUDENTS for j in TIMES], lowBound=0, upBound=1,
-                                   cat=LpBinary)
+    # With the tight formulation these count the classes a student has at a time beyond their first, as for cohorts.
+    studenttime = LpVariable.dicts("StudentTime", [(i, j) for i in STUDENTS if i not in COHORTSIZES for j in TIMES],
+                                   lowBound=0, upBound=None if tight else 1, cat=LpInteger if tight else LpBinary)
+    studenttime.update(LpVariable.dicts("CohortTime", [(i, j) for i in STUDENTS if i in COHORTSIZES for j in TIMES],
+                                        lowBound=0, cat=LpInteger))
     studentsum = LpVariable.dicts("StudentSum", [(i) for i in STUDENTS], 0, cat=LpInteger)
 
 
@@ -69,13 +167,27 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     projectorpositive = LpVariable.dicts("ProjectorPositivePart", [(k) for k in TIMES], 0, cat=LpInteger)
     # Count the days that a teacher is rostered on. Make it bigger than a small number times the sum
     # for that particular day.
+    # Days tutors already work because of fixed classes count whether or not there are classes in the model.
+    # The tight formulation has a constraint for each class instead, so a class running on a day counts the whole day
+    # in the LP relaxation rather than a tenth of it.
     for m in TEACHERS:
         app.logger.info('Counting Teachers for ' + m)
         for d in range(len(day)):
-            model += daysforteachers[(m, d)] >= 0.1 * lpSum(
-                subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]])
+            working = 1 if (m, day[d]) in FIXED.get('days', ()) else 0
+            if tight:
+                for j in TEACHERMAPPING[m]:
+                    for k in DAYS[day[d]]:
+                        if (j, k, m) in subject_vars:
+                            model += daysforteachers[(m, d)] >= subject_vars[(j, k, m)]
+                if working:
+                    model += daysforteachers[(m, d)] >= 1
+            else:
+                model += daysforteachers[(m, d)] >= 0.1 * (1 - working) * lpSum(
+                    subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]]
+                    if (j, k, m) in subject_vars) + working
             model += daysforteachers[(m, d)] <= lpSum(
-                subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]])
+                subject_vars[(j, k, m)] for j in TEACHERMAPPING[m] for k in DAYS[day[d]]
+                if (j, k, m) in subject_vars) + working
     for m in TEACHERS:
         model += daysforteacherssum[(m)] == lpSum(daysforteachers[(m, d)] for d in range(len(day)))
 
@@ -85,8 +197,9 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     # can be scheduled when a tutor is not available.
     # The last column of the availabilities is the tutor identifying number, hence why we have
     # used a somewhat convoluted idea down here.
+    # There are only variables for these times if pruning is turned off (see get_tutor_times).
     for m in TEACHERS:
-        for k in TIMES:
+        for k in TUTORTIMES[m]:
             if k not in TUTORAVAILABILITY[m]:
                 model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) == 0
 
@@ -95,15 +208,15 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
             for i in SUBJECTMAPPING[j]:
-                model += lpSum(assign_vars[(i, j, k, m)] for k in TIMES) == 1
+                model += lpSum(assign_vars[(i, j, k, m)] for k in TUTORTIMES[m]) == COHORTSIZES.get(i, 1)
 
     # This code means that students cannot attend a tute when a tute is not running
     # But can not attend a tute if they attend a repeat.
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
             for i in SUBJECTMAPPING[j]:
-                for k in TIMES:
-                    model += assign_vars[(i, j, k, m)] <= subject_vars[(j, k, m)]
+                for k in TUTORTIMES[m]:
+                    model += assign_vars[(i, j, k, m)] <= COHORTSIZES.get(i, 1) * subject_vars[(j, k, m)]
 
     # Constraints on which tutor can take each class
     # This goes through each list and either constrains it to 1 or 0 depending if
@@ -111,42 +224,80 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     print("Constraining tutor classes")
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
-            model += lpSum(subject_vars[(j, k, m)] for k in TIMES) == REPEATS[j]
+            model += lpSum(subject_vars[(j, k, m)] for k in TUTORTIMES[m]) == REPEATS[j]
 
     # General Constraints on Rooms etc.
     print("Constraining times")
     # For each time cannot exceed number of rooms
     for k in TIMES:
-        model += lpSum(subject_vars[(j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m]) <= len(ROOMS)
+        model += lpSum(subject_vars[(j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m]
+                       if (j, k, m) in subject_vars) <= len(ROOMS) - \
+                 FIXED.get('times', {}).get(k, 0)
 
 
     #Number of rooms that need projectors less than the number that have projectors. Want to make this a soft constraint so
     #that it will not affect the feasibility of the model. We'll have a large penalty for exceeding the number of rooms with
     #projectors.
     for k in TIMES:
-        model += projectortime[(k)]==(lpSum(subject_vars[(j,k,m)] for m in TEACHERS for j in TEACHERMAPPING[m] if j in PROJECTORS)-numroomsprojector)
+        model += projectortime[(k)]==(lpSum(subject_vars[(j,k,m)] for m in TEACHERS for j in TEACHERMAPPING[m] if j in PROJECTORS and (j,k,m) in subject_vars)-numroomsprojector+FIXED.get('projectors', {}).get(k, 0))
         model += projectorpositive[(k)] >= projectortime[(k)]
         model += projectorpositive[(k)] >= 0
 
     # Teachers can only teach one class at a time
-    for k in TIMES:
-        for m in TEACHERS:
+    for m in TEACHERS:
+        for k in TUTORTIMES[m]:
             model += lpSum(subject_vars[(j, k, m)] for j in TEACHERMAPPING[m]) <= 1
     print("Constraint: Minimize student clashes")
     # STUDENT CLASHES
-    for i in STUDENTS:
+    # Each student only needs their own enrolments, so look these up once rather than testing
+    # every subject of every tutor for every student and timeslot.
+    STUDENTENROLMENTS = build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+
+    def get_clash_constraints(i):
+        enrolments = STUDENTENROLMENTS.get(i, [])
         for k in TIMES:
-            model += studenttime[(i, k)] <= lpSum(
-                assign_vars[(i, j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m] if i in SUBJECTMAPPING[j]) / 2
-            model += studenttime[(i, k)] >= 0.3 * (0.5 * lpSum(
-                assign_vars[(i, j, k, m)] for m in TEACHERS for j in TEACHERMAPPING[m] if i in SUBJECTMAPPING[j]) - 0.5)
+            fixed = FIXED.get('students', {}).get((i, k), 0)
+            running = [assign_vars[(i, j, k, m)] for (j, m) in enrolments if (i, j, k, m) in assign_vars]
+            if i in COHORTSIZES:
+                # Each of the cohort's students can have one class at the time without a clash
+                size = COHORTSIZES[i]
+                yield studenttime[(i, k)] >= lpSum(running) + size * fixed - size
+            elif tight:
+                yield studenttime[(i, k)] >= lpSum(running) + fixed - 1
+            else:
+                yield studenttime[(i, k)] <= (lpSum(running) + fixed) / 2
+                yield studenttime[(i, k)] >= 0.3 * (0.5 * (lpSum(running) + fixed) - 0.5)
+
+    def get_attended(i, k):
+        return {(j, m): round(assign_vars[(i, j, k, m)].varValue or 0) for (j, m) in STUDENTENROLMENTS.get(i, [])
+                if (i, j, k, m) in assign_vars and round(assign_vars[(i, j, k, m)].varValue or 0) > 0}
+
+    def count_clashes(i, k, attended):
+        fixed = FIXED.get('students', {}).get((i, k), 0)
+        if i in COHORTSIZES or tight:
+            size = COHORTSIZES.get(i, 1)
+            return max(0, sum(attended.values()) + size * fixed - size)
+        return 1 if sum(attended.values()) + fixed >= 2 else 0
+
+    # With lazy clash constraints, only the students most likely to clash start with them, and the others are added
+    # when the solution has clashes for them (see the solve below).
+    lazy = appcfg.get("lazy_clash_constraints", False)
+    if lazy:
+        CLASHSTUDENTS = set(get_clash_risk_students(STUDENTS, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, REPEATS))
+    else:
+        CLASHSTUDENTS = set(STUDENTS)
+    for i in STUDENTS:
+        if i in CLASHSTUDENTS:
+            for constraint in get_clash_constraints(i):
+                model += constraint
     for i in STUDENTS:
         model += studentsum[(i)] == lpSum(studenttime[(i, k)] for k in TIMES)
 
     # This minimizes the number of 9:30 classes.
     for i in TIMES:
         if i in NONPREFERREDTIMES:
-            model += num930classes[(i)] == lpSum(subject_vars[(j, i, m)] for m in TEACHERS for j in TEACHERMAPPING[m])
+            model += num930classes[(i)] == lpSum(subject_vars[(j, i, m)] for m in TEACHERS for j in TEACHERMAPPING[m]
+                                                 if (j, i, m) in subject_vars)
 
         else:
             model += num930classes[(i)] == 0
@@ -156,28 +307,484 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
     # Class size constraint
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
-            for k in TIMES:
+            for k in TUTORTIMES[m]:
                 model += lpSum(assign_vars[(i, j, k, m)] for i in SUBJECTMAPPING[j]) >= minclasssize * subject_vars[
                     (j, k, m)]
                 model += lpSum(assign_vars[(i, j, k, m)] for i in SUBJECTMAPPING[j]) <= maxclasssize
 
+    if symmetry_breaking:
+        print("Breaking symmetry between students")
+        SYMMETRIC = get_symmetric_students(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, REPEATS, FIXED)
+        # By each time, the next student has been to the class no more than the student before them.
+        count = 0
+        for (a, b, j, m) in SYMMETRIC:
+            times = [k for k in TIMES if (a, j, k, m) in assign_vars]
+            for n in range(1, len(times)):
+                model += lpSum(assign_vars[(b, j, k, m)] for k in times[:n]) <= lpSum(
+                    assign_vars[(a, j, k, m)] for k in times[:n])
+                count += 1
+        report['symmetry_constraints'] = count
+
     # Solving the model
     model += (100 * lpSum(studentsum[(i)] for i in STUDENTS) + lpSum(num930classes[(i)] for i in TIMES) + 500 * lpSum(
         daysforteacherssum[(m)] for m in TEACHERS)+5000*lpSum(projectorpositive[(k)] for k in TIMES))
+    report['build'] = time.perf_counter() - started
+    report['variables'] = model.numVariables()
+    report['constraints'] = model.numConstraints()
+    # Without pruning, each tutor has variables at every time, an availability constraint and a one class at a time
+    # constraint for each time they are not available, and each of their classes has two class size constraints
+    # and a constraint per student linking the student to the class. The tight formulation and symmetry breaking
+    # add rows for each of a class's times too, so the sizes are left out with those.
+    if not tight and not symmetry_breaking:
+        report['variables_before_pruning'] = report['variables']
+        report['constraints_before_pruning'] = report['constraints']
+        for m in TEACHERS:
+            pruned = len(TIMES) - len(TUTORTIMES[m])
+            report['constraints_before_pruning'] += 2 * pruned
+            for j in TEACHERMAPPING[m]:
+                report['variables_before_pruning'] += pruned * (1 + len(SUBJECTMAPPING[j]))
+                report['constraints_before_pruning'] += pruned * (2 + len(SUBJECTMAPPING[j]))
+    if warm_start is not None:
+        subject_start, assign_start = warm_start
+        for key, var in subject_vars.items():
+            var.setInitialValue(subject_start.get(key, 0))
+        for key, var in assign_vars.items():
+            var.setInitialValue(assign_start.get(key, 0))
     print("Solving Model")
-    model.solve()
-    print("Status:", LpStatus[model.status])
+    started = time.perf_counter()
+    report.update(timetabler.solver.solve_pulp_model(model, solver_options, warm_start=warm_start is not None))
+    # Add clash constraints for the students with clashes that have none, and for the other students taking the
+    # classes that clash, who would have the same clash. Then solve again starting from the last solution (with the
+    # new students' clashes counted, so that it is still feasible), until no student without them has a clash.
+    rounds = 1
+    while lazy and timetabler.solver.get_status(model.status, model.sol_status) in SOLVED_STATES:
+        clashing = set()
+        for i in STUDENTS:
+            if i not in CLASHSTUDENTS:
+                for k in TIMES:
+                    attended = get_attended(i, k)
+                    if count_clashes(i, k, attended):
+                        clashing.add(i)
+                        for (j1, m1), (j2, m2) in itertools.combinations(attended, 2):
+                            clashing.update(set(SUBJECTMAPPING[j1]).intersection(SUBJECTMAPPING[j2]))
+        clashing -= CLASHSTUDENTS
+        if not clashing:
+            break
+        print("Adding clash constraints for %d students" % len(clashing))
+        for i in STUDENTS:
+            if i in clashing:
+                for constraint in get_clash_constraints(i):
+                    model += constraint
+                CLASHSTUDENTS.add(i)
+                for k in TIMES:
+                    studenttime[(i, k)].setInitialValue(count_clashes(i, k, get_attended(i, k)))
+                studentsum[(i)].setInitialValue(sum(studenttime[(i, k)].varValue for k in TIMES))
+        report.update(timetabler.solver.solve_pulp_model(model, solver_options, warm_start=True))
+        rounds += 1
+    if lazy:
+        report['clash_rounds'] = rounds
+        report['clash_students'] = len(CLASHSTUDENTS)
+    report['solve'] = time.perf_counter() - started
+    subject_values = {(j, k, m): subject_vars[(j, k, m)].varValue if (j, k, m) in subject_vars else 0
+                      for m in TEACHERS for j in TEACHERMAPPING[m] for k in TIMES}
+    assign_values = {(i, j, k, m): assign_vars[(i, j, k, m)].varValue if (i, j, k, m) in assign_vars else 0
+                     for m in TEACHERS for j in TEACHERMAPPING[m] for i in SUBJECTMAPPING[j] for k in TIMES}
+    return timetabler.solver.get_status(model.status, model.sol_status), subject_values, assign_values
+
+
+def get_clash_risk_students(STUDENTS, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, REPEATS):
+    '''
+    Get the students most likely to have clashes, who are given clash constraints from the start when they are
+    added lazily (see solve_timetable_pulp). These are the students with two or more classes that only run once, as
+    they cannot avoid a clash by going to a repeat.
+
+    :param STUDENTS: The names of the students.
+    :param TEACHERS: an array of the names of the tutors
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param SUBJECTMAPPING: A dictionary of the students enrolled in each subject
+    :param REPEATS: A dictionary of the number of classes of each subject.
+    :return: A list of the students, in the order of STUDENTS.
+    '''
+    STUDENTENROLMENTS = build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+    return [i for i in STUDENTS if sum(1 for (j, m) in STUDENTENROLMENTS.get(i, []) if REPEATS[j] == 1) >= 2]
+
+
+def split_cohort(members, counts):
+    '''
+    Share a cohort's students between the classes the cohort model put them in.
+
+    Each student attending a class is an edge between the class and its time, and each student is given a colour,
+    so that colouring the edges with no two edges of a class or a time the same colour gives every student one
+    class of each subject and no clashes. This is always possible because no class or time has more edges than
+    there are students (Konig's theorem). A time with more attendances than students is first split into times of
+    at most that many, so there are only as many clashes as the cohort model counted.
+
+    :param members: The students in the cohort.
+    :param counts: Dictionary indexed by (subject, tutor) of dictionaries of the number of the cohort's students
+                   attending the class at each time.
+    :return: A list of the (student, subject, time, tutor) assignments.
+    '''
+    n = len(members)
+    seen = {}
+    colours = {}
+    for (j, m), times in counts.items():
+        for k, count in times.items():
+            for _ in range(count):
+                u, v = (j, m), (k, seen.get(k, 0) // n)
+                seen[k] = seen.get(k, 0) + 1
+                atu, atv = colours.setdefault(u, {}), colours.setdefault(v, {})
+                a = next(c for c in range(n) if c not in atu)
+                if a in atv:
+                    # Swap colours a and b along the path from v whose edges alternate between them, which frees a
+                    # at v. The path cannot reach u, where a is free.
+                    b = next(c for c in range(n) if c not in atv)
+                    path = []
+                    x, c = v, a
+                    while c in colours[x]:
+                        y = colours[x][c]
+                        path.append((x, y, c))
+                        x, c = y, b if c == a else a
+                    for x, y, c in path:
+                        del colours[x][c], colours[y][c]
+                    for x, y, c in path:
+                        c = b if c == a else a
+                        colours[x][c], colours[y][c] = y, x
+                atu[a], atv[a] = v, u
+    return [(members[c], j, k, m) for (j, m) in counts for c, (k, slot) in colours.get((j, m), {}).items()]
+
+
+def solve_timetable_cohorts(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                            TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                            NONPREFERREDTIMES, report, solver_options=None, warm_start=None, FIXED=None,
+                            symmetry_breaking=False, tight_formulation=None):
+    '''
+    Build and solve the first stage timetabling model with PuLP, with the students who take the same classes
+    grouped into cohorts (see group_cohorts).
+
+    The model has one integer variable for the number of a cohort's students at each class rather than one binary
+    variable for each student, and the cohorts are split back into students with split_cohort. The parameters and
+    the return value are as for solve_timetable_pulp, and the report also has the number of cohorts. There is no
+    symmetry between cohorts to break, so symmetry_breaking is ignored.
+    '''
+    FIXED = FIXED or {}
+    COHORTS = group_cohorts(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, FIXED)
+    COHORTSIZES = {c: len(members) for c, members in COHORTS.items() if len(members) > 1}
+    cohortof = {i: c for c, members in COHORTS.items() for i in members}
+    COHORTMAPPING = {j: list(dict.fromkeys(cohortof[i] for i in SUBJECTMAPPING[j])) for j in SUBJECTMAPPING}
+    COHORTFIXED = dict(FIXED)
+    COHORTFIXED['students'] = {(i, k): value for (i, k), value in FIXED.get('students', {}).items() if i in COHORTS}
+    if warm_start is not None:
+        assign_start = {}
+        for (i, j, k, m), value in warm_start[1].items():
+            if i in cohortof:
+                key = (cohortof[i], j, k, m)
+                assign_start[key] = assign_start.get(key, 0) + value
+        warm_start = (warm_start[0], assign_start)
+    print("Grouped %d students into %d cohorts" % (len(STUDENTS), len(COHORTS)))
+    status, subject_values, cohort_values = solve_timetable_pulp(
+        list(COHORTS), TIMES, day, DAYS, TEACHERS, COHORTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+        maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES, report, solver_options,
+        warm_start, COHORTFIXED, COHORTSIZES, tight_formulation=tight_formulation)
+    report['cohorts'] = len(COHORTS)
+
+    assign_values = {(i, j, k, m): 0 for m in TEACHERS for j in TEACHERMAPPING[m] for i in SUBJECTMAPPING[j]
+                     for k in TIMES}
+    if status in SOLVED_STATES:
+        for c, members in COHORTS.items():
+            counts = {}
+            for m in TEACHERS:
+                for j in TEACHERMAPPING[m]:
+                    if c in COHORTMAPPING[j]:
+                        counts[(j, m)] = {k: int(round(cohort_values[(c, j, k, m)])) for k in TIMES
+                                          if round(cohort_values[(c, j, k, m)]) > 0}
+            for key in split_cohort(members, counts):
+                assign_values[key] = 1
+    return status, subject_values, assign_values
+
+
+def get_first_stage_solver(backend=None):
+    '''
+    Get the function that builds and solves the first stage model.
+
+    :param backend: 'pulp', 'matrix' or 'cohort'. Defaults to appcfg["model_backend"].
+    :return: solve_timetable_pulp, matrix.solve_timetable_matrix or solve_timetable_cohorts.
+    '''
+    if backend is None:
+        backend = appcfg.get("model_backend", "pulp")
+    if backend == 'pulp':
+        return solve_timetable_pulp
+    elif backend == 'cohort':
+        return solve_timetable_cohorts
+    elif backend == 'matrix':
+        return timetabler.matrix.solve_timetable_matrix
+    raise ValueError("Unknown model backend: " + str(backend))
+
+
+def find_timetable_components(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING):
+    '''
+    Split the subjects into groups that share no students and no tutors.
+
+    Subjects are linked when they have a tutor or a student in common. Different groups only meet in the number of
+    rooms and projectors at each time, so each group can be timetabled on its own.
+
+    :param TEACHERS: an array of the names of the tutors
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param SUBJECTMAPPING: A dictionary of the students enrolled in each subject
+    :return: A list of sets of subject codes, largest first.
+    '''
+    parent = {}
+
+    def find(j):
+        while parent[j] != j:
+            parent[j] = parent[parent[j]]
+            j = parent[j]
+        return j
+
+    first = {}
+    for m in TEACHERS:
+        for j in TEACHERMAPPING[m]:
+            parent.setdefault(j, j)
+            for other in [m] + sorted(SUBJECTMAPPING[j]):
+                if other in first:
+                    parent[find(j)] = find(first[other])
+                else:
+                    first[other] = j
+    components = {}
+    for j in parent:
+        components.setdefault(find(j), set()).add(j)
+    return sorted(components.values(), key=lambda component: (-len(component), min(component)))
+
+
+def solve_timetable_component(solve, data, subjects, report, solver_options=None, warm_start=None, FIXED=None,
+                              symmetry_breaking=False, tight_formulation=None):
+    '''
+    Solve the first stage model for some of the subjects, as if they were the whole timetable.
+
+    :param solve: The first stage solver, from get_first_stage_solver.
+    :param data: The timetable data tuple, as from get_timetable_data(rooms=True).
+    :param subjects: The subject codes to timetable.
+    :param report: Dictionary filled with the build and solve statistics, as for solve_timetable_pulp.
+    :param solver_options: Dictionary of solver settings, as for solve_timetable_pulp.
+    :param warm_start: Optional starting solution, as for solve_timetable_pulp. Only the subjects' values are used.
+    :param FIXED: Optional fixed classes, as for solve_timetable_pulp.
+    :param symmetry_breaking: Whether to break symmetry between students, as for solve_timetable_pulp.
+    :param tight_formulation: Whether to use the tight formulation, as for solve_timetable_pulp.
+    :return: The result of the first stage solver.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+     NONPREFERREDTIMES, CAPACITIES) = restrict_timetable_data(data, subjects, [])[0]
+    if warm_start is not None:
+        warm_start = ({key: value for key, value in warm_start[0].items() if key[0] in subjects},
+                      {key: value for key, value in warm_start[1].items() if key[1] in subjects})
+    return solve(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+                 maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES, report,
+                 solver_options, warm_start, FIXED, symmetry_breaking=symmetry_breaking,
+                 tight_formulation=tight_formulation)
+
+
+def count_classes_at_times(subject_values, PROJECTORS):
+    '''
+    Count the classes running at each time in a first stage solution.
+
+    :param subject_values: Values of the subject variables indexed by (subject, time, tutor).
+    :param PROJECTORS: The subjects that need a projector.
+    :return: A tuple of dictionaries indexed by time of the number of classes and of the number needing a projector.
+    '''
+    times = {}
+    projectors = {}
+    for (j, k, m), value in subject_values.items():
+        if value == 1:
+            times[k] = times.get(k, 0) + 1
+            if j in PROJECTORS:
+                projectors[k] = projectors.get(k, 0) + 1
+    return times, projectors
+
+
+def solve_timetable_components(data, report, backend=None, solver_options=None, warm_start=None, FIXED=None,
+                               symmetry_breaking=False, tight_formulation=None):
+    '''
+    Solve the first stage model by splitting the subjects into independent groups (see find_timetable_components)
+    and solving the groups at the same time, each with its own CBC process.
+
+    The groups are then put together largest first. A group whose classes would take more rooms or projectors at
+    some time than are left by the groups before it is solved again with those groups' classes fixed. If that fails,
+    the whole model is solved in one go instead.
+
+    :param data: The timetable data tuple, as from get_timetable_data(rooms=True).
+    :param report: Dictionary filled as for solve_timetable_pulp, with the counts and statistics of the groups
+                   added up, plus the number of components and the number re-solved to share the rooms.
+    :param backend: The model backend, as for solve_timetable_two_step.
+    :param solver_options: Dictionary of solver settings, as for solve_timetable_two_step. Each group after the
+                           first gets its own log and process id file, named after the given ones.
+    :param warm_start: Optional starting solution, as for solve_timetable_pulp.
+    :param FIXED: Optional fixed classes, as for solve_timetable_pulp.
+    :param symmetry_breaking: Whether to break symmetry between students, as for solve_timetable_pulp.
+    :param tight_formulation: Whether to use the tight formulation, as for solve_timetable_pulp.
+    :return: A tuple of the status, subject values and assignment values, as for solve_timetable_pulp.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+     NONPREFERREDTIMES, CAPACITIES) = data
+    started = time.perf_counter()
+    solve = get_first_stage_solver(backend)
+    FIXED = FIXED or {}
+    components = find_timetable_components(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+    print("Solving", len(components), "components")
+    app.logger.info('Solving %d components', len(components))
+
+    def component_options(n):
+        options = dict(solver_options or {})
+        for key in ['log_path', 'pid_path']:
+            if n > 0 and options.get(key):
+                options[key] += '.' + str(n)
+        return options
+
+    reports = [{} for component in components]
+    with ThreadPoolExecutor(appcfg.get("decompose_workers") or os.cpu_count()) as pool:
+        futures = [pool.submit(solve_timetable_component, solve, data, component, reports[n], component_options(n),
+                               warm_start, FIXED, symmetry_breaking, tight_formulation)
+                   for n, component in enumerate(components)]
+        results = [future.result() for future in futures]
+
+    # Put the components together, re-solving any that no longer fit in the rooms left at a time
+    usedtimes = dict(FIXED.get('times', {}))
+    usedprojectors = dict(FIXED.get('projectors', {}))
+    subject_values = {}
+    assign_values = {}
+    statuses = []
+    coordinated = 0
+    for n, component in enumerate(components):
+        status, component_subjects, component_assign = results[n]
+        times, projectors = count_classes_at_times(component_subjects, PROJECTORS)
+        if status in SOLVED_STATES and (
+                any(usedtimes.get(k, 0) + times[k] > len(ROOMS) for k in times) or
+                any(usedprojectors.get(k, 0) + projectors[k] > max(numroomsprojector, projectors[k]) for k in projectors)):
+            coordinated += 1
+            reports[n] = {}
+            status, component_subjects, component_assign = solve_timetable_component(
+                solve, data, component, reports[n], component_options(n), warm_start,
+                dict(FIXED, times=usedtimes, projectors=usedprojectors), symmetry_breaking, tight_formulation)
+            if status not in SOLVED_STATES:
+                print("Components could not share the rooms, solving the whole timetable")
+                app.logger.info('Components could not share the rooms, solving the whole timetable')
+                report['components'] = 1
+                return solve(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                             TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                             NONPREFERREDTIMES, report, solver_options, warm_start, FIXED,
+                             symmetry_breaking=symmetry_breaking, tight_formulation=tight_formulation)
+            times, projectors = count_classes_at_times(component_subjects, PROJECTORS)
+        for k in times:
+            usedtimes[k] = usedtimes.get(k, 0) + times[k]
+        for k in projectors:
+            usedprojectors[k] = usedprojectors.get(k, 0) + projectors[k]
+        statuses.append(status)
+        subject_values.update(component_subjects)
+        assign_values.update(component_assign)
+
+    for key in ['build', 'variables', 'constraints', 'root_bound', 'objective', 'bound', 'nodes',
+                'symmetry_constraints']:
+        if all(key in component_report for component_report in reports):
+            report[key] = sum(component_report[key] for component_report in reports)
+    if 'objective' in report and 'bound' in report:
+        report['gap'] = abs(report['objective'] - report['bound']) / max(abs(report['objective']), 1e-10)
+    for component_report in reports:
+        if component_report.get('stopped_by'):
+            report['stopped_by'] = component_report['stopped_by']
+    report['components'] = len(components)
+    report['coordinated'] = coordinated
+    report['solve'] = time.perf_counter() - started
+    for status in ['Infeasible', 'Unbounded', 'Undefined', 'Not Solved', 'Feasible']:
+        if status in statuses:
+            return status, subject_values, assign_values
+    return 'Optimal', subject_values, assign_values
+
+
+def solve_timetable_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                             TEACHERMAPPING,
+                             TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES,
+                             report=None, backend=None, solver_options=None, warm_start=None, FIXED=None,
+                             decompose=None, symmetry_breaking=None, tight_formulation=None):
+    '''
+    Run the timetabling process: solve the timetable with the CBCSolver using the PuLP package, then allocate rooms.
+
+    This does not use the database, so it can be run in another process (see solve_timetable_snapshot).
+
+
+    :param STUDENTS: should be an array of student names
+    :param SUBJECTS: should be an array of subject codes
+    :param TIMES: an array of strings representing possible timeslots
+    :param day:
+    :param DAYS: the days corresponding to the timeslots above
+    :param TEACHERS: an array of the names of the tutors
+    :param SUBJECTMAPPING: This is a dictionary representing the subjects
+                            each tutor is taking
+    :param REPEATS: A dictionary of how many repeats each subject has
+    :param TEACHERMAPPING: A dictionary of what subject each tutor teachers
+    :param TUTORAVAILABILITY:
+    :param maxclasssize: An integer representing the maximum class size
+    :param minclasssize: An integer representing the minimum class size
+    :param nrooms: An integer representing the max allowable concurrent classes
+    :param CAPACITIES: A dictionary indexed by room name with the amount of people that each room can contain
+    :param report: An optional dictionary which is filled with the model build, solve and room allocation times
+                    in seconds, along with the variable and constraint counts of the model.
+    :param backend: 'pulp' to build the first stage model with PuLP expressions, 'matrix' to build it as
+                    sparse arrays (see timetabler.matrix), or 'cohort' to build it with PuLP for cohorts of
+                    students taking the same classes (see solve_timetable_cohorts). Defaults to
+                    appcfg["model_backend"].
+    :param solver_options: Dictionary of solver settings passed to timetabler.solver, e.g. log_path and pid_path
+                    so that a background job can follow and cancel the run.
+    :param warm_start: Optional starting solution for the first stage, as for solve_timetable_pulp.
+    :param FIXED: Optional classes that are fixed, as for solve_timetable_pulp, plus 'rooms', the (time, room)
+                    pairs they take.
+    :param decompose: Whether to solve the first stage in independent groups of subjects (see
+                    solve_timetable_components). Defaults to appcfg["decompose"].
+    :param symmetry_breaking: Whether to add constraints ordering the repeats attended by interchangeable students
+                    (see get_symmetric_students). Defaults to appcfg["symmetry_breaking"].
+    :param tight_formulation: Whether to use the tight formulation of the days worked and clashes (see
+                    solve_timetable_pulp). Defaults to appcfg["tight_formulation"].
+    :return: A tuple of the model status as a string, the values of the room allocation variables indexed by
+             (subject, time, tutor, room) (None if rooms were not allocated), the values of the student assignment
+             variables indexed by (student, subject, time, tutor) and the population of each class that is running.
+    '''
+    print("Running solver")
+    if report is None:
+        report = {}
+    FIXED = FIXED or {}
+    if decompose is None:
+        decompose = appcfg.get("decompose", False)
+    if symmetry_breaking is None:
+        symmetry_breaking = appcfg.get("symmetry_breaking", False)
+    if tight_formulation is None:
+        tight_formulation = appcfg.get("tight_formulation", False)
+    if decompose:
+        status, subject_values, assign_values = solve_timetable_components(
+            (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+             TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+             NONPREFERREDTIMES, CAPACITIES), report, backend, solver_options, warm_start, FIXED, symmetry_breaking,
+            tight_formulation)
+    else:
+        solve = get_first_stage_solver(backend)
+        status, subject_values, assign_values = solve(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                                      TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize,
+                                                      ROOMS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES,
+                                                      report, solver_options, warm_start, FIXED,
+                                                      symmetry_breaking=symmetry_breaking,
+                                                      tight_formulation=tight_formulation)
+    print("Status:", status)
     print("Completed Timetable")
 
     classpop = {}
     for m in TEACHERS:
         for j in TEACHERMAPPING[m]:
             for k in TIMES:
-                if subject_vars[(j,k,m)].varValue == 1:
-                    classpop[(j,k,m)] = sum(assign_vars[(i,j,k,m)].varValue for i in SUBJECTMAPPING[j])
+                if subject_values[(j,k,m)] == 1:
+                    classpop[(j,k,m)] = sum(assign_values[(i,j,k,m)] for i in SUBJECTMAPPING[j])
 
-    if LpStatus[model.status] == "Optimal":
+    room_values = None
+    if status in SOLVED_STATES:
         print("Allocating Rooms")
+        started = time.perf_counter()
         model2 = LpProblem('RoomAllocation', LpMinimize)
         print("Defining Variables")
         subject_vars_rooms = LpVariable.dicts("SubjectVariablesRooms",
@@ -210,7 +817,7 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
             for j in TEACHERMAPPING[m]:
                 for k in TIMES:
                     if (j,k,m) in classpop.keys():
-                        model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for n in ROOMS) == subject_vars[(j, k, m)].varValue
+                        model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for n in ROOMS) == subject_values[(j, k, m)]
 
 
 
@@ -220,10 +827,11 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
                     model2 += projector_rooms_sum[(j)] == lpSum(subject_vars_rooms[(j,k,m,n)] for n in PROJECTORROOMS for k in TIMES if (j,k,m) in classpop.keys())
 
         print("Ensuring Uniqueness")
-        # Can only have one class in each room at a time.
+        # Can only have one class in each room at a time, and none in rooms taken by fixed classes.
         for k in TIMES:
             for n in ROOMS:
-                model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for m in TEACHERS for j in TEACHERMAPPING[m] if (j,k,m) in classpop.keys()) <= 1
+                model2 += lpSum(subject_vars_rooms[(j, k, m, n)] for m in TEACHERS for j in TEACHERMAPPING[m] if (j,k,m) in classpop.keys()) <= \
+                          (0 if (k, n) in FIXED.get('rooms', ()) else 1)
 
 
         print("Accomodating Capacities")
@@ -244,42 +852,251 @@ def runtimetable_with_rooms_two_step(STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACH
         print("Setting Objective Function")
         model2 += lpSum(teacher_number_rooms_sum[(m)] for m in TEACHERS) - 50 * lpSum(projector_rooms_sum[(j)] for j in PROJECTORS) +10 * lpSum(poppositive[(k,n)] for k in TIMES for n in ROOMS)
         print("Solve Room Allocation")
-        model2.solve()
-        print(LpStatus[model2.status])
-        if LpStatus[model2.status] == 'Optimal':
+        room_options = dict(solver_options or {})
+        if room_options.get('log_path'):
+            # Keep the first stage log for the job's report
+            room_options['log_path'] += '.rooms'
+        timetabler.solver.solve_pulp_model(model2, room_options)
+        report['rooms'] = time.perf_counter() - started
+        room_status = timetabler.solver.get_status(model2.status, model2.sol_status)
+        print(room_status)
+        if room_status in SOLVED_STATES:
             print("Complete")
-            print("Adding to Database")
-            timetabler.models.add_classes_to_timetable_twostep(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES,
-                                                               subject_vars_rooms, assign_vars, ROOMS, classpop)
-            print("Status:", LpStatus[model2.status])
-    return LpStatus[model.status]
+            room_values = {key: var.varValue for key, var in subject_vars_rooms.items()}
+    return status, room_values, assign_values, classpop
+
+
+def add_timetable_solution(data, room_values, assign_values, classpop, report, replace=False, subjects=None):
+    '''
+    Add a solution from solve_timetable_two_step to the database and log the timings.
+
+    :param data: The timetable data tuple the solution was solved from, as from get_timetable_data(rooms=True).
+    :param room_values: Values of the room allocation variables, or None if there is nothing to add.
+    :param assign_values: Values of the student assignment variables.
+    :param classpop: The population of each class that is running.
+    :param report: Dictionary of timings from the solve. The writeback time is added to it.
+    :param replace: Whether to remove the classes already on the current timetable first, when the solution is a
+                    re-solve of them (e.g. a warm start).
+    :param subjects: If given, the solution is a repair of just these subjects, and only their classes that
+                     changed are written (see models.update_classes_for_subjects).
+    :return: Nil.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+     NONPREFERREDTIMES, CAPACITIES) = data
+    if room_values is not None and subjects is not None:
+        print("Updating repaired classes in Database")
+        started = time.perf_counter()
+        report['kept'], report['created'], report['deleted'] = timetabler.models.update_classes_for_subjects(
+            subjects, room_values, assign_values, classpop)
+        report['writeback'] = time.perf_counter() - started
+    elif room_values is not None:
+        print("Adding to Database")
+        started = time.perf_counter()
+        if replace:
+            timetabler.models.remove_timetabled_classes()
+        timetabler.models.add_classes_to_timetable_twostep(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES,
+                                                           room_values, assign_values, ROOMS, classpop, report)
+        report['writeback'] = time.perf_counter() - started
+    print(format_build_report(report))
+    app.logger.info(format_build_report(report))
+
+
+def runtimetable_with_rooms_two_step(*data, report=None, backend=None, solver_options=None, warm_start=None,
+                                     symmetry_breaking=None):
+    '''
+    Run the timetabling process and input into the database.
+
+    :param data: The timetable data, as from get_timetable_data(rooms=True). See solve_timetable_two_step.
+    :param report: An optional dictionary which is filled with the model build, solve, room allocation and
+                    writeback times in seconds, along with the variable and constraint counts of the model.
+    :param backend: The model backend, as for solve_timetable_two_step.
+    :param solver_options: Dictionary of solver settings, as for solve_timetable_two_step.
+    :param warm_start: Optional starting solution, as for solve_timetable_two_step. The classes it came from are
+                    replaced by the new solution.
+    :param symmetry_breaking: Whether to break symmetry between interchangeable students, as for
+                    solve_timetable_two_step.
+    :return: A string representing model status.
+    '''
+    if report is None:
+        report = {}
+    status, room_values, assign_values, classpop = solve_timetable_two_step(*data, report=report, backend=backend,
+                                                                            solver_options=solver_options,
+                                                                            warm_start=warm_start,
+                                                                            symmetry_breaking=symmetry_breaking)
+    add_timetable_solution(data, room_values, assign_values, classpop, report, replace=warm_start is not None)
+    return status
+
+
+def snapshot_timetable_data(data):
+    '''
+    Serialise the timetable data tuple so it can be handed to another process or saved.
+
+    :param data: The timetable data, as from get_timetable_data(rooms=True).
+    :return: The data as a JSON string, with sets stored as sorted lists.
+    '''
+    def plain(value):
+        if isinstance(value, (set, frozenset)):
+            return sorted(value)
+        if isinstance(value, dict):
+            return {key: plain(item) for key, item in value.items()}
+        return value
+    return json.dumps([plain(value) for value in data])
+
+
+def load_timetable_data(snapshot):
+    '''
+    Read a snapshot written by snapshot_timetable_data.
+
+    :param snapshot: The JSON string.
+    :return: The timetable data tuple, with DAYS, SUBJECTMAPPING, TEACHERMAPPING and TUTORAVAILABILITY mapping to sets
+             as get_timetable_data returns them.
+    '''
+    data = json.loads(snapshot)
+    # Positions of DAYS, SUBJECTMAPPING, TEACHERMAPPING and TUTORAVAILABILITY in the tuple
+    for position in [4, 6, 8, 9]:
+        data[position] = {key: set(value) for key, value in data[position].items()}
+    return tuple(data)
+
+
+def solve_timetable_snapshot(snapshot, backend=None, solver_options=None, warm_start=None, FIXED=None,
+                             symmetry_breaking=None, tight_formulation=None):
+    '''
+    Solve a timetable from a snapshot. This is what a worker process runs, so it only takes and returns plain data.
+
+    :param snapshot: The timetable data from snapshot_timetable_data.
+    :param backend: The model backend, as for solve_timetable_two_step.
+    :param solver_options: Dictionary of solver settings, as for solve_timetable_two_step.
+    :param warm_start: Optional starting solution, as for solve_timetable_two_step.
+    :param FIXED: Optional fixed classes, as for solve_timetable_two_step.
+    :param symmetry_breaking: Whether to break symmetry between students, as for solve_timetable_two_step.
+    :param tight_formulation: Whether to use the tight formulation, as for solve_timetable_two_step.
+    :return: A tuple of the results of solve_timetable_two_step followed by the report dictionary.
+    '''
+    report = {}
+    result = solve_timetable_two_step(*load_timetable_data(snapshot), report=report, backend=backend,
+                                      solver_options=solver_options, warm_start=warm_start, FIXED=FIXED,
+                                      symmetry_breaking=symmetry_breaking, tight_formulation=tight_formulation)
+    return result + (report,)
+
 
+def get_timetable_changes(old, new):
+    '''
+    Find the subjects affected by the changes between two sets of timetable data, e.g. since the last solve.
 
+    A subject is affected if it was added, its students, repeats, tutor or projector need changed, or its tutor's
+    availability changed.
 
-def preparetimetable(addtonewtimetable=False):
+    :param old: The timetable data tuple at the last solve, as from load_timetable_data.
+    :param new: The timetable data tuple now, as from get_timetable_data(rooms=True).
+    :return: The set of affected subject codes, or None if the timeslots, rooms or class sizes changed, which
+             affects every class.
     '''
-    Get timetable data and then execute the timetabling program.
+    (OLDSTUDENTS, OLDSUBJECTS, OLDTIMES, oldday, OLDDAYS, OLDTEACHERS, OLDSUBJECTMAPPING, OLDREPEATS,
+     OLDTEACHERMAPPING, OLDTUTORAVAILABILITY, oldmaxclasssize, oldminclasssize, OLDROOMS, OLDPROJECTORS,
+     OLDPROJECTORROOMS, oldnumroomsprojector, OLDNONPREFERREDTIMES, OLDCAPACITIES) = old
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+     NONPREFERREDTIMES, CAPACITIES) = new
+    if (set(OLDTIMES) != set(TIMES) or set(OLDNONPREFERREDTIMES) != set(NONPREFERREDTIMES) or
+            OLDCAPACITIES != CAPACITIES or set(OLDPROJECTORROOMS) != set(PROJECTORROOMS) or
+            (oldmaxclasssize, oldminclasssize) != (maxclasssize, minclasssize)):
+        return None
+    oldtutors = {j: m for m in OLDTEACHERS for j in OLDTEACHERMAPPING[m]}
+    changed = set()
+    for m in TEACHERS:
+        for j in TEACHERMAPPING[m]:
+            if (oldtutors.get(j) != m or OLDSUBJECTMAPPING.get(j) != SUBJECTMAPPING[j] or
+                    OLDREPEATS.get(j) != REPEATS[j] or (j in OLDPROJECTORS) != (j in PROJECTORS) or
+                    OLDTUTORAVAILABILITY.get(m) != TUTORAVAILABILITY[m]):
+                changed.add(j)
+    # Subjects that were removed, so their classes are taken off the timetable
+    changed |= set(oldtutors) - changed - set(j for m in TEACHERS for j in TEACHERMAPPING[m])
+    return changed
 
-    :param addtonewtimetable: Whether this should be added to a new timetable and set as default.
-    :return: The view timetable page.
+
+def restrict_timetable_data(data, subjects, fixedclasses):
+    '''
+    Cut the timetable data down to some subjects, with the rest of the timetable fixed as it is.
+
+    :param data: The timetable data tuple, as from get_timetable_data(rooms=True).
+    :param subjects: The subject codes to timetable.
+    :param fixedclasses: The classes to keep, as from models.get_fixed_classes.
+    :return: A tuple of the timetable data for just the subjects, their tutors and their students, and the FIXED
+             dictionary for solve_timetable_two_step describing the fixed classes.
+    '''
+    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector,
+     NONPREFERREDTIMES, CAPACITIES) = data
+    NEWTEACHERMAPPING = {}
+    for m in TEACHERS:
+        if TEACHERMAPPING[m] & set(subjects):
+            NEWTEACHERMAPPING[m] = TEACHERMAPPING[m] & set(subjects)
+    NEWSUBJECTMAPPING = {j: SUBJECTMAPPING[j] for m in NEWTEACHERMAPPING for j in NEWTEACHERMAPPING[m]}
+    NEWSTUDENTS = set()
+    for j in NEWSUBJECTMAPPING:
+        NEWSTUDENTS |= NEWSUBJECTMAPPING[j]
+    NEWTUTORAVAILABILITY = {m: set(TUTORAVAILABILITY[m]) for m in NEWTEACHERMAPPING}
+
+    FIXED = {'times': {}, 'projectors': {}, 'students': {}, 'days': set(), 'rooms': set()}
+    for (j, k, m, n, students) in fixedclasses:
+        FIXED['times'][k] = FIXED['times'].get(k, 0) + 1
+        if j in PROJECTORS:
+            FIXED['projectors'][k] = FIXED['projectors'].get(k, 0) + 1
+        for i in students:
+            if i in NEWSTUDENTS:
+                FIXED['students'][(i, k)] = FIXED['students'].get((i, k), 0) + 1
+        if m in NEWTEACHERMAPPING:
+            # The tutor is busy at this time
+            NEWTUTORAVAILABILITY[m].discard(k)
+            FIXED['days'].add((m, k.split(' ')[0]))
+        if n is not None:
+            FIXED['rooms'].add((k, n))
+
+    restricted = (list(NEWSTUDENTS), sorted(NEWSUBJECTMAPPING), TIMES, day, DAYS, list(NEWTEACHERMAPPING),
+                  NEWSUBJECTMAPPING, REPEATS, NEWTEACHERMAPPING, NEWTUTORAVAILABILITY, maxclasssize, minclasssize,
+                  ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES)
+    return restricted, FIXED
+
+
+
+def preparetimetable(username=None, solver_options=None):
+    '''
+    Start the timetabling program as a background job (see timetabler.jobs).
+
+    Only one job runs at a time for each timetable, so if one is already queued or running it is returned instead.
+
+    :param username: The user running the timetabler.
+    :param solver_options: Dictionary of solver settings for this run, overriding appcfg.
+    :return: The Job.
 
     TESTED
     '''
     print("Preparing Timetable")
+    return timetabler.jobs.submit_timetable_job(username=username, solver_options=solver_options)
 
-    (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
-     TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS,PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES, CAPACITIES) = timetabler.models.get_timetable_data(rooms=True)
 
-    print("Everything ready")
-    executor.submit(runtimetable_with_rooms_two_step, STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING,
-                    REPEATS, TEACHERMAPPING,
-                    TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS,PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,CAPACITIES)
+def repairtimetable(username=None, solver_options=None):
+    '''
+    Start a repair of the current timetable as a background job (see timetabler.jobs).
 
+    Only the subjects affected by changes since the last solve are re-timetabled, around the rest of the timetable.
 
-    form = AddTimetableForm()
-    return render_template("viewtimetable.html", form=form)
+    :param username: The user running the repair.
+    :param solver_options: Dictionary of solver settings for this run, overriding appcfg.
+    :return: The Job.
+    '''
+    print("Preparing Timetable Repair")
+    return timetabler.jobs.submit_timetable_job(username=username, solver_options=solver_options, kind='repair')
 
 
+def get_available_solvers():
+    '''
+    Get the solvers that can be chosen on the Run Timetabler page.
+
+    :return: A list of solver names: "cbc" for the bundled CBC, then any other solvers PuLP can find.
+    '''
+    return ['cbc'] + [solver for solver in listSolvers(onlyAvailable=True) if solver != 'PULP_CBC_CMD']
 
 
 def allowed_file(filename):
@@ -299,7 +1116,7 @@ def upload(file):
     Save the uploaded file to the UPLOAD_FOLDER directory.
 
     :param file: The file to upload
-    :return: Filename of uploaded file in upload folder
+    :return: Filename of uploaded file in upload folder, or None if there is no file or its extension is not allowed
     '''
     if file and allowed_file(file.filename):
         # Make the filename safe, remove unsupported chars
@@ -313,6 +1130,19 @@ def upload(file):
         return path_to_file
 
 
+def formnumber(value, type=int):
+    '''
+    Get the value of an optional number field.
+
+    :param value: Input from request.form
+    :param type: int or float.
+    :return: The number, or None if the field was left blank.
+    '''
+    if value is None or value.strip() == '':
+        return None
+    return type(value)
+
+
 def checkboxvalue(checkbox):
     '''
     Get value of checkbox.
@@ -349,6 +1179,90 @@ def read_csv(filename):
     return pandas.read_csv(filename)
 
 
+def read_xlsx_chunks(filename, chunksize):
+    '''
+    Read the first sheet of an xlsx file a few rows at a time, without loading the whole workbook.
+
+    :param filename - path to an xlsx file:
+    :param chunksize: Number of rows in each chunk.
+    :return: A generator of pandas dataframes, with the first row of the sheet as their column names.
+    '''
+    # openpyxl is what pandas reads xlsx files with, so it is only needed once an xlsx file is uploaded
+    import openpyxl
+    workbook = openpyxl.load_workbook(filename, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = next(rows, None)
+        if header is None:
+            return
+        columns = [str(name) if name is not None else "Unnamed: " + str(n) for n, name in enumerate(header)]
+        chunk = []
+        for row in rows:
+            # Sheets often carry formatting on empty rows after the data
+            if all(value is None for value in row):
+                continue
+            chunk.append(row)
+            if len(chunk) == chunksize:
+                yield pandas.DataFrame(chunk, columns=columns)
+                chunk = []
+        if chunk:
+            yield pandas.DataFrame(chunk, columns=columns)
+    finally:
+        workbook.close()
+
+
+def read_spreadsheet_chunks(filename, chunksize=None):
+    '''
+    Read a CSV or Excel file a chunk of rows at a time, so that big files do not have to fit in memory at once.
+
+    CSV files are read with pandas in chunks and xlsx files are streamed row by row. Older xls files cannot be
+    streamed, so they are read whole as a single chunk.
+
+    :param filename - path to a CSV or Excel file:
+    :param chunksize: Number of rows in each chunk. Defaults to appcfg["upload_chunk_size"].
+    :return: A generator of pandas dataframes.
+    '''
+    if chunksize is None:
+        chunksize = appcfg.get("upload_chunk_size", 5000)
+    extension = os.path.splitext(filename)[1].lower()
+    if extension == ".csv":
+        for chunk in pandas.read_csv(filename, chunksize=chunksize):
+            yield chunk
+    elif extension == ".xlsx":
+        for chunk in read_xlsx_chunks(filename, chunksize):
+            yield chunk
+    else:
+        yield read_excel(filename)
+
+
+def import_spreadsheet(filename, populate, chunksize=None, progress=None):
+    '''
+    Import a CSV or Excel file with one of the populate functions, one chunk of rows at a time.
+
+    :param filename - path to a CSV or Excel file:
+    :param populate: The function that imports a dataframe, e.g. models.populate_students.
+    :param chunksize: Number of rows in each chunk, as for read_spreadsheet_chunks.
+    :param progress: Optional function called after each chunk with the number of rows and chunks imported so far.
+    :return: A dictionary of the number of rows and chunks imported, plus the totals of any counts populate returns
+             and the concatenation of any lists, e.g. of names it could not match.
+    '''
+    summary = {'rows': 0, 'chunks': 0}
+    for chunk in read_spreadsheet_chunks(filename, chunksize):
+        counts = populate(chunk)
+        for key, value in (counts or {}).items():
+            if isinstance(value, list):
+                summary.setdefault(key, []).extend(value)
+            else:
+                summary[key] = summary.get(key, 0) + value
+        summary['rows'] += len(chunk)
+        summary['chunks'] += 1
+        print("Imported", summary['rows'], "rows from", filename)
+        app.logger.info('Imported %d rows in %d chunks from %s', summary['rows'], summary['chunks'], filename)
+        if progress is not None:
+            progress(summary['rows'], summary['chunks'])
+    return summary
+
+
 def create_roll(students, subject, timeslot, room):
     path_to_file = app.config['UPLOAD_FOLDER'] + '/roll_' + \
         subject.subcode + '_' + time.strftime("%Y-%m-%d_%H%M%S") + '.docx'
@@ -385,9 +1299,8 @@ def create_roll(students, subject, timeslot, room):
 
 def create_excel(data):
     path_to_file = app.config['UPLOAD_FOLDER'] + '/timetable' + time.strftime("%Y-%m-%d_%H%M%S") + '.xlsx'
-    writer = pandas.ExcelWriter(path_to_file, engine='xlsxwriter')
-    data.to_excel(writer, sheet_name='Timetable', index=False)
-    writer.save()
+    with pandas.ExcelWriter(path_to_file, engine='xlsxwriter') as writer:
+        data.to_excel(writer, sheet_name='Timetable', index=False)
     return path_to_file
 
 
@@ -0,0 +1,371 @@
+'''
+Background timetabling jobs.
+
+A job is saved in the jobs table when the timetabler is started from the Run Timetabler page, and then run on the
+executor. The page polls the job for its status and progress, and can cancel it, which kills the running CBC process.
+
+A "timetable" job solves the whole timetable. A "repair" job compares the data with the snapshot kept by the last
+solved job, and re-timetables only the subjects that changed, with the rest of the timetable fixed.
+
+An "upload" job imports an uploaded spreadsheet, so that a big file does not hold up the request. The import runs in
+one transaction, and its progress is kept in memory for the upload pages to poll.
+'''
+import datetime
+import functools
+import glob
+import json
+import os
+import signal
+import tempfile
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from timetabler import app, db, executor
+from timetabler.config import appcfg
+import timetabler.helpers
+import timetabler.models
+import timetabler.solver
+
+ACTIVE_STATES = ['queued', 'running']
+
+# The populate function for each kind of upload
+UPLOAD_IMPORTS = {'students': 'populate_students', 'timetable': 'populate_timetabledata',
+                  'tutors': 'populate_tutors', 'availabilities': 'populate_availabilities'}
+
+# Rows imported so far by each running upload job, by job id. This is not saved in the jobs table because the
+# import's transaction is not committed until it finishes.
+upload_progress = {}
+
+# Held while checking for an active job, so that two quick clicks cannot both start a solve.
+submit_lock = threading.Lock()
+
+process_pool = None
+
+
+def get_job_path(jobid, extension):
+    '''
+    Get the path of one of the files a job keeps while it runs.
+
+    :param jobid: The id of the Job.
+    :param extension: 'log' for the CBC log, 'pid' for the CBC process id or 'cancel' for the cancel marker.
+    :return: Path to the file in appcfg["job_folder"].
+    '''
+    folder = appcfg.get("job_folder") or tempfile.gettempdir()
+    os.makedirs(folder, exist_ok=True)
+    return os.path.join(folder, 'timetable-job-{}.{}'.format(jobid, extension))
+
+
+def get_active_job(timetable=None):
+    '''
+    Get the queued or running job for a timetable, if there is one.
+
+    :param timetable: The timetable id. Defaults to the current timetable.
+    :return: The Job or None.
+    '''
+    if timetable is None:
+        timetable = timetabler.models.get_current_timetable_id()
+    return timetabler.models.Job.query.filter(timetabler.models.Job.timetable == timetable,
+                                              timetabler.models.Job.status.in_(ACTIVE_STATES)).first()
+
+
+def get_latest_job():
+    '''
+    Get the most recent job for the current timetable.
+
+    :return: The Job or None.
+    '''
+    return timetabler.models.Job.query.filter_by(
+        timetable=timetabler.models.get_current_timetable_id()).order_by(timetabler.models.Job.id.desc()).first()
+
+
+def get_last_solved_job(timetable=None):
+    '''
+    Get the most recent job that solved a timetable and kept a snapshot of its data.
+
+    :param timetable: The timetable id. Defaults to the current timetable.
+    :return: The Job or None.
+    '''
+    if timetable is None:
+        timetable = timetabler.models.get_current_timetable_id()
+    return timetabler.models.Job.query.filter(
+        timetabler.models.Job.timetable == timetable,
+        timetabler.models.Job.status.in_([status.lower() for status in timetabler.helpers.SOLVED_STATES]),
+        timetabler.models.Job.snapshot.isnot(None)).order_by(timetabler.models.Job.id.desc()).first()
+
+
+def submit_timetable_job(username=None, solver_options=None, run=True, kind='timetable'):
+    '''
+    Start the timetabling program in the background for the current timetable.
+
+    If a job is already queued or running for the timetable, that job is returned and no new solve is started.
+
+    :param username: The user starting the job.
+    :param solver_options: Dictionary of solver settings for this run, overriding appcfg (see
+                           solver.get_solver_options).
+    :param run: Whether to submit the job to the executor. Tests set this to False and call run_timetable_job.
+    :param kind: "timetable" to solve the whole timetable, or "repair" to re-timetable what changed since the last
+                 solve.
+    :return: The Job.
+    '''
+    with submit_lock:
+        job = get_active_job()
+        if job is not None:
+            return job
+        job = timetabler.models.Job(kind, timetable=timetabler.models.get_current_timetable_id(),
+                                    username=username, options=json.dumps(solver_options or {}))
+        job.save()
+    if run:
+        executor.submit(run_timetable_job, job.id)
+    return job
+
+
+def run_timetable_job(jobid):
+    '''
+    Run a timetabling job. This is called on the executor and saves the job's status as it goes.
+
+    :param jobid: The id of the Job to run.
+    :return: The final status of the job.
+    '''
+    with app.app_context():
+        try:
+            job = timetabler.models.Job.query.get(jobid)
+            if job is None or job.status != 'queued':
+                return job and job.status
+            job.update(status='running', started=datetime.datetime.now(), logfile=get_job_path(jobid, 'log'))
+            solver_options = timetabler.solver.get_solver_options(json.loads(job.options or '{}'))
+            solver_options.update(log_path=job.logfile, pid_path=get_job_path(jobid, 'pid'),
+                                  cancel_path=get_job_path(jobid, 'cancel'))
+            data = timetabler.models.get_timetable_data(rooms=True)
+            snapshot = timetabler.helpers.snapshot_timetable_data(data)
+            solve_data, FIXED, subjects = data, None, None
+            if job.kind == 'repair':
+                subjects, message = get_repair_subjects(data, jobid)
+                if not subjects:
+                    job.update(status='optimal' if subjects is not None else 'failed',
+                               finished=datetime.datetime.now(), message=message,
+                               snapshot=snapshot if subjects is not None else None)
+                    return job.status
+                solve_data, FIXED = timetabler.helpers.restrict_timetable_data(
+                    data, subjects, timetabler.models.get_fixed_classes(subjects))
+            warm_start = None
+            if solver_options.get('warm_start') and job.kind != 'repair':
+                warm_start = timetabler.models.get_timetable_solution()
+            report = {}
+            try:
+                status, room_values, assign_values, classpop, report = solve_in_worker(
+                    timetabler.helpers.snapshot_timetable_data(solve_data), solver_options, warm_start, FIXED)
+                message = "Solver finished with status " + status
+            except Exception as e:
+                app.logger.exception('Timetable job %s failed', jobid)
+                status = None
+                message = str(e)[:200]
+            db.session.refresh(job)
+            if job.status == 'cancelled':
+                return job.status
+            if status is not None:
+                timetabler.helpers.add_timetable_solution(solve_data, room_values, assign_values, classpop, report,
+                                                          replace=warm_start is not None, subjects=subjects)
+            if status in timetabler.helpers.SOLVED_STATES and 'writeback' in report:
+                result = status.lower()
+            elif status == 'Infeasible':
+                result = 'infeasible'
+            else:
+                result = 'failed'
+            if report.get('stopped_by'):
+                message += ", stopped by the " + report['stopped_by']
+            if subjects is not None:
+                message += ", repaired " + str(len(subjects)) + " subjects"
+            job.update(status=result, finished=datetime.datetime.now(), message=message[:200],
+                       objective=report.get('objective'), bound=report.get('bound'), gap=report.get('gap'),
+                       report=json.dumps(report), snapshot=snapshot if result in ('optimal', 'feasible') else None)
+            return job.status
+        finally:
+            if os.path.exists(get_job_path(jobid, 'cancel')):
+                os.remove(get_job_path(jobid, 'cancel'))
+            db.session.remove()
+
+
+def get_repair_subjects(data, jobid):
+    '''
+    Find the subjects a repair job should re-timetable.
+
+    :param data: The timetable data now, as from models.get_timetable_data(rooms=True).
+    :param jobid: The id of the repair Job, so that it is not compared with itself.
+    :return: A tuple of the set of subject codes that changed since the last solve and a message. The set is empty
+             if nothing changed, and None if the timetable cannot be repaired and needs a full run.
+    '''
+    previous = get_last_solved_job()
+    if previous is None or previous.id == jobid:
+        return None, "There is no solved timetable to repair, run the timetabler first"
+    subjects = timetabler.helpers.get_timetable_changes(
+        timetabler.helpers.load_timetable_data(previous.snapshot), data)
+    if subjects is None:
+        return None, "The timeslots, rooms or class sizes have changed, run the timetabler again"
+    if not subjects:
+        return subjects, "Nothing has changed since the last solve"
+    return subjects, ""
+
+
+def submit_upload_job(upload, path, username=None, run=True):
+    '''
+    Start importing an uploaded file in the background.
+
+    :param upload: The kind of file, one of the keys of UPLOAD_IMPORTS.
+    :param path: Path to the uploaded file.
+    :param username: The user uploading the file.
+    :param run: Whether to submit the job to the executor. Tests set this to False and call run_upload_job.
+    :return: The Job.
+    '''
+    if upload not in UPLOAD_IMPORTS:
+        raise ValueError("Unknown upload: " + str(upload))
+    job = timetabler.models.Job('upload', username=username, options=json.dumps({'upload': upload, 'path': path}))
+    job.save()
+    if run:
+        executor.submit(run_upload_job, job.id)
+    return job
+
+
+@contextmanager
+def import_transaction():
+    '''
+    Run an import in a single transaction.
+
+    The populate functions are called with commit=False inside this block, so they only flush. The transaction is
+    committed when the block finishes, and an error rolls back the whole import.
+
+    :return: The session.
+    '''
+    try:
+        yield db.session
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+
+def run_upload_job(jobid):
+    '''
+    Run an upload job. This is called on the executor and saves the job's status when it finishes.
+
+    :param jobid: The id of the Job to run.
+    :return: The final status of the job, "finished" or "failed".
+    '''
+    with app.app_context():
+        try:
+            job = timetabler.models.Job.query.get(jobid)
+            if job is None or job.status != 'queued':
+                return job and job.status
+            options = json.loads(job.options)
+            job.update(status='running', started=datetime.datetime.now())
+            upload_progress[jobid] = 0
+            populate = getattr(timetabler.models, UPLOAD_IMPORTS[options['upload']])
+            try:
+                with import_transaction():
+                    summary = timetabler.helpers.import_spreadsheet(
+                        options['path'], functools.partial(populate, commit=False),
+                        progress=lambda rows, chunks: upload_progress.update({jobid: rows}))
+                status = 'finished'
+                message = "Imported " + str(summary['rows']) + " rows"
+                if summary.get('unmatched'):
+                    message += ", " + str(len(summary['unmatched'])) + " student names were not found: " + \
+                               ", ".join(summary['unmatched'])
+            except Exception as e:
+                app.logger.exception('Upload job %s failed', jobid)
+                summary = {}
+                status = 'failed'
+                message = ("Nothing was imported: " + str(e))[:200]
+            job = timetabler.models.Job.query.get(jobid)
+            job.update(status=status, finished=datetime.datetime.now(), message=message, report=json.dumps(summary))
+            return job.status
+        finally:
+            upload_progress.pop(jobid, None)
+            db.session.remove()
+
+
+def get_upload_job(jobid):
+    '''
+    Get an upload job with the number of rows it has imported so far.
+
+    :param jobid: The id of the Job.
+    :return: Dictionary of the job as from Job.as_dict, plus rows, or None if there is no such upload job.
+    '''
+    job = timetabler.models.Job.query.get(jobid)
+    if job is None or job.kind != 'upload':
+        return None
+    result = job.as_dict()
+    if job.status in ACTIVE_STATES:
+        result['rows'] = upload_progress.get(jobid, 0)
+    else:
+        result['rows'] = json.loads(job.report or '{}').get('rows')
+    return result
+
+
+def get_process_pool():
+    '''
+    Get the pool of worker processes that solves run in when appcfg["job_execution"] is "process".
+
+    :return: The ProcessPoolExecutor, created on first use.
+    '''
+    global process_pool
+    if process_pool is None:
+        process_pool = ProcessPoolExecutor(appcfg.get("solver_processes", 1))
+    return process_pool
+
+
+def solve_in_worker(snapshot, solver_options, warm_start=None, FIXED=None):
+    '''
+    Solve a timetable snapshot in the way set by appcfg["job_execution"]: in this thread ("thread"), or in a worker
+    process ("process") so that building the model does not hold up the web process. Either way only plain data
+    comes back, and the caller writes it to the database. The symmetry breaking and tight formulation settings are
+    passed from this process's appcfg, so that a worker process uses them too.
+
+    :param snapshot: The timetable data from helpers.snapshot_timetable_data.
+    :param solver_options: Dictionary of solver settings.
+    :param warm_start: Optional starting solution from models.get_timetable_solution.
+    :param FIXED: Optional fixed classes for a repair, from helpers.restrict_timetable_data.
+    :return: The result of helpers.solve_timetable_snapshot.
+    '''
+    settings = {'symmetry_breaking': appcfg.get("symmetry_breaking", False),
+                'tight_formulation': appcfg.get("tight_formulation", False)}
+    if appcfg.get("job_execution", "thread") == 'process':
+        return get_process_pool().submit(timetabler.helpers.solve_timetable_snapshot, snapshot,
+                                         solver_options=solver_options, warm_start=warm_start,
+                                         FIXED=FIXED, **settings).result()
+    return timetabler.helpers.solve_timetable_snapshot(snapshot, solver_options=solver_options,
+                                                       warm_start=warm_start, FIXED=FIXED, **settings)
+
+
+def cancel_job(jobid):
+    '''
+    Cancel a queued or running job. A running CBC process is killed, and no further solves are started for the job.
+
+    :param jobid: The id of the Job to cancel.
+    :return: The Job, or None if there is no such job.
+    '''
+    job = timetabler.models.Job.query.get(jobid)
+    if job is None or job.status not in ACTIVE_STATES:
+        return job
+    open(get_job_path(jobid, 'cancel'), 'w').close()
+    job.update(status='cancelled', finished=datetime.datetime.now(), message="Cancelled")
+    # A decomposed solve runs a CBC process for each component, with pid files numbered after the job's
+    for pid_path in glob.glob(get_job_path(jobid, 'pid') + '*'):
+        try:
+            with open(pid_path) as f:
+                os.kill(int(f.read()), signal.SIGTERM)
+        except (OSError, ValueError):
+            # CBC finished between finding the file and killing it
+            pass
+    return job
+
+
+def refresh_job_progress(job):
+    '''
+    Update a running job's objective, bound and gap from its CBC log.
+
+    :param job: The Job.
+    :return: The Job.
+    '''
+    if job is not None and job.status == 'running' and job.logfile:
+        stats = timetabler.solver.parse_cbc_log(job.logfile)
+        job.update(objective=stats.get('objective'), bound=stats.get('bound'), gap=stats.get('gap'))
+    return job
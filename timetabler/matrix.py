@@ -0,0 +1,452 @@
+'''
+Sparse matrix backend for the timetabling model.
+
+This builds the same model as helpers.solve_timetable_pulp, but as NumPy coordinate (COO) arrays instead of
+PuLP expression objects, writes it straight to an MPS file and solves it with CBC. On large runs this avoids
+creating hundreds of thousands of small Python objects for the variables and constraints.
+'''
+import os
+import tempfile
+import time
+import numpy
+import timetabler.enrolments
+import timetabler.solver
+from timetabler import app
+from timetabler.config import appcfg
+
+
+class SparseModel(object):
+    '''
+    A mixed integer model held as coordinate arrays.
+
+    Variables are added in contiguous blocks of columns and constraints in blocks of rows, so that callers can
+    work out column and row numbers arithmetically with NumPy rather than looking up individual objects.
+    '''
+
+    def __init__(self, name):
+        self.name = name
+        self.numcols = 0
+        self.numrows = 0
+        self.lower = []
+        self.upper = []
+        self.integer = []
+        self.cost = []
+        self.rows = []
+        self.cols = []
+        self.vals = []
+        self.senses = []
+        self.rhs = []
+
+    def add_variables(self, count, lower=0, upper=None, integer=False, cost=0):
+        '''
+        Add a block of variables.
+
+        :param count: Number of variables in the block.
+        :param lower: Lower bound, or None for no lower bound.
+        :param upper: Upper bound, or None for no upper bound.
+        :param integer: Whether the variables are integer.
+        :param cost: Objective coefficient for every variable in the block.
+        :return: The column number of the first variable in the block.
+        '''
+        base = self.numcols
+        self.lower.append(numpy.full(count, -numpy.inf if lower is None else float(lower)))
+        self.upper.append(numpy.full(count, numpy.inf if upper is None else float(upper)))
+        self.integer.append(numpy.full(count, integer, dtype=bool))
+        self.cost.append(numpy.full(count, float(cost)))
+        self.numcols += count
+        return base
+
+    def add_constraints(self, count, rows, cols, vals, sense, rhs=0):
+        '''
+        Add a block of constraints.
+
+        Rows, columns and coefficients may be given as several parts, e.g. one part for the variables being
+        summed and another for the variable the sum is linked to.
+
+        :param count: Number of rows in the block.
+        :param rows: An array (or list of arrays) of row numbers within the block, starting from zero.
+        :param cols: An array (or list of arrays) of column numbers, matching rows.
+        :param vals: An array (or list of arrays/scalars) of coefficients, matching rows.
+        :param sense: One of 'L', 'G' or 'E' for <=, >= and ==.
+        :param rhs: The right hand side, either a scalar or an array with one entry per row.
+        :return: The row number of the first row in the block.
+        '''
+        if not isinstance(rows, list):
+            rows, cols, vals = [rows], [cols], [vals]
+        for r, c, v in zip(rows, cols, vals):
+            r = numpy.asarray(r, dtype=numpy.int64)
+            self.rows.append(r + self.numrows)
+            self.cols.append(numpy.asarray(c, dtype=numpy.int64))
+            self.vals.append(numpy.broadcast_to(numpy.asarray(v, dtype=float), r.shape))
+        self.senses.append(numpy.full(count, sense))
+        self.rhs.append(numpy.broadcast_to(numpy.asarray(rhs, dtype=float), (count,)))
+        base = self.numrows
+        self.numrows += count
+        return base
+
+    def coo(self):
+        '''
+        Get the constraint matrix with duplicate entries summed and zero entries removed.
+
+        :return: A tuple of row, column and value arrays, sorted by column then row.
+        '''
+        rows = numpy.concatenate(self.rows) if self.rows else numpy.zeros(0, dtype=numpy.int64)
+        cols = numpy.concatenate(self.cols) if self.cols else numpy.zeros(0, dtype=numpy.int64)
+        vals = numpy.concatenate(self.vals) if self.vals else numpy.zeros(0)
+        keys = cols * max(self.numrows, 1) + rows
+        keys, inverse = numpy.unique(keys, return_inverse=True)
+        summed = numpy.zeros(len(keys))
+        numpy.add.at(summed, inverse, vals)
+        keep = summed != 0
+        keys = keys[keep]
+        return keys % max(self.numrows, 1), keys // max(self.numrows, 1), summed[keep]
+
+    def write_mps(self, path):
+        '''
+        Write the model to a fixed format MPS file, using the same conventions as PuLP.
+
+        :param path: File to write to.
+        :return: Nil.
+        '''
+        rows, cols, vals = self.coo()
+        lower = numpy.concatenate(self.lower)
+        upper = numpy.concatenate(self.upper)
+        integer = numpy.concatenate(self.integer)
+        cost = numpy.concatenate(self.cost)
+        senses = numpy.concatenate(self.senses)
+        rhs = numpy.concatenate(self.rhs)
+
+        # Every column needs at least one entry to be declared, so give the objective an explicit (possibly zero)
+        # entry for any column which has a cost or appears in no constraint.
+        objcols = numpy.flatnonzero((cost != 0) | (numpy.bincount(cols, minlength=self.numcols) == 0))
+        entrycols = numpy.concatenate([objcols, cols])
+        entryrows = numpy.concatenate([numpy.full(len(objcols), -1), rows])
+        entryvals = numpy.concatenate([cost[objcols], vals])
+        order = numpy.argsort(entrycols, kind='stable')
+
+        with open(path, 'w') as f:
+            f.write('*SENSE:Minimize\n')
+            f.write('NAME          %s\n' % self.name)
+            f.write('ROWS\n')
+            f.write(' N  OBJ\n')
+            f.writelines(' %s  R%07d\n' % (sense, r) for r, sense in enumerate(senses.tolist()))
+            f.write('COLUMNS\n')
+            marked = False
+            for c, r, v in zip(entrycols[order].tolist(), entryrows[order].tolist(), entryvals[order].tolist()):
+                if integer[c] != marked:
+                    marked = integer[c]
+                    f.write("    MARK      'MARKER'                 '%s'\n" % ('INTORG' if marked else 'INTEND'))
+                f.write('    C%07d  %-8s  % .12e\n' % (c, 'OBJ' if r < 0 else 'R%07d' % r, v))
+            if marked:
+                f.write("    MARK      'MARKER'                 'INTEND'\n")
+            f.write('RHS\n')
+            f.writelines('    RHS       R%07d  % .12e\n' % (r, rhs[r]) for r in numpy.flatnonzero(rhs).tolist())
+            f.write('BOUNDS\n')
+            for c in range(self.numcols):
+                f.writelines(_bound_lines(c, lower[c], upper[c], integer[c]))
+            f.write('ENDATA\n')
+
+    def solve(self, solver_options=None, start=None):
+        '''
+        Solve the model with CBC.
+
+        :param solver_options: Dictionary of solver settings, as for solver.solve_pulp_model.
+        :param start: Optional dictionary of starting values indexed by column, given to CBC as a warm start.
+        :return: A tuple of the model status as a string (as in LpStatus), an array of variable values and a
+                 dictionary of statistics read from the CBC log.
+        '''
+        solver_options = solver_options or {}
+        if solver_options.get('solver', 'cbc') != 'cbc':
+            raise ValueError("The matrix backend only supports the cbc solver")
+        with tempfile.TemporaryDirectory() as directory:
+            model_path = os.path.join(directory, 'model.mps')
+            solution_path = os.path.join(directory, 'model.sol')
+            self.write_mps(model_path)
+            options = timetabler.solver.get_cbc_options(solver_options)
+            if start:
+                start_path = os.path.join(directory, 'start.mst')
+                timetabler.solver.write_mip_start(start_path, {'C%07d' % c: value for c, value in start.items()})
+                options.append('mips ' + start_path)
+            stats = timetabler.solver.run_cbc(model_path, solution_path, options=options,
+                                              log_path=solver_options.get('log_path'),
+                                              pid_path=solver_options.get('pid_path'),
+                                              cancel_path=solver_options.get('cancel_path'))
+            status, solution = timetabler.solver.read_solution(solution_path)
+        values = numpy.zeros(self.numcols)
+        for name, value in solution.items():
+            if name.startswith('C'):
+                values[int(name[1:])] = value
+        return status, values, stats
+
+
+def _bound_lines(c, lower, upper, integer):
+    '''
+    MPS bound lines for a single column, following PuLP's writeMPSBoundLines.
+    '''
+    name = 'C%07d' % c
+    if lower == upper:
+        return [' FX BND       %-8s  % .12e\n' % (name, lower)]
+    if integer and lower == 0 and upper == 1:
+        return [' BV BND       %-8s\n' % name]
+    lines = []
+    if lower > -numpy.inf:
+        # Integer columns without bounds are read as binary by CBC, so write the zero lower bound explicitly.
+        if lower != 0 or (integer and upper == numpy.inf):
+            lines.append(' LO BND       %-8s  % .12e\n' % (name, lower))
+    elif upper < numpy.inf:
+        lines.append(' MI BND       %-8s\n' % name)
+    else:
+        lines.append(' FR BND       %-8s\n' % name)
+    if upper < numpy.inf:
+        lines.append(' UP BND       %-8s  % .12e\n' % (name, upper))
+    return lines
+
+
+def build_timetable_matrix(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                           TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                           NONPREFERREDTIMES, FIXED=None, prune=None, symmetry_breaking=False,
+                           tight_formulation=None):
+    '''
+    Build the first stage timetabling model as a SparseModel.
+
+    Classes are the (subject, tutor) pairs and enrolments the (student, subject, tutor) triples. Each has one
+    variable per timeslot its tutor is available (or per timeslot if prune is False), laid out in (class, time) and
+    (enrolment, time) order. The grids of every (class, time) and (enrolment, time) are masked to the ones with
+    variables, which lets every constraint block be built with array arithmetic.
+
+    The parameters are as for helpers.runtimetable_with_rooms_two_step, and FIXED is as for
+    helpers.solve_timetable_pulp. prune defaults to appcfg["prune_unavailable_times"]. The days worked and student
+    clashes are formulated as in helpers.solve_timetable_pulp, depending on tight_formulation (which defaults to
+    appcfg["tight_formulation"]), and so are the symmetry breaking constraints.
+
+    :return: A tuple of the model and a dictionary describing the variable layout, with the number of variables and
+             constraints the model would have without pruning.
+    '''
+    model = SparseModel('Timetabling')
+    FIXED = FIXED or {}
+    if prune is None:
+        prune = appcfg.get("prune_unavailable_times", True)
+    tight = appcfg.get("tight_formulation", False) if tight_formulation is None else tight_formulation
+    T = len(TIMES)
+    D = len(day)
+    classes = [(j, m) for m in TEACHERS for j in TEACHERMAPPING[m]]
+    enrolments = [(i, q) for q, (j, m) in enumerate(classes) for i in SUBJECTMAPPING[j]]
+    studentindex = {i: s for s, i in enumerate(STUDENTS)}
+    tutorindex = {m: n for n, m in enumerate(TEACHERS)}
+    Q, P, S, M = len(classes), len(enrolments), len(STUDENTS), len(TEACHERS)
+
+    class_of = numpy.array([q for (i, q) in enrolments], dtype=numpy.int64)
+    student_of = numpy.array([studentindex[i] for (i, q) in enrolments], dtype=numpy.int64)
+    tutor_of = numpy.array([tutorindex[m] for (j, m) in classes], dtype=numpy.int64)
+    day_of = numpy.array([next((d for d in range(D) if k in DAYS[day[d]]), -1) for k in TIMES], dtype=numpy.int64)
+    nonpreferred = numpy.array([k in NONPREFERREDTIMES for k in TIMES], dtype=bool)
+    projector = numpy.array([j in PROJECTORS for (j, m) in classes], dtype=bool)
+    available = numpy.array([[k in TUTORAVAILABILITY[m] for k in TIMES] for m in TEACHERS], dtype=bool)
+    fixedtimes = numpy.array([FIXED.get('times', {}).get(k, 0) for k in TIMES])
+    fixedprojectors = numpy.array([FIXED.get('projectors', {}).get(k, 0) for k in TIMES])
+    fixedstudents = numpy.array([FIXED.get('students', {}).get((i, k), 0) for i in STUDENTS for k in TIMES])
+
+    # Which (class, time) and (enrolment, time) pairs have variables, and the position of each among them.
+    keep_qt = available[tutor_of].ravel() if prune else numpy.ones(Q * T, dtype=bool)
+    keep_pt = keep_qt[(class_of[:, None] * T + numpy.arange(T)).ravel()]
+    position_qt = numpy.cumsum(keep_qt) - 1
+    nqt, npt = int(keep_qt.sum()), int(keep_pt.sum())
+
+    assign = model.add_variables(npt, 0, 1, True)
+    subject = model.add_variables(nqt, 0, 1, True)
+    num930classes = model.add_variables(T, 0, None, True, cost=1)
+    daysforteachers = model.add_variables(M * D, 0, 1, True)
+    daysforteacherssum = model.add_variables(M, 0, None, True, cost=500)
+    studenttime = model.add_variables(S * T, 0, None if tight else 1, True)
+    studentsum = model.add_variables(S, 0, None, True, cost=100)
+    projectortime = model.add_variables(T, None, None, True)
+    projectorpositive = model.add_variables(T, 0, None, True, cost=5000)
+
+    # Flattened (enrolment, time) and (class, time) grids of the variables, in column order.
+    pt_p = numpy.repeat(numpy.arange(P), T)[keep_pt]
+    pt_t = numpy.tile(numpy.arange(T), P)[keep_pt]
+    pt_assign = assign + numpy.arange(npt)
+    pt_subject = subject + position_qt[class_of[pt_p] * T + pt_t]
+    qt_q = numpy.repeat(numpy.arange(Q), T)[keep_qt]
+    qt_t = numpy.tile(numpy.arange(T), Q)[keep_qt]
+    qt_subject = subject + numpy.arange(nqt)
+    times = numpy.arange(T)
+
+    # Days worked by each tutor.
+    onday = day_of[qt_t] >= 0
+    daysrows = tutor_of[qt_q[onday]] * D + day_of[qt_t[onday]]
+    dayscols = daysforteachers + numpy.arange(M * D)
+    # Days tutors already work because of fixed classes count whether or not there are classes in the model.
+    workingdays = numpy.array([(m, day[d]) in FIXED.get('days', ()) for m in TEACHERS for d in range(D)], dtype=float)
+    if tight:
+        ondays = int(onday.sum())
+        model.add_constraints(ondays, [numpy.arange(ondays), numpy.arange(ondays)],
+                              [dayscols[daysrows], qt_subject[onday]], [1, -1], 'G')
+        working = numpy.flatnonzero(workingdays)
+        model.add_constraints(len(working), numpy.arange(len(working)), dayscols[working], 1, 'G', 1)
+    else:
+        model.add_constraints(M * D, [numpy.arange(M * D), daysrows], [dayscols, qt_subject[onday]],
+                              [1, -0.1 * (1 - workingdays[daysrows])], 'G', workingdays)
+    model.add_constraints(M * D, [numpy.arange(M * D), daysrows], [dayscols, qt_subject[onday]], [1, -1], 'L',
+                          workingdays)
+    model.add_constraints(M, [numpy.arange(M), numpy.repeat(numpy.arange(M), D)],
+                          [daysforteacherssum + numpy.arange(M), dayscols], [1, -1], 'E')
+
+    # Tutor availability, which only needs constraints if there are variables for the times tutors are not available.
+    unavailable = ~available.ravel()
+    if not prune:
+        rowmap = numpy.full(M * T, -1)
+        rowmap[unavailable] = numpy.arange(unavailable.sum())
+        rows = rowmap[tutor_of[qt_q] * T + qt_t]
+        model.add_constraints(int(unavailable.sum()), rows[rows >= 0], qt_subject[rows >= 0], 1, 'E')
+
+    # Each student attends each of their subjects once, and only when the class is running.
+    model.add_constraints(P, pt_p, pt_assign, 1, 'E', 1)
+    model.add_constraints(npt, [numpy.arange(npt), numpy.arange(npt)], [pt_assign, pt_subject], [1, -1], 'L')
+
+    # Number of repeats for each class.
+    model.add_constraints(Q, qt_q, qt_subject, 1, 'E', [REPEATS[j] for (j, m) in classes])
+
+    # Rooms available at each time.
+    model.add_constraints(T, qt_t, qt_subject, 1, 'L', len(ROOMS) - fixedtimes)
+
+    # Soft limit on the number of classes needing projectors.
+    withprojector = projector[qt_q]
+    model.add_constraints(T, [times, qt_t[withprojector]], [projectortime + times, qt_subject[withprojector]],
+                          [1, -1], 'E', fixedprojectors - numroomsprojector)
+    model.add_constraints(T, [times, times], [projectorpositive + times, projectortime + times], [1, -1], 'G')
+    model.add_constraints(T, times, projectorpositive + times, 1, 'G')
+
+    # Tutors teach one class at a time.
+    keep_mt = available.ravel() if prune else numpy.ones(M * T, dtype=bool)
+    position_mt = numpy.cumsum(keep_mt) - 1
+    model.add_constraints(int(keep_mt.sum()), position_mt[tutor_of[qt_q] * T + qt_t], qt_subject, 1, 'L', 1)
+
+    # Student clashes.
+    clashrows = student_of[pt_p] * T + pt_t
+    clashcols = studenttime + numpy.arange(S * T)
+    if tight:
+        model.add_constraints(S * T, [numpy.arange(S * T), clashrows], [clashcols, pt_assign], [1, -1], 'G',
+                              fixedstudents - 1)
+    else:
+        model.add_constraints(S * T, [numpy.arange(S * T), clashrows], [clashcols, pt_assign], [1, -0.5], 'L',
+                              0.5 * fixedstudents)
+        model.add_constraints(S * T, [numpy.arange(S * T), clashrows], [clashcols, pt_assign], [1, -0.15], 'G',
+                              0.15 * fixedstudents - 0.15)
+    model.add_constraints(S, [numpy.arange(S), numpy.repeat(numpy.arange(S), T)],
+                          [studentsum + numpy.arange(S), clashcols], [1, -1], 'E')
+
+    # Classes at non-preferred times.
+    late = nonpreferred[qt_t]
+    model.add_constraints(T, [times, qt_t[late]], [num930classes + times, qt_subject[late]], [1, -1], 'E')
+
+    # Class sizes.
+    sizerows = position_qt[class_of[pt_p] * T + pt_t]
+    model.add_constraints(nqt, [sizerows, numpy.arange(nqt)], [pt_assign, qt_subject], [1, -minclasssize], 'G')
+    model.add_constraints(nqt, sizerows, pt_assign, 1, 'L', maxclasssize)
+
+    # Each interchangeable student attends a repeat at the same or an earlier time than the next one: by each time,
+    # the next student has been to the class no more than the student before them.
+    if symmetry_breaking:
+        SYMMETRIC = timetabler.enrolments.get_symmetric_students(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING,
+                                                                 SUBJECTMAPPING, REPEATS, FIXED)
+        enrolmentindex = {(i, classes[q]): p for p, (i, q) in enumerate(enrolments)}
+        # Enrolments' variables are contiguous, from pstart[p] to pstart[p + 1]
+        pstart = numpy.searchsorted(pt_p, numpy.arange(P + 1))
+        rows, cols, vals = [], [], []
+        count = 0
+        for (a, b, j, m) in SYMMETRIC:
+            pa, pb = enrolmentindex[(a, (j, m))], enrolmentindex[(b, (j, m))]
+            n = int(pstart[pa + 1] - pstart[pa])
+            # Row r sums the variables at the first r + 1 of the times
+            r, c = numpy.nonzero(numpy.tril(numpy.ones((max(n - 1, 0), n), dtype=bool)))
+            rows += [count + r, count + r]
+            cols += [pt_assign[pstart[pb] + c], pt_assign[pstart[pa] + c]]
+            vals += [1, -1]
+            count += max(n - 1, 0)
+        if count:
+            model.add_constraints(count, rows, cols, vals, 'L')
+
+    # Without pruning there would be a variable, a constraint linking it to the class and two class size
+    # constraints for each pruned (enrolment, time) and (class, time) pair, and an availability constraint and a one
+    # class at a time constraint for each time a tutor is not available. The tight formulation and symmetry breaking
+    # add rows for each of a class's times too, so the sizes are left out with those.
+    if tight or symmetry_breaking:
+        unpruned = None
+    elif prune:
+        unpruned = (model.numcols + (P * T - npt) + (Q * T - nqt),
+                    model.numrows + (P * T - npt) + 2 * (Q * T - nqt) + 2 * int(unavailable.sum()))
+    else:
+        unpruned = (model.numcols, model.numrows)
+
+    layout = {'classes': classes, 'enrolments': enrolments, 'assign': assign, 'subject': subject,
+              'classtimes': list(zip(qt_q.tolist(), qt_t.tolist())),
+              'enrolmenttimes': list(zip(pt_p.tolist(), pt_t.tolist())), 'unpruned': unpruned,
+              'symmetry': count if symmetry_breaking else 0}
+    return model, layout
+
+
+def solve_timetable_matrix(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                           TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector,
+                           NONPREFERREDTIMES, report, solver_options=None, warm_start=None, FIXED=None,
+                           symmetry_breaking=False, tight_formulation=None):
+    '''
+    Build and solve the first stage timetabling model with the sparse matrix backend.
+
+    :param report: Dictionary filled with build and solve times, the variable and constraint counts and the
+                   statistics CBC logged for the solve. The clash constraints are all added up front, so if
+                   appcfg["lazy_clash_constraints"] is set, lazy_clash_constraints_ignored is set to True.
+    :param solver_options: Dictionary of solver settings, as for solver.solve_pulp_model.
+    :param warm_start: Optional starting solution, as for helpers.solve_timetable_pulp.
+    :param FIXED: Optional classes that are fixed, as for helpers.solve_timetable_pulp.
+    :param symmetry_breaking: Whether to break symmetry between students, as for helpers.solve_timetable_pulp.
+    :param tight_formulation: Whether to use the tight formulation, as for helpers.solve_timetable_pulp.
+    :return: A tuple of the model status, the values of the subject variables indexed by (subject, time, tutor)
+             and the values of the assignment variables indexed by (student, subject, time, tutor).
+    '''
+    if appcfg.get("lazy_clash_constraints", False):
+        print("The matrix backend does not add clash constraints lazily, adding them for every student")
+        app.logger.warning('lazy_clash_constraints is not supported by the matrix backend, so it was ignored')
+        report['lazy_clash_constraints_ignored'] = True
+    started = time.perf_counter()
+    model, layout = build_timetable_matrix(STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS,
+                                           TEACHERMAPPING, TUTORAVAILABILITY, maxclasssize, minclasssize, ROOMS,
+                                           PROJECTORS, numroomsprojector, NONPREFERREDTIMES, FIXED,
+                                           symmetry_breaking=symmetry_breaking,
+                                           tight_formulation=tight_formulation)
+    report['build'] = time.perf_counter() - started
+    report['variables'] = model.numcols
+    report['constraints'] = model.numrows
+    if layout['unpruned'] is not None:
+        report['variables_before_pruning'], report['constraints_before_pruning'] = layout['unpruned']
+    if symmetry_breaking:
+        report['symmetry_constraints'] = layout['symmetry']
+    classes = layout['classes']
+    start = None
+    if warm_start is not None:
+        subject_start, assign_start = warm_start
+        start = {}
+        for c, (q, t) in enumerate(layout['classtimes']):
+            j, m = classes[q]
+            start[layout['subject'] + c] = subject_start.get((j, TIMES[t], m), 0)
+        for c, (p, t) in enumerate(layout['enrolmenttimes']):
+            i, q = layout['enrolments'][p]
+            j, m = classes[q]
+            start[layout['assign'] + c] = assign_start.get((i, j, TIMES[t], m), 0)
+    print("Solving Model")
+    started = time.perf_counter()
+    status, values, stats = model.solve(solver_options, start)
+    report['solve'] = time.perf_counter() - started
+    report.update(stats)
+
+    # Pruned variables are given as 0, as for helpers.solve_timetable_pulp.
+    subject_values = {(j, k, m): 0 for (j, m) in classes for k in TIMES}
+    for c, (q, t) in enumerate(layout['classtimes']):
+        j, m = classes[q]
+        subject_values[(j, TIMES[t], m)] = float(values[layout['subject'] + c])
+    assign_values = {(i, j, k, m): 0 for (i, q) in layout['enrolments'] for (j, m) in [classes[q]] for k in TIMES}
+    for c, (p, t) in enumerate(layout['enrolmenttimes']):
+        i, q = layout['enrolments'][p]
+        j, m = classes[q]
+        assign_values[(i, j, TIMES[t], m)] = float(values[layout['assign'] + c])
+    return status, subject_values, assign_values
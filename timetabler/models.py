@@ -1,8 +1,13 @@
-from flask import render_template
+from flask import g, has_app_context, render_template
 from timetabler import bcrypt, db
 from timetabler.helpers import *
-from pandas import isnull
+from pandas import DataFrame, isnull
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.sql.expression import UpdateBase
+from collections import defaultdict
 from datetime import time
+from time import perf_counter
 import datetime
 from timetabler.config import appcfg
 
@@ -18,10 +23,11 @@ class CRUDMixin(db.Model):
         return cls.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(), **kwargs).first()
 
     @classmethod
-    def get_or_create(cls, **kwargs):
+    def get_or_create(cls, commit=True, **kwargs):
         '''
         Get, or create and return an object of the specified type with the specified keyword arguments.
 
+        :param commit: Commit a new object to the database? If not, it is only flushed, so that it has an id.
         :param kwargs: Arguments for the object.
         :return:
         '''
@@ -29,7 +35,10 @@ class CRUDMixin(db.Model):
         if obj is None:
             obj = cls(**kwargs)
             db.session.add(obj)
-            db.session.commit()
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
             return obj
         else:
             return obj
@@ -149,6 +158,10 @@ class User(Base):
 ####MODELS
 
 
+# How often get_admin_settings found the settings already read for the request (hits) or had to query them (misses)
+admin_settings_stats = {'hits': 0, 'misses': 0}
+
+
 class Admin(db.Model):
     '''
     This is the Admin table where we keep key value pairs for certain things like year, studyperiod, timetable etc.
@@ -185,18 +198,18 @@ Association tables for the many-to-many relationships. These are the secondaries
 '''
 substumap = db.Table('substumap',
                      db.Column('id', db.Integer, primary_key=True),
-                     db.Column('student_id', db.Integer, db.ForeignKey('students.id')),
-                     db.Column('subject_id', db.Integer, db.ForeignKey('subjects.id')))
+                     db.Column('student_id', db.Integer, db.ForeignKey('students.id'), index=True),
+                     db.Column('subject_id', db.Integer, db.ForeignKey('subjects.id'), index=True))
 
 subtutmap = db.Table('subtutmap',
                      db.Column('id', db.Integer, primary_key=True),
-                     db.Column('tutor_id', db.Integer, db.ForeignKey('tutors.id')),
-                     db.Column('subject_id', db.Integer, db.ForeignKey('subjects.id')))
+                     db.Column('tutor_id', db.Integer, db.ForeignKey('tutors.id'), index=True),
+                     db.Column('subject_id', db.Integer, db.ForeignKey('subjects.id'), index=True))
 
 stutimetable = db.Table('stutimetable',
                         db.Column('id', db.Integer, primary_key=True),
-                        db.Column('timetabledclass_id', db.Integer, db.ForeignKey('timetabledclass.id')),
-                        db.Column('student_id', db.Integer, db.ForeignKey('students.id')))
+                        db.Column('timetabledclass_id', db.Integer, db.ForeignKey('timetabledclass.id'), index=True),
+                        db.Column('student_id', db.Integer, db.ForeignKey('students.id'), index=True))
 
 timeslotclassesmap = db.Table('timeslotclassesmap',
                               db.Column('id', db.Integer, primary_key=True),
@@ -205,8 +218,8 @@ timeslotclassesmap = db.Table('timeslotclassesmap',
 
 tutoravailabilitymap = db.Table('tutoravailabilitymap',
                                 db.Column('id', db.Integer, primary_key=True),
-                                db.Column('tutor_id', db.Integer, db.ForeignKey('tutors.id')),
-                                db.Column('timeslot_id', db.Integer, db.ForeignKey('timeslots.id')))
+                                db.Column('tutor_id', db.Integer, db.ForeignKey('tutors.id'), index=True),
+                                db.Column('timeslot_id', db.Integer, db.ForeignKey('timeslots.id'), index=True))
 
 
 class University(db.Model):
@@ -232,6 +245,7 @@ class Subject(Base):
     This is the subject class that contains each subject for each year/studyperiod
     '''
     __tablename__ = 'subjects'
+    __table_args__ = (db.Index('ix_subjects_year_studyperiod_subcode', 'year', 'studyperiod', 'subcode'),)
     subcode = db.Column(db.String(50), nullable=False)
     subname = db.Column(db.String(50), nullable=False)
     repeats = db.Column(db.Integer, default=1)
@@ -244,9 +258,10 @@ class Subject(Base):
         self.subname = subname
         self.repeats = repeats
 
-    def addTutor(self, tutor):
+    def addTutor(self, tutor, commit=True):
         self.tutor = tutor
-        db.session.commit()
+        if commit:
+            db.session.commit()
 
     def view_subject_template(self, form, msg=""):
         return render_template("subject.html", subject=self, students=self.students,
@@ -274,6 +289,8 @@ class Subject(Base):
 
 class Student(Base):
     __tablename__ = 'students'
+    __table_args__ = (db.Index('ix_students_year_studyperiod_name', 'year', 'studyperiod', 'name'),
+                      db.Index('ix_students_year_studyperiod_studentcode', 'year', 'studyperiod', 'studentcode'))
     studentcode = db.Column(db.String(50), nullable=False)
     name = db.Column(db.String(100), nullable=True)
     subjects = db.relationship("Subject", secondary=substumap, backref=db.backref('students'))
@@ -317,6 +334,7 @@ class Timetable(Base):
 
 class Tutor(Base):
     __tablename__ = 'tutors'
+    __table_args__ = (db.Index('ix_tutors_year_studyperiod_name', 'year', 'studyperiod', 'name'),)
     name = db.Column(db.String(50), nullable=False)
     subjects = db.relationship("Subject", secondary=subtutmap,
                                backref=db.backref('tutor', uselist=False, lazy='joined'))
@@ -378,6 +396,8 @@ class TimetabledClass(Base):
 
     '''
     __tablename__ = 'timetabledclass'
+    __table_args__ = (db.Index('ix_timetabledclass_year_studyperiod_timetable', 'year', 'studyperiod', 'timetable'),
+                      db.Index('ix_timetabledclass_subjectid', 'subjectid'))
     subjectid = db.Column(db.Integer, db.ForeignKey('subjects.id'))
     subject = db.relationship("Subject", backref=db.backref('timetabledclasses'), single_parent=True)
     timetable = db.Column(db.Integer, db.ForeignKey('timetable.id'))
@@ -396,6 +416,67 @@ class TimetabledClass(Base):
             self.roomid = roomid
 
 
+class Job(Base):
+    '''
+    This class represents a background run of the timetabling program.
+
+    The job is saved as it moves through queued -> running -> optimal/feasible/infeasible/failed (or cancelled) so
+    that the Run Timetabler page can poll for its progress, and so that the result is still there after a restart.
+    A feasible job stopped at the time limit or gap tolerance with a solution, which was still added to the timetable.
+    The solver settings for the run are kept in options as JSON. A solved job keeps the timetable data it solved in
+    snapshot (see helpers.snapshot_timetable_data), so that a later repair job can tell what has changed since.
+    '''
+    __tablename__ = 'jobs'
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False)
+    timetable = db.Column(db.Integer, db.ForeignKey('timetable.id'))
+    username = db.Column(db.String(50), nullable=True)
+    created = db.Column(db.DateTime, nullable=False)
+    started = db.Column(db.DateTime, nullable=True)
+    finished = db.Column(db.DateTime, nullable=True)
+    objective = db.Column(db.Float, nullable=True)
+    bound = db.Column(db.Float, nullable=True)
+    gap = db.Column(db.Float, nullable=True)
+    message = db.Column(db.String(200), nullable=True)
+    logfile = db.Column(db.String(200), nullable=True)
+    options = db.Column(db.Text, nullable=True)
+    report = db.Column(db.Text, nullable=True)
+    snapshot = db.Column(db.Text, nullable=True)
+
+    def __init__(self, kind, timetable=None, username=None, options=None):
+        super().__init__()
+        self.kind = kind
+        self.timetable = timetable
+        self.username = username
+        self.options = options
+        self.status = 'queued'
+        self.created = datetime.datetime.now()
+
+    def elapsed(self):
+        '''
+        Get how long the job has been running, or ran for if it is finished.
+
+        :return: Number of seconds, or None if the job has not started.
+        '''
+        if self.started is None:
+            return None
+        finished = self.finished or datetime.datetime.now()
+        return (finished - self.started).total_seconds()
+
+    def as_dict(self):
+        '''
+        Get the job as a dictionary that can be sent to the browser as JSON.
+
+        :return: Dictionary of the job's status and progress.
+        '''
+        return {'id': self.id, 'kind': self.kind, 'status': self.status, 'username': self.username,
+                'created': convert_datetime_to_string(self.created),
+                'started': self.started and convert_datetime_to_string(self.started),
+                'finished': self.finished and convert_datetime_to_string(self.finished),
+                'elapsed': self.elapsed(), 'objective': self.objective, 'bound': self.bound, 'gap': self.gap,
+                'message': self.message}
+
+
 class Room(db.Model):
     __tablename__ = 'rooms'
     id = db.Column(db.Integer, primary_key=True)
@@ -430,6 +511,7 @@ class Room(db.Model):
 
 class Timeslot(Base):
     __tablename__ = 'timeslots'
+    __table_args__ = (db.Index('ix_timeslots_year_studyperiod_day_time', 'year', 'studyperiod', 'day', 'time'),)
     timetable = db.Column(db.Integer, db.ForeignKey('timetable.id'))
     day = db.Column(db.String(50), nullable=False)
     daynumeric = db.Column(db.String(50), nullable=False)
@@ -483,13 +565,20 @@ def linksubjecttutor(tutorid, subcode):
 
 
 def create_user_with_tutor(username, password, tutor):
+    '''
+    Create a user for a new tutor, if there is not one with the username already. The user is added to the session
+    but not committed, so that it is saved with the tutor, in the same transaction.
+
+    :param username: The username.
+    :param password: The password.
+    :param tutor: The tutor.
+    :return: Nil.
+    '''
     if User.query.filter_by(username=username, year=get_current_year(),
                             studyperiod=get_current_studyperiod()).first() is None:
         user = User(username=username, password=username)
-        db.session.add(user)
-        db.session.commit()
         user.tutor = tutor
-        db.session.commit()
+        db.session.add(user)
 
 
 def getadmin():
@@ -504,13 +593,22 @@ def getadmin():
     return admin
 
 
-def populate_students(df):
+def populate_students(df, commit=True):
     '''
     Populate student and subject database from a dataframe.
+
+    The rows for the current study period are picked out with pandas and de-duplicated, and the students, subjects
+    and enrolments that are not already in the database are inserted in bulk in one transaction.
+
     :param df: Pandas dataframe containing the student and subject data.
-    :return: Nil.
+    :param commit: Commit the rows inserted? If not, they are only flushed, and the caller commits or rolls back.
+    :return: A dictionary of the number of students, subjects and enrolments inserted, and the number of rows
+             skipped because they were for another study period (other_period), were missing a student id or
+             subject code (invalid), were for an enrolment already in the database (existing) or repeated an
+             enrolment earlier in the file (duplicate). The enrolments and the rows skipped add up to the rows in df.
     '''
     print("Populating Students")
+    year = get_current_year()
     studyperiod = get_current_studyperiod()
     col_student_id = appcfg["enrolment_schema"]["student_id"]
     col_student_first_name = appcfg["enrolment_schema"]["student_first_name"]
@@ -518,64 +616,199 @@ def populate_students(df):
     col_subject_code = appcfg["enrolment_schema"]["subject_code"]
     col_subject_name = appcfg["enrolment_schema"]["subject_name"]
     col_study_period = appcfg["enrolment_schema"]["study_period"]
-    for index, row in df.iterrows():
-        if studyperiod == row[col_study_period]:
-            student_name = (str(row[col_student_first_name]) + " " + str(row[col_student_last_name])).strip().title()
-            print("Adding: ", student_name, row[col_subject_code], row[col_subject_name])
-            student = Student.get_or_create(studentcode=str(int(row[col_student_id])),
-                                            name=student_name,
-                                            universityid=University.query.filter_by(
-                                                name='University of Melbourne').first().id,
-                                            collegeid=str(College.query.filter_by(name="International House").first().id))
-            subject = Subject.get_or_create(subcode=row[col_subject_code],
-                                            subname=row[col_subject_name])
-            student.addSubject(subject)
-
-
-def populate_timetabledata(df):
-    '''
-    Populate timetable and classlists from dataframe
+    rows = df[df[col_study_period] == studyperiod]
+    other_period = len(df) - len(rows)
+    rows = rows.dropna(subset=[col_student_id, col_subject_code])
+    invalid = len(df) - other_period - len(rows)
+    enrolments = DataFrame({
+        'studentcode': rows[col_student_id].astype(float).astype(int).astype(str),
+        'name': (rows[col_student_first_name].astype(str) + " " +
+                 rows[col_student_last_name].astype(str)).str.strip().str.title(),
+        'subcode': rows[col_subject_code].astype(str),
+        'subname': rows[col_subject_name].astype(str)})
+
+    universityid = University.query.filter_by(name='University of Melbourne').first().id
+    collegeid = College.query.filter_by(name="International House").first().id
+    students = dict(db.session.query(Student.studentcode, Student.id).filter_by(year=year, studyperiod=studyperiod))
+    subjects = dict(db.session.query(Subject.subcode, Subject.id).filter_by(year=year, studyperiod=studyperiod))
+    existing = set(db.session.query(substumap.c.student_id, substumap.c.subject_id).join(
+        Student, Student.id == substumap.c.student_id).filter(Student.year == year, Student.studyperiod == studyperiod))
+    try:
+        newstudents = enrolments.drop_duplicates('studentcode')
+        newstudents = [{'year': year, 'studyperiod': studyperiod, 'studentcode': row.studentcode, 'name': row.name,
+                        'email': "", 'universityid': universityid, 'collegeid': collegeid}
+                       for row in newstudents[~newstudents['studentcode'].isin(students)].itertuples()]
+        # return_defaults fills in the new ids, which the enrolments need
+        db.session.bulk_insert_mappings(Student, newstudents, return_defaults=True)
+        students.update((student['studentcode'], student['id']) for student in newstudents)
+
+        newsubjects = enrolments.drop_duplicates('subcode')
+        newsubjects = [{'year': year, 'studyperiod': studyperiod, 'subcode': row.subcode, 'subname': row.subname,
+                        'repeats': 1} for row in newsubjects[~newsubjects['subcode'].isin(subjects)].itertuples()]
+        db.session.bulk_insert_mappings(Subject, newsubjects, return_defaults=True)
+        subjects.update((subject['subcode'], subject['id']) for subject in newsubjects)
+
+        pairs = list(zip(enrolments['studentcode'].map(students), enrolments['subcode'].map(subjects)))
+        links = set(pairs) - existing
+        if links:
+            db.session.execute(substumap.insert(), [{'student_id': student_id, 'subject_id': subject_id}
+                                                    for (student_id, subject_id) in links])
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+    except Exception:
+        db.session.rollback()
+        raise
+    repeated = sum(1 for pair in pairs if pair in existing)
+    counts = {'students': len(newstudents), 'subjects': len(newsubjects), 'enrolments': len(links),
+              'other_period': other_period, 'invalid': invalid, 'existing': repeated,
+              'duplicate': len(pairs) - repeated - len(links)}
+    print("Added", counts['students'], "students,", counts['subjects'], "subjects and", counts['enrolments'],
+          "enrolments, skipped", counts['other_period'], "rows for other study periods,", counts['invalid'],
+          "rows missing a student id or subject code,", counts['existing'], "existing enrolments and",
+          counts['duplicate'], "duplicate rows")
+    app.logger.info('Populate students: %s', counts)
+    return counts
+
+
+def populate_timetabledata(df, commit=True):
+    '''
+    Populate timetable and classlists from dataframe.
+
+    Each row is a class, with the subject code in x1, the tutor in x3, the time (e.g. "Monday 7:30pm") in x4 and
+    the names of its students from the sixth column on. The students, subjects, tutors, timeslots and classes are
+    looked up with one query each, and the new classes and class list entries are inserted in bulk in one
+    transaction.
+
     :param df: Pandas dataframe containing timetable and classlist data.
-    :return: Nil.
+    :param commit: Commit the rows inserted? If not, they are only flushed, and the caller commits or rolls back.
+    :return: A dictionary of the number of classes and class list entries added, and lists of the student names and
+             subject codes that did not match any in the database. Rows for unknown subjects are skipped.
     '''
-    timetable = Timetable.get_or_create(key="default")
+    Timetable.get_or_create(commit=commit, key="default")
     print("Timetable Created")
-    for index, row in df.iterrows():
-        tutor = Tutor.get_or_create(name=row['x3'])
-        subject = Subject.get_or_create(subcode=row['x1'])
-        time2 = row['x4'].split(' ')
-        day = time2[0]
-        time2 = time2[1]
-        time2 = check_time(time2)
-        timeslot = Timeslot.get_or_create(day=day, time=time2)
-        timetable = get_current_timetable()
-        timetabledclass = TimetabledClass.get_or_create(time=timeslot.id, subjectid=subject.id, timetable=timetable.id)
-        for i in range(5, len(row)):
-            if not isnull(row[i]):
-                student = Student.get(name=row[i]).first()
-                if timetabledclass not in student.timetabledclasses:
-                    student.timetabledclasses.append(timetabledclass)
-                    db.session.commit()
-
-
-def populate_availabilities(df):
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    timetable = get_current_timetable_id()
+    students = dict(db.session.query(Student.name, Student.id).filter_by(year=year, studyperiod=studyperiod))
+    subjects = dict(db.session.query(Subject.subcode, Subject.id).filter_by(year=year, studyperiod=studyperiod))
+    tutors = dict(db.session.query(Tutor.name, Tutor.id).filter_by(year=year, studyperiod=studyperiod))
+    timeslots = {}
+    for (day, slot, id) in db.session.query(Timeslot.day, Timeslot.time, Timeslot.id).filter_by(
+            year=year, studyperiod=studyperiod).order_by(Timeslot.id):
+        timeslots.setdefault((day, slot), id)
+    classes = {(time2, subjectid): id for (time2, subjectid, id) in db.session.query(
+        TimetabledClass.time, TimetabledClass.subjectid, TimetabledClass.id).filter_by(
+        year=year, studyperiod=studyperiod, timetable=timetable)}
+    unmatched = set()
+    unknownsubjects = set()
+    col_subject, col_tutor, col_time = [df.columns.get_loc(column) for column in ['x1', 'x3', 'x4']]
+    try:
+        newclasses = {}
+        classlists = {}
+        for row in df.itertuples(index=False):
+            subcode = row[col_subject]
+            if subcode not in subjects:
+                unknownsubjects.add(subcode)
+                continue
+            tutorname = row[col_tutor]
+            if tutorname not in tutors:
+                tutors[tutorname] = Tutor.get_or_create(commit=False, name=tutorname).id
+            day, time2 = row[col_time].split(' ')[:2]
+            time2 = check_time(time2)
+            if (day, time2) not in timeslots:
+                timeslots[(day, time2)] = Timeslot.get_or_create(commit=False, day=day, time=time2).id
+            key = (timeslots[(day, time2)], subjects[subcode])
+            if key not in classes and key not in newclasses:
+                newclasses[key] = {'year': year, 'studyperiod': studyperiod, 'timetable': timetable,
+                                   'time': key[0], 'subjectid': key[1], 'tutorid': tutors[tutorname]}
+            for name in row[5:]:
+                if isnull(name):
+                    continue
+                if name in students:
+                    classlists.setdefault(key, set()).add(students[name])
+                else:
+                    unmatched.add(name)
+        # return_defaults fills in the ids of the new classes, which the class lists need
+        db.session.bulk_insert_mappings(TimetabledClass, list(newclasses.values()), return_defaults=True)
+        classes.update((key, newclass['id']) for key, newclass in newclasses.items())
+
+        existing = set(db.session.query(stutimetable.c.timetabledclass_id, stutimetable.c.student_id).join(
+            TimetabledClass, TimetabledClass.id == stutimetable.c.timetabledclass_id).filter(
+            TimetabledClass.timetable == timetable))
+        rows = set((classes[key], studentid) for key in classlists for studentid in classlists[key]) - existing
+        if rows:
+            db.session.execute(stutimetable.insert(), [{'timetabledclass_id': classid, 'student_id': studentid}
+                                                       for (classid, studentid) in rows])
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+    except Exception:
+        db.session.rollback()
+        raise
+    if unmatched or unknownsubjects:
+        app.logger.warning('Class list students not found: %s; subjects not found: %s', sorted(unmatched),
+                           sorted(unknownsubjects))
+    return {'classes': len(newclasses), 'students': len(rows), 'unmatched': sorted(unmatched),
+            'unknownsubjects': sorted(unknownsubjects)}
+
+
+def populate_availabilities(df, commit=True):
     '''
     Populate tutor availabilities from dataframe.
+
+    Each tutor in the dataframe gets exactly the times marked 1 as their availability. The tutors and timeslots are
+    looked up with one query each, and only the availabilities that changed are deleted or inserted, in one
+    transaction.
+
     :param df: Pandas dataframe containing tutor availabilities (1/0) against the current timeslots.
-    :return: Nil.
+    :param commit: Commit the changes? If not, they are only flushed, and the caller commits or rolls back.
+    :return: A dictionary of the number of availabilities added and removed.
     '''
-    for index, row in df.iterrows():
-        tutor = Tutor.get_or_create(name=row["Tutor"])
-        tutor.availabletimes = []
-        db.session.commit()
-        for key in row.keys():
-            keysplit = key.split(' ')
-            if keysplit[0] in ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']:
-                timeslot = Timeslot.get_or_create(day=keysplit[0],
-                                                  time=keysplit[1])
-                if row[key] == 1:
-                    print("Assigning timeslot: ", key, row["Tutor"])
-                    tutor.addAvailableTime(timeslot)
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    days = ['Monday', 'Tuesday', 'Wednesday', 'Thursday', 'Friday', 'Saturday', 'Sunday']
+    columns = [key for key in df.columns if str(key).split(' ')[0] in days]
+    available = df.melt(id_vars=['Tutor'], value_vars=columns, var_name='timeslot', value_name='available')
+    try:
+        tutors = dict(db.session.query(Tutor.name, Tutor.id).filter_by(year=year, studyperiod=studyperiod))
+        for name in set(df['Tutor']) - set(tutors):
+            tutors[name] = Tutor.get_or_create(commit=False, name=name).id
+        timeslots = {}
+        for (day, slot, id) in db.session.query(Timeslot.day, Timeslot.time, Timeslot.id).filter_by(
+                year=year, studyperiod=studyperiod).order_by(Timeslot.id):
+            timeslots.setdefault(day + " " + slot, id)
+        for key in columns:
+            if key not in timeslots:
+                keysplit = key.split(' ')
+                timeslots[key] = Timeslot.get_or_create(commit=False, day=keysplit[0], time=keysplit[1]).id
+
+        wanted = set(zip(available.loc[available['available'] == 1, 'Tutor'].map(tutors),
+                         available.loc[available['available'] == 1, 'timeslot'].map(timeslots)))
+        tutorids = set(df['Tutor'].map(tutors))
+        existing = set(db.session.query(tutoravailabilitymap.c.tutor_id, tutoravailabilitymap.c.timeslot_id).filter(
+            tutoravailabilitymap.c.tutor_id.in_(tutorids)))
+        removed = existing - wanted
+        added = wanted - existing
+        if removed:
+            db.session.execute(tutoravailabilitymap.delete().where(db.and_(
+                tutoravailabilitymap.c.tutor_id == db.bindparam('tutor'),
+                tutoravailabilitymap.c.timeslot_id == db.bindparam('timeslot'))),
+                [{'tutor': tutor_id, 'timeslot': timeslot_id} for (tutor_id, timeslot_id) in removed])
+        if added:
+            db.session.execute(tutoravailabilitymap.insert(), [{'tutor_id': tutor_id, 'timeslot_id': timeslot_id}
+                                                               for (tutor_id, timeslot_id) in added])
+        if commit:
+            db.session.commit()
+        else:
+            db.session.flush()
+    except Exception:
+        db.session.rollback()
+        raise
+    print("Availabilities added:", len(added), "removed:", len(removed))
+    return {'added': len(added), 'removed': len(removed)}
 
 
 def get_tutor_template(tutor, form, msg="", msg2="", msg3=""):
@@ -585,14 +818,23 @@ def get_tutor_template(tutor, form, msg="", msg2="", msg3=""):
                            msg=msg, msg2=msg2, msg3=msg3, form=form)
 
 
-def populate_tutors(df):
+def populate_tutors(df, commit=True):
+    '''
+    Populate tutors, and the subjects they teach and the number of classes of each, from a dataframe.
+
+    :param df: Pandas dataframe with the columns Tutor, Subject Code and Repeats.
+    :param commit: Commit each change? If not, they are only flushed, and the caller commits or rolls back.
+    :return: Nil.
+    '''
     for index, row in df.iterrows():
-        tutor = Tutor.get_or_create(name=row['Tutor'])
+        tutor = Tutor.get_or_create(commit=commit, name=row['Tutor'])
         subject = Subject.get(subcode=row["Subject Code"])
-        subject.update(repeats=row["Repeats"])
+        subject.update(commit=commit, repeats=row["Repeats"])
         if subject not in tutor.subjects:
             print("Assigning tutor: ", row['Tutor'], row["Subject Code"], row["Repeats"])
-            subject.addTutor(tutor)
+            subject.addTutor(tutor, commit=commit)
+    if not commit:
+        db.session.flush()
 
 
 def update_year(year):
@@ -616,13 +858,47 @@ def update_studyperiod(studyperiod):
     admin.value = studyperiod
     db.session.commit()
 
+def get_admin_settings():
+    '''
+    Get the key value pairs in the admin table.
+
+    CRUDMixin.get and get_all look up the year and studyperiod every time, so the settings are read with one query
+    and kept on flask.g for the rest of the request (or background job). They are cleared whenever an Admin row is
+    saved, so a request that changes a setting sees the new value. Outside an app context they are not kept.
+
+    :return: Dictionary of the settings by key.
+    '''
+    if has_app_context() and 'admin_settings' in g:
+        admin_settings_stats['hits'] += 1
+        return g.admin_settings
+    admin_settings_stats['misses'] += 1
+    settings = dict(db.session.query(Admin.key, Admin.value))
+    if has_app_context():
+        g.admin_settings = settings
+    return settings
+
+
+def clear_admin_settings(*args):
+    '''
+    Forget the admin settings kept for this request, so that they are read again.
+
+    :param args: Ignored, so that this can listen to SQLAlchemy events.
+    :return: Nil.
+    '''
+    if has_app_context():
+        g.pop('admin_settings', None)
+
+
+for identifier in ['after_insert', 'after_update', 'after_delete']:
+    event.listen(Admin, identifier, clear_admin_settings)
+
+
 def get_current_year():
     '''
     Get the current year from the admin table.
     :return: The current year as an integer.
     '''
-    admin = Admin.query.filter_by(key='currentyear').first()
-    return int(admin.value)
+    return int(get_admin_settings()['currentyear'])
 
 
 def get_current_timetable():
@@ -630,17 +906,15 @@ def get_current_timetable():
     Get the current timetable from the database.
     :return: The current timetable as an object.
     '''
-    admin = Admin.query.filter_by(key='timetable').first()
-    return Timetable.get(id=int(admin.value))
+    return Timetable.get(id=get_current_timetable_id())
 
 
 def get_current_timetable_id():
     '''
-    Get the current timetable id from the database.
+    Get the current timetable id from the admin table.
     :return: The current timetable id as an integer.
     '''
-    admin = Admin.query.filter_by(key='timetable').first()
-    return Timetable.get(id=int(admin.value)).id
+    return int(get_admin_settings()['timetable'])
 
 
 def get_current_studyperiod():
@@ -648,8 +922,7 @@ def get_current_studyperiod():
     Get the current studyperiod from the database
     :return: The current studyperiod as a String.
     '''
-    admin = Admin.query.filter_by(key='studyperiod').first()
-    return admin.value
+    return get_admin_settings()['studyperiod']
 
 
 def linksubjectstudent(studentcode, subcode):
@@ -667,10 +940,10 @@ def check_time(time2):
 
     '''
     if time2.find('pm') != -1:
-        time2 = time.strftime("%H:%M", time.strptime(time2, "%I:%M%p"))
+        time2 = datetime.datetime.strptime(time2, "%I:%M%p").strftime("%H:%M")
     elif len(time2) < 5:
         time2 = time2 + "pm"
-        time2 = time.strftime("%H:%M", time.strptime(time2, "%I:%M%p"))
+        time2 = datetime.datetime.strptime(time2, "%I:%M%p").strftime("%H:%M")
     return time2
 
 
@@ -808,27 +1081,265 @@ def add_classes_to_timetable(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES, su
 
 
 def add_classes_to_timetable_twostep(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, TIMES, subject_vars_with_rooms,
-                                     assign_vars, ROOMS, classpop):
+                                     assign_vars, ROOMS, classpop, report=None):
+    '''
+    Add the solved timetable to the database.
+
+    The subjects, tutors, students, timeslots and rooms are each looked up with one query, and the classes and their
+    students are then inserted in bulk and committed together.
+
+    :param subject_vars_with_rooms: Values of the room allocation variables indexed by (subject, time, tutor, room)
+    :param assign_vars: Values of the student assignment variables indexed by (student, subject, time, tutor)
+    :param classpop: The population of each class that is running, indexed by (subject, time, tutor)
+    :param report: An optional dictionary which is filled with the time in seconds taken to look up the ids
+                   (writeback_lookups), insert the classes (writeback_classes) and insert their students
+                   (writeback_students).
+    :return: Nil.
+    '''
     print("Adding classes to timetable.")
-    for m in TEACHERS:
-        for j in TEACHERMAPPING[m]:
-            subject = Subject.get(subcode=j)
-            for k in TIMES:
-                for n in ROOMS:
-                    if (j,k,m) in classpop.keys():
-                        timesplit = k.split(' ')
-                        timeslot = Timeslot.get(timetable=get_current_timetable().id, day=timesplit[0], time=timesplit[1])
-                        tutor = Tutor.get(name=m)
-                        room = Room.query.filter_by(name=n).first()
-                        if subject_vars_with_rooms[(j, k, m, n)].varValue == 1:
-                            timetabledclass = TimetabledClass.create(subjectid=subject.id,
-                                                                     timetable=get_current_timetable().id, time=timeslot.id,
-                                                                     tutorid=tutor.id, roomid=room.id)
-                            for i in SUBJECTMAPPING[j]:
-                                if assign_vars[(i, j, k, m)].varValue == 1:
-                                    student = Student.get(name=i)
-                                    timetabledclass.students.append(student)
-                                    db.session.commit()
+    if report is None:
+        report = {}
+    started = perf_counter()
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    timetable = get_current_timetable_id()
+    subjects = dict(db.session.query(Subject.subcode, Subject.id).filter_by(year=year, studyperiod=studyperiod))
+    tutors = dict(db.session.query(Tutor.name, Tutor.id).filter_by(year=year, studyperiod=studyperiod))
+    students = dict(db.session.query(Student.name, Student.id).filter_by(year=year, studyperiod=studyperiod))
+    rooms = dict(db.session.query(Room.name, Room.id))
+    timeslots = {day + " " + slot: id for (day, slot, id) in db.session.query(
+        Timeslot.day, Timeslot.time, Timeslot.id).filter_by(year=year, studyperiod=studyperiod, timetable=timetable)}
+    report['writeback_lookups'] = perf_counter() - started
+
+    started = perf_counter()
+    classes = {}
+    for (j, k, m, n), value in subject_vars_with_rooms.items():
+        if value == 1 and (j, k, m) in classpop:
+            classes[(j, k, m)] = {'year': year, 'studyperiod': studyperiod, 'subjectid': subjects[j],
+                                  'timetable': timetable, 'time': timeslots[k], 'tutorid': tutors[m],
+                                  'roomid': rooms[n]}
+    # return_defaults fills in the id of each class, which the student rows need
+    db.session.bulk_insert_mappings(TimetabledClass, list(classes.values()), return_defaults=True)
+    report['writeback_classes'] = perf_counter() - started
+
+    started = perf_counter()
+    rows = [{'timetabledclass_id': classes[(j, k, m)]['id'], 'student_id': students[i]}
+            for (j, k, m) in classes for i in SUBJECTMAPPING[j] if assign_vars[(i, j, k, m)] == 1]
+    if rows:
+        db.session.execute(stutimetable.insert(), rows)
+    db.session.commit()
+    report['writeback_students'] = perf_counter() - started
+
+
+def get_timetable_solution():
+    '''
+    Get the classes on the current timetable in the form of the solver's variables, e.g. to warm start a re-solve.
+
+    :return: A tuple of the subject values indexed by (subject, time, tutor) and the assignment values indexed by
+             (student, subject, time, tutor), each 1 for the classes and students on the timetable. Returns None if
+             the timetable is empty.
+    '''
+    timetabledclasses = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
+                                                       timetable=get_current_timetable().id).all()
+    if len(timetabledclasses) == 0:
+        return None
+    subject_values = {}
+    assign_values = {}
+    for timetabledclass in timetabledclasses:
+        slot = timetabledclass.timeslot.day + " " + timetabledclass.timeslot.time
+        key = (timetabledclass.subject.subcode, slot, timetabledclass.tutor.name)
+        subject_values[key] = 1
+        for student in timetabledclass.students:
+            assign_values[(student.name,) + key] = 1
+    return subject_values, assign_values
+
+
+def get_fixed_classes(subjects):
+    '''
+    Get the classes on the current timetable that are not for some subjects, e.g. to keep them fixed while the
+    subjects are re-timetabled.
+
+    :param subjects: The subject codes to leave out.
+    :return: A list of (subject, time, tutor, room, students) tuples, where room is the room name or None and
+             students is a list of student names.
+    '''
+    timetabledclasses = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
+                                                       timetable=get_current_timetable().id).all()
+    fixedclasses = []
+    for timetabledclass in timetabledclasses:
+        if timetabledclass.subject.subcode in subjects:
+            continue
+        slot = timetabledclass.timeslot.day + " " + timetabledclass.timeslot.time
+        room = Room.query.get(timetabledclass.roomid) if timetabledclass.roomid is not None else None
+        fixedclasses.append((timetabledclass.subject.subcode, slot, timetabledclass.tutor.name,
+                             room.name if room is not None else None,
+                             [student.name for student in timetabledclass.students]))
+    return fixedclasses
+
+
+def update_classes_for_subjects(subjects, subject_values, assign_values, classpop):
+    '''
+    Update the classes for some subjects on the current timetable to a new solution, leaving the other classes alone.
+
+    Classes that are in both the timetable and the solution are kept, with their room and students updated if they
+    changed. Only classes that moved time, or were added or removed, are deleted and created. The subjects, tutors,
+    students, timeslots and rooms are each looked up with one query, and the students of each class are grouped in
+    one pass over the assignment values.
+
+    :param subjects: The subject codes that were re-timetabled.
+    :param subject_values: Values of the room allocation variables indexed by (subject, time, tutor, room).
+    :param assign_values: Values of the student assignment variables indexed by (student, subject, time, tutor).
+    :param classpop: The population of each class that is running, indexed by (subject, time, tutor).
+    :return: A tuple of the number of classes kept, created and deleted.
+    '''
+    year = get_current_year()
+    studyperiod = get_current_studyperiod()
+    timetable = get_current_timetable().id
+    timeslots = {timeslot.day + " " + timeslot.time: timeslot for timeslot in Timeslot.query.filter_by(
+        year=year, studyperiod=studyperiod, timetable=timetable).all()}
+    rooms = {room.name: room for room in Room.query.all()}
+    subjectids = dict(db.session.query(Subject.subcode, Subject.id).filter_by(year=year, studyperiod=studyperiod))
+    tutorids = dict(db.session.query(Tutor.name, Tutor.id).filter_by(year=year, studyperiod=studyperiod))
+    students = {student.name: student for student in Student.query.filter_by(year=year, studyperiod=studyperiod)}
+    classstudents = defaultdict(set)
+    for (i, j, k, m), value in assign_values.items():
+        if value == 1:
+            classstudents[(j, k, m)].add(i)
+    new = {}
+    for (j, k, m, n), value in subject_values.items():
+        if value == 1 and (j, k, m) in classpop:
+            new[(subjectids[j], timeslots[k].id, tutorids[m])] = (rooms[n].id, classstudents[(j, k, m)])
+    resolved = set(subjectids[j] for j in subjects if j in subjectids)
+    kept = deleted = 0
+    timetabledclasses = TimetabledClass.query.filter_by(year=year, studyperiod=studyperiod, timetable=timetable).all()
+    for timetabledclass in timetabledclasses:
+        if timetabledclass.subjectid not in resolved:
+            continue
+        key = (timetabledclass.subjectid, timetabledclass.time, timetabledclass.tutorid)
+        if key in new:
+            roomid, names = new.pop(key)
+            if timetabledclass.roomid != roomid:
+                timetabledclass.roomid = roomid
+            if set(student.name for student in timetabledclass.students) != names:
+                timetabledclass.students = [students[i] for i in names]
+            kept += 1
+        else:
+            db.session.delete(timetabledclass)
+            deleted += 1
+    for (subjectid, timeslotid, tutorid), (roomid, names) in new.items():
+        timetabledclass = TimetabledClass(subjectid=subjectid, timetable=timetable, time=timeslotid, tutorid=tutorid,
+                                          roomid=roomid)
+        timetabledclass.students = [students[i] for i in names]
+        db.session.add(timetabledclass)
+    db.session.commit()
+    return kept, len(new), deleted
+
+
+def remove_timetabled_classes():
+    '''
+    Remove all classes from the current timetable.
+
+    :return: Nil.
+    '''
+    timetabledclasses = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
+                                                       timetable=get_current_timetable().id).all()
+    for timetabledclass in timetabledclasses:
+        db.session.delete(timetabledclass)
+    db.session.commit()
+
+
+clash_report_cache = {}
+
+# The tables the clash report reads, and the number of writes to them since the app started
+clash_report_tables = ['stutimetable', 'timetabledclass', 'students', 'subjects', 'timeslots']
+clash_report_version = {'version': 0}
+
+
+def get_timetable_version():
+    '''
+    Get the version of the class lists, classes and names the clash report reads, which goes up with every insert,
+    update or delete of them (see count_clash_report_write) and again when the transaction making it commits.
+
+    :return: The version, as an integer.
+    '''
+    return clash_report_version['version']
+
+
+def count_clash_report_write(conn, clauseelement, *args):
+    '''
+    Count an insert, update or delete of a table the clash report reads, whether made through the ORM or with a
+    bulk statement, so that the reports kept are read again.
+
+    :param conn: The connection the statement ran on.
+    :param clauseelement: The statement.
+    :param args: Ignored, so that this can listen to SQLAlchemy events.
+    :return: Nil.
+    '''
+    table = getattr(clauseelement, 'table', None)
+    if isinstance(clauseelement, UpdateBase) and getattr(table, 'name', None) in clash_report_tables:
+        clash_report_version['version'] += 1
+        conn.info['clash_report_write'] = True
+
+
+def count_clash_report_commit(conn):
+    '''
+    Count the commit of a transaction that wrote to a table the clash report reads, as a report read while it was
+    open did not see its writes.
+
+    :param conn: The connection committing.
+    :return: Nil.
+    '''
+    if conn.info.pop('clash_report_write', False):
+        clash_report_version['version'] += 1
+
+
+event.listen(Engine, 'after_execute', count_clash_report_write)
+event.listen(Engine, 'commit', count_clash_report_commit)
+event.listen(Engine, 'rollback', count_clash_report_commit)
+
+
+def get_clash_report(timetable=None):
+    '''
+    Get the students who are in more than one class at the same time.
+
+    The clashes are found with one query grouping the class lists by student and timeslot, and the names for the
+    report are joined onto those groups, rather than loading every timeslot, class and student. The report is kept
+    until the version of the tables it reads (see get_timetable_version) changes.
+
+    :param timetable: The timetable id. The current timetable is used if not given.
+    :return: A list of dictionaries with the student (id, studentcode and name), the timeslot (id, day and time) and
+             the names of the subjects the student has at that time, ordered by timeslot and student.
+    '''
+    if timetable is None:
+        timetable = get_current_timetable_id()
+    version = get_timetable_version()
+    cached = clash_report_cache.get(timetable)
+    if cached is not None and cached[0] == version:
+        return cached[1]
+    clashes = db.session.query(stutimetable.c.student_id, TimetabledClass.time) \
+        .join(TimetabledClass, TimetabledClass.id == stutimetable.c.timetabledclass_id) \
+        .filter(TimetabledClass.timetable == timetable) \
+        .group_by(stutimetable.c.student_id, TimetabledClass.time) \
+        .having(db.func.count(stutimetable.c.id) > 1).subquery()
+    rows = db.session.query(Student.id, Student.studentcode, Student.name, Timeslot.id, Timeslot.day, Timeslot.time,
+                            Subject.subname) \
+        .select_from(stutimetable) \
+        .join(TimetabledClass, TimetabledClass.id == stutimetable.c.timetabledclass_id) \
+        .join(clashes, db.and_(clashes.c.student_id == stutimetable.c.student_id,
+                               clashes.c.time == TimetabledClass.time)) \
+        .join(Student, Student.id == stutimetable.c.student_id) \
+        .join(Timeslot, Timeslot.id == TimetabledClass.time) \
+        .join(Subject, Subject.id == TimetabledClass.subjectid) \
+        .filter(TimetabledClass.timetable == timetable) \
+        .order_by(Timeslot.id, Student.id, TimetabledClass.id)
+    report = []
+    for studentid, studentcode, name, timeslotid, day, slottime, subname in rows:
+        if len(report) == 0 or (report[-1]['student']['id'], report[-1]['timeslot']['id']) != (studentid, timeslotid):
+            report.append({'student': {'id': studentid, 'studentcode': studentcode, 'name': name},
+                           'timeslot': {'id': timeslotid, 'day': day, 'time': slottime}, 'subjects': []})
+        report[-1]['subjects'].append(subname)
+    clash_report_cache[timetable] = (version, report)
+    return report
 
 
 def get_all_rolls():
@@ -938,6 +1449,37 @@ def init_db_rooms():
             db.session.commit()
 
 
+def init_db_jobs():
+    # The jobs table was added after the first release, so create it on existing databases.
+    Job.__table__.create(db.engine, checkfirst=True)
+    # The snapshot column was added later still.
+    if 'snapshot' not in [column['name'] for column in db.inspect(db.engine).get_columns('jobs')]:
+        db.engine.execute('ALTER TABLE jobs ADD COLUMN snapshot TEXT')
+
+
+def init_db_indexes():
+    '''
+    Create the indexes declared on the models that an existing database does not have yet.
+
+    The indexes on the year and studyperiod of each table and on the association tables' foreign keys were added
+    after the first release. db.create_all() only creates them with new tables, so this adds them to the old ones.
+
+    :return: A list of the names of the indexes created.
+    '''
+    inspector = db.inspect(db.engine)
+    tables = inspector.get_table_names()
+    created = []
+    for table in db.metadata.sorted_tables:
+        if table.name not in tables:
+            continue
+        existing = [index['name'] for index in inspector.get_indexes(table.name)]
+        for index in table.indexes:
+            if index.name not in existing:
+                index.create(db.engine)
+                created.append(index.name)
+    return created
+
+
 def init_db():
    print("Importing study period and year")
    init_db_studyperiod()
@@ -955,6 +1497,20 @@ def init_db():
    init_db_rooms()
 
 
+def upgrade_db():
+    '''
+    Bring a database made by an earlier release up to date with the models, by creating the tables, columns and
+    indexes added since. db.create_all() makes all of these on a new database, so this is only needed on old ones,
+    and is run with "python manage.py upgrade" rather than each time the app starts.
+
+    :return: A list of the names of the indexes created.
+    '''
+    print("Creating Jobs")
+    init_db_jobs()
+    print("Creating Indexes")
+    return init_db_indexes()
+
+
 def change_preferred_timeslot(id, preferred):
     timeslot = Timeslot.query.get(id)
     if preferred == 1:
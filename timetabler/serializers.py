@@ -0,0 +1,304 @@
+'''
+Serializers for the rows the AJAX views send to the DataTables tables.
+
+Each serializer declares the columns a table needs, so that the rows are read with one query of those columns
+rather than by loading whole objects (and their relationships, one query at a time) and dumping their __dict__.
+'''
+import json
+from flask import current_app
+from timetabler import db
+from timetabler.models import Subject, Student, Tutor, TimetabledClass, Timeslot, Room, University, College, User, \
+    substumap, subtutmap, tutoravailabilitymap
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+def dumps(data):
+    '''
+    Encode data as JSON, with orjson if it is installed.
+
+    :param data: The data to encode.
+    :return: The JSON as a string.
+    '''
+    if orjson is not None:
+        return orjson.dumps(data).decode('utf-8')
+    return json.dumps(data, separators=(',', ':'), check_circular=False)
+
+
+def datatables_response(data, **kwargs):
+    '''
+    Make the response for a DataTables table.
+
+    :param data: List of the rows for the table.
+    :param kwargs: Other values for the response, e.g. draw, recordsTotal and recordsFiltered for a table using
+                   server-side processing.
+    :return: A JSON response of the form {"data": [...]}.
+    '''
+    kwargs['data'] = data
+    return current_app.response_class(dumps(kwargs), mimetype='application/json')
+
+
+def get_datatables_request(args):
+    '''
+    Read the parameters a DataTables table using server-side processing sends with each request.
+
+    :param args: The request arguments.
+    :return: Dictionary with draw, start, length (-1 for all rows), search (the text searched for) and order (a list
+             of (key, descending) pairs, where key is the name of the column in the table, or its data if it has no
+             name). Returns None if the table is not using server-side processing.
+    '''
+    if 'draw' not in args:
+        return None
+    order = []
+    i = 0
+    while 'order[%d][column]' % i in args:
+        column = int(args['order[%d][column]' % i])
+        if args.get('columns[%d][orderable]' % column, 'true') == 'true':
+            key = args.get('columns[%d][name]' % column) or args.get('columns[%d][data]' % column)
+            order.append((key, args.get('order[%d][dir]' % i) == 'desc'))
+        i += 1
+    return {'draw': int(args['draw']), 'start': int(args.get('start', 0)), 'length': int(args.get('length', -1)),
+            'search': args.get('search[value]', ''), 'order': order}
+
+
+def get_value(row, key):
+    '''
+    Get a value from a serialized row.
+
+    :param row: The row as a dictionary.
+    :param key: The key of the value, where a dotted key such as "tutor.name" is looked up in a nested object.
+    :return: The value.
+    '''
+    for part in key.split('.'):
+        row = row[part]
+    return row
+
+
+def page_rows(rows, datatables, keys):
+    '''
+    Search, sort and page rows that are already in memory for a table using server-side processing.
+
+    :param rows: List of the serialized rows.
+    :param datatables: The request, as from get_datatables_request.
+    :param keys: The keys of the values that can be searched and sorted on.
+    :return: Dictionary with draw, recordsTotal, recordsFiltered and data for datatables_response.
+    '''
+    total = len(rows)
+    if datatables['search']:
+        text = datatables['search'].lower()
+        rows = [row for row in rows if any(text in str(get_value(row, key)).lower() for key in keys)]
+    # Sorting by the last key first keeps the earlier keys' order, as Python's sort is stable
+    for key, descending in reversed(datatables['order']):
+        if key in keys:
+            rows = sorted(rows, key=lambda row: get_value(row, key), reverse=descending)
+    end = None if datatables['length'] < 0 else datatables['start'] + datatables['length']
+    return {'draw': datatables['draw'], 'recordsTotal': total, 'recordsFiltered': len(rows),
+            'data': rows[datatables['start']:end]}
+
+
+class Serializer(object):
+    '''
+    Declares the JSON for the rows of a model.
+
+    model is the model queried. fields is a list of (key, column) pairs, where a dotted key such as "tutor.name" puts
+    the value in a nested object. A nested object whose id is null (an outer join that found nothing) is given as
+    null. joins is a list of (target, onclause) pairs outer joined onto the model for the columns of related rows.
+    lists is a list of (key, serializer, column) triples for related rows given as a list under key, where column
+    is the column in that serializer's query holding the id of the row the related row belongs to. search is a list
+    of the columns searched when a table using server-side processing is filtered.
+    '''
+    model = None
+    fields = []
+    joins = []
+    lists = []
+    search = []
+
+    # Number of ids looked up at once when reading lists, to stay under the database's limit on parameters
+    chunksize = 500
+
+    @classmethod
+    def query(cls, *columns):
+        '''
+        Get the query for the serializer's fields.
+
+        :param columns: Extra columns to add after the fields.
+        :return: The query, which can be filtered and ordered further.
+        '''
+        query = db.session.query(*([column for key, column in cls.fields] + list(columns))).select_from(cls.model)
+        for target, onclause in cls.joins:
+            query = query.outerjoin(target, onclause)
+        return query
+
+    @classmethod
+    def dump_row(cls, row):
+        '''
+        Convert a row of the serializer's query to a dictionary.
+
+        :param row: A row of the query.
+        :return: Dictionary of the row's values by field key.
+        '''
+        result = {}
+        for (key, column), value in zip(cls.fields, row):
+            path = key.split('.')
+            target = result
+            for part in path[:-1]:
+                target = target.setdefault(part, {})
+            target[path[-1]] = value
+        for key, value in result.items():
+            if isinstance(value, dict) and 'id' in value and value['id'] is None:
+                result[key] = None
+        return result
+
+    @classmethod
+    def dump(cls, query=None):
+        '''
+        Read the rows of a query of the serializer's fields, and their lists.
+
+        :param query: A query from cls.query(), e.g. filtered. All of the model's rows are read if not given.
+        :return: A list of dictionaries, one for each row.
+        '''
+        if query is None:
+            query = cls.query()
+        rows = [cls.dump_row(row) for row in query]
+        for key, serializer, column in cls.lists:
+            lists = {row['id']: [] for row in rows}
+            ids = list(lists.keys())
+            for i in range(0, len(ids), cls.chunksize):
+                for row in serializer.query(column).filter(column.in_(ids[i:i + cls.chunksize])):
+                    lists[row[-1]].append(serializer.dump_row(row))
+            for row in rows:
+                row[key] = lists[row['id']]
+        return rows
+
+    @classmethod
+    def page(cls, query, datatables):
+        '''
+        Search, sort and page a query for a table using server-side processing, in the database.
+
+        :param query: A query from cls.query(), e.g. filtered to the current year and studyperiod.
+        :param datatables: The request, as from get_datatables_request. Columns are sorted on if their key is one of
+                           the serializer's fields.
+        :return: Dictionary with draw, recordsTotal, recordsFiltered and data for datatables_response.
+        '''
+        total = query.count()
+        if datatables['search'] and cls.search:
+            query = query.filter(db.or_(*[column.contains(datatables['search'], autoescape=True)
+                                          for column in cls.search]))
+            filtered = query.count()
+        else:
+            filtered = total
+        columns = dict(cls.fields)
+        for key, descending in datatables['order']:
+            if key in columns:
+                query = query.order_by(columns[key].desc() if descending else columns[key])
+        query = query.order_by(cls.model.id).offset(datatables['start'])
+        if datatables['length'] >= 0:
+            query = query.limit(datatables['length'])
+        return {'draw': datatables['draw'], 'recordsTotal': total, 'recordsFiltered': filtered,
+                'data': cls.dump(query)}
+
+    @classmethod
+    def response(cls, query, args):
+        '''
+        Make the response for a table of the serializer's rows, searched, sorted and paged in the database if the
+        table uses server-side processing.
+
+        :param query: A query from cls.query().
+        :param args: The request arguments.
+        :return: A JSON response for DataTables.
+        '''
+        datatables = get_datatables_request(args)
+        if datatables is None:
+            return datatables_response(cls.dump(query))
+        return datatables_response(**cls.page(query, datatables))
+
+
+# Number of students enrolled in each subject
+enrolments = db.select([substumap.c.subject_id, db.func.count(substumap.c.id).label('students')]) \
+    .group_by(substumap.c.subject_id).alias('enrolments')
+
+
+class TimeslotSerializer(Serializer):
+    model = Timeslot
+    fields = [('id', Timeslot.id), ('day', Timeslot.day), ('time', Timeslot.time),
+              ('preferredtime', Timeslot.preferredtime)]
+
+
+class TimetabledClassSerializer(Serializer):
+    model = TimetabledClass
+    fields = [('id', TimetabledClass.id), ('time', TimetabledClass.time),
+              ('subject.id', Subject.id), ('subject.subcode', Subject.subcode), ('subject.subname', Subject.subname),
+              ('timeslot.id', Timeslot.id), ('timeslot.day', Timeslot.day), ('timeslot.time', Timeslot.time),
+              ('tutor.id', Tutor.id), ('tutor.name', Tutor.name), ('room.id', Room.id), ('room.name', Room.name)]
+    joins = [(Subject, Subject.id == TimetabledClass.subjectid), (Timeslot, Timeslot.id == TimetabledClass.time),
+             (Tutor, Tutor.id == TimetabledClass.tutorid), (Room, Room.id == TimetabledClass.roomid)]
+    search = [Subject.subcode, Subject.subname, Timeslot.day, Timeslot.time, Tutor.name, Room.name]
+
+
+class TutorSubjectSerializer(Serializer):
+    model = Subject
+    fields = [('id', Subject.id), ('subcode', Subject.subcode), ('subname', Subject.subname),
+              ('repeats', Subject.repeats)]
+    joins = [(subtutmap, subtutmap.c.subject_id == Subject.id)]
+
+
+class TutorTimeSerializer(Serializer):
+    model = Timeslot
+    fields = [('id', Timeslot.id), ('day', Timeslot.day), ('time', Timeslot.time)]
+    joins = [(tutoravailabilitymap, tutoravailabilitymap.c.timeslot_id == Timeslot.id)]
+
+
+class TutorSerializer(Serializer):
+    model = Tutor
+    fields = [('id', Tutor.id), ('name', Tutor.name), ('email', Tutor.email)]
+    lists = [('subjects', TutorSubjectSerializer, subtutmap.c.tutor_id),
+             ('availabletimes', TutorTimeSerializer, tutoravailabilitymap.c.tutor_id)]
+
+
+class RoomSerializer(Serializer):
+    model = Room
+    fields = [('id', Room.id), ('name', Room.name), ('building', Room.building), ('projector', Room.projector),
+              ('capacity', Room.capacity)]
+
+
+class UniversitySerializer(Serializer):
+    model = University
+    fields = [('id', University.id), ('name', University.name)]
+
+
+class CollegeSerializer(Serializer):
+    model = College
+    fields = [('id', College.id), ('name', College.name)]
+
+
+class UserSerializer(Serializer):
+    model = User
+    fields = [('id', User.id), ('username', User.username), ('email', User.email), ('is_admin', User.is_admin),
+              ('tutor.id', Tutor.id), ('tutor.name', Tutor.name)]
+    joins = [(Tutor, Tutor.userid == User.id)]
+
+
+class StudentSerializer(Serializer):
+    model = Student
+    fields = [('id', Student.id), ('studentcode', Student.studentcode), ('name', Student.name),
+              ('email', Student.email)]
+    search = [Student.studentcode, Student.name]
+
+
+class SubjectSerializer(Serializer):
+    model = Subject
+    fields = [('id', Subject.id), ('subcode', Subject.subcode), ('subname', Subject.subname),
+              ('repeats', Subject.repeats), ('needsprojector', Subject.needsprojector),
+              ('students', db.func.coalesce(enrolments.c.students, 0))]
+    joins = [(enrolments, enrolments.c.subject_id == Subject.id)]
+    search = [Subject.subcode, Subject.subname]
+
+
+class MappedSubjectSerializer(Serializer):
+    model = Subject
+    fields = SubjectSerializer.fields + [('tutor.id', Tutor.id), ('tutor.name', Tutor.name)]
+    joins = SubjectSerializer.joins + [(subtutmap, subtutmap.c.subject_id == Subject.id),
+                                       (Tutor, Tutor.id == subtutmap.c.tutor_id)]
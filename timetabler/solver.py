@@ -0,0 +1,250 @@
+'''
+Helpers for running CBC directly on a model file.
+
+PuLP writes its own temporary files and waits on CBC internally. Running CBC ourselves means we know the
+process id, so a run can be cancelled, and we keep its log, so progress can be read while it runs.
+'''
+import os
+import re
+import subprocess
+import tempfile
+from pulp import PULP_CBC_CMD, LpStatus, LpStatusOptimal, LpSolutionIntegerFeasible, PulpSolverError, getSolver
+from timetabler.config import appcfg
+
+
+def get_solver_options(overrides=None):
+    '''
+    Get the solver settings from appcfg, with any settings given for this run taking precedence.
+
+    :param overrides: Dictionary of settings for this run. Missing or None values use appcfg.
+    :return: Dictionary with solver (a PuLP solver name, or "cbc" for the bundled CBC run by run_cbc), time_limit
+             (seconds), gap (relative MIP gap), threads and warm_start (whether to start from the saved timetable).
+             Settings that are None are left to the solver.
+    '''
+    solver_options = {'solver': appcfg.get("solver", "cbc"), 'time_limit': appcfg.get("solver_time_limit"),
+                      'gap': appcfg.get("solver_gap"), 'threads': appcfg.get("solver_threads"),
+                      'warm_start': appcfg.get("solver_warm_start", False)}
+    for key, value in (overrides or {}).items():
+        if value is not None:
+            solver_options[key] = value
+    return solver_options
+
+
+def get_cbc_options(solver_options):
+    '''
+    Get the CBC command line options for the time limit, gap and threads in a dictionary of solver settings.
+
+    :param solver_options: Dictionary of solver settings, as from get_solver_options.
+    :return: A list of options for run_cbc.
+    '''
+    options = []
+    if solver_options.get('time_limit') is not None:
+        options.append('sec ' + str(solver_options['time_limit']))
+    if solver_options.get('gap') is not None:
+        options.append('ratio ' + str(solver_options['gap']))
+    if solver_options.get('threads') is not None:
+        options.append('threads ' + str(solver_options['threads']))
+    return options
+
+
+def get_status(status, sol_status):
+    '''
+    Get the status of a solve as a string.
+
+    This is the LpStatus string, except that a solve stopped by a limit with an integer solution is "Feasible"
+    rather than "Optimal", so the solution is kept but not reported as optimal.
+
+    :param status: The PuLP status code.
+    :param sol_status: The PuLP solution status code.
+    :return: The status string.
+    '''
+    if status == LpStatusOptimal and sol_status == LpSolutionIntegerFeasible:
+        return 'Feasible'
+    return LpStatus[status]
+
+
+def get_cbc_path():
+    '''
+    Get the path of the CBC binary that ships with PuLP.
+
+    :return: Path to the CBC executable.
+    '''
+    return PULP_CBC_CMD(msg=False).path
+
+
+def run_cbc(model_path, solution_path, options=None, log_path=None, pid_path=None, cancel_path=None):
+    '''
+    Solve an MPS or LP file with CBC.
+
+    :param model_path: Path to the model file.
+    :param solution_path: Path CBC should write the solution to.
+    :param options: A list of extra CBC options without the leading dash, e.g. ['sec 60'].
+    :param log_path: File to write the CBC log to. A temporary file next to the solution is used if not given.
+    :param pid_path: File to write the CBC process id to while it runs, so that it can be cancelled.
+    :param cancel_path: If this file exists the run has been cancelled, and CBC is not started.
+    :return: Dictionary of statistics read from the CBC log (see parse_cbc_log).
+    '''
+    if cancel_path is not None and os.path.exists(cancel_path):
+        raise PulpSolverError("Solve was cancelled")
+    if log_path is None:
+        log_path = solution_path + '.log'
+    args = [get_cbc_path(), model_path]
+    for option in options or []:
+        args.extend(('-' + option).split())
+    args.extend(['-solve', '-printingOptions', 'all', '-solution', solution_path])
+    with open(log_path, 'w') as log:
+        process = subprocess.Popen(args, stdout=log, stderr=log, stdin=subprocess.DEVNULL)
+        if pid_path is not None:
+            with open(pid_path, 'w') as f:
+                f.write(str(process.pid))
+        # Cancelled before the process id was written, so nobody else can kill it
+        if cancel_path is not None and os.path.exists(cancel_path):
+            process.terminate()
+        try:
+            returncode = process.wait()
+        finally:
+            if pid_path is not None and os.path.exists(pid_path):
+                os.remove(pid_path)
+    if returncode != 0 or not os.path.exists(solution_path):
+        raise PulpSolverError("Error while executing " + args[0])
+    return parse_cbc_log(log_path)
+
+
+def read_solution(solution_path):
+    '''
+    Read a CBC solution file.
+
+    :param solution_path: Path to the solution file written by run_cbc.
+    :return: A tuple of the model status as a string (as in LpStatus) and a dictionary of values
+             indexed by column or row name.
+    '''
+    status, sol_status = PULP_CBC_CMD(msg=False).get_status(solution_path)
+    values = {}
+    with open(solution_path) as f:
+        f.readline()
+        for line in f:
+            fields = line.split()
+            if len(fields) < 3:
+                break
+            # Infeasible rows are flagged with a leading **
+            if fields[0] == '**':
+                fields = fields[1:]
+            values[fields[1]] = float(fields[2])
+    return get_status(status, sol_status), values
+
+
+def write_mip_start(path, values):
+    '''
+    Write starting values for CBC, in the solution file format CBC reads with -mips.
+
+    Only the given columns are written, so CBC completes the rest of the solution itself.
+
+    :param path: Path to write to.
+    :param values: Dictionary of starting values indexed by column name.
+    :return: Nil.
+    '''
+    with open(path, 'w') as f:
+        f.write('Stopped on time - objective value 0\n')
+        for i, (name, value) in enumerate(values.items()):
+            f.write('{:>7} {} {:>15} {:>23}\n'.format(i, name, value, 0))
+
+
+def solve_pulp_model(model, solver_options=None, warm_start=False):
+    '''
+    Solve a PuLP model by writing it out and running CBC with run_cbc.
+
+    This does the same as model.solve() with the bundled CBC, but with a known log file and process id.
+    Other solvers are run through PuLP, without a log, process id or statistics.
+
+    :param model: The LpProblem to solve. Its variables and status are updated with the solution.
+    :param solver_options: Dictionary of solver settings as from get_solver_options, which may also include
+                           log_path, pid_path and cancel_path as for run_cbc.
+    :param warm_start: Whether to give the solver the variables' initial values (set with setInitialValue) as a
+                       starting solution. Variables without an initial value are left for the solver to fill in.
+    :return: Dictionary of statistics read from the CBC log (see parse_cbc_log).
+    '''
+    solver_options = solver_options or {}
+    if solver_options.get('solver', 'cbc') != 'cbc':
+        model.solve(getSolver(solver_options['solver'], msg=False, timeLimit=solver_options.get('time_limit'),
+                              gapRel=solver_options.get('gap'), threads=solver_options.get('threads'),
+                              warmStart=warm_start))
+        return {}
+    solver = PULP_CBC_CMD(msg=False)
+    with tempfile.TemporaryDirectory() as directory:
+        model_path = os.path.join(directory, 'model.mps')
+        solution_path = os.path.join(directory, 'model.sol')
+        vs, variablesNames, constraintsNames, objectiveName = model.writeMPS(model_path, rename=1)
+        options = get_cbc_options(solver_options)
+        if warm_start:
+            start_path = os.path.join(directory, 'start.mst')
+            write_mip_start(start_path, {variablesNames[v.name]: v.value() for v in vs if v.value() is not None})
+            options.append('mips ' + start_path)
+        stats = run_cbc(model_path, solution_path, options=options,
+                        log_path=solver_options.get('log_path'), pid_path=solver_options.get('pid_path'),
+                        cancel_path=solver_options.get('cancel_path'))
+        status, values, reducedCosts, shadowPrices, slacks, sol_status = solver.readsol_MPS(
+            solution_path, model, vs, variablesNames, constraintsNames)
+    model.assignVarsVals(values)
+    model.assignStatus(status, sol_status)
+    return stats
+
+
+def parse_cbc_log(log_path):
+    '''
+    Read the progress of a CBC run from its log. This can be called while CBC is still running.
+
+    :param log_path: Path to the CBC log.
+    :return: Dictionary with whichever of objective (best solution so far), bound (best possible), gap (relative),
+             nodes, root_bound (LP relaxation), start_objective (of a warm start solution), result (CBC's final
+             result line) and stopped_by (the limit that stopped the run: "time limit" or "gap tolerance") are
+             known so far.
+    '''
+    stats = {}
+    if not os.path.exists(log_path):
+        return stats
+    with open(log_path) as f:
+        for line in f:
+            match = re.match(r'Continuous objective value is (\S+)', line)
+            if match:
+                stats['root_bound'] = float(match.group(1))
+            match = re.search(r'After (\d+) nodes, \d+ on tree, (\S+) best solution, best possible (\S+)', line)
+            if match:
+                stats['nodes'] = int(match.group(1))
+                stats['bound'] = float(match.group(3))
+                if float(match.group(2)) < 1e50:
+                    stats['objective'] = float(match.group(2))
+            match = re.search(r'Integer solution of (\S+) found', line)
+            if match:
+                stats['objective'] = float(match.group(1))
+            match = re.search(r'Search completed - best objective (\S+), took \d+ iterations and (\d+) nodes', line)
+            if match and float(match.group(1)) < 1e50:
+                stats['objective'] = stats['bound'] = float(match.group(1))
+                stats['nodes'] = int(match.group(2))
+            match = re.match(r'Result - (.*)', line)
+            if match:
+                stats['result'] = match.group(1).strip()
+            match = re.match(r'Objective value:\s+(\S+)', line)
+            if match:
+                stats['objective'] = float(match.group(1))
+            match = re.match(r'Enumerated nodes:\s+(\d+)', line)
+            if match:
+                stats['nodes'] = int(match.group(1))
+            match = re.search(r'MIPStart provided solution with cost (\S+)', line)
+            if match:
+                stats['start_objective'] = float(match.group(1))
+            match = re.match(r'Gap:\s+(\S+)', line)
+            if match:
+                stats['final_gap'] = float(match.group(1))
+    result = stats.get('result', '')
+    if result == 'Optimal solution found' and 'objective' in stats:
+        stats['bound'] = stats['objective']
+    if 'objective' in stats and 'bound' in stats:
+        stats['gap'] = abs(stats['objective'] - stats['bound']) / max(abs(stats['objective']), 1e-10)
+    # CBC prints the final gap when it stops early, which is more up to date than the last progress line
+    if 'final_gap' in stats:
+        stats['gap'] = stats.pop('final_gap')
+    if 'time' in result:
+        stats['stopped_by'] = 'time limit'
+    elif 'gap' in result:
+        stats['stopped_by'] = 'gap tolerance'
+    return stats
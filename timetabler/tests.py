@@ -1,11 +1,14 @@
 import unittest
 import abc
+import io
+import tempfile
 from pandas import DataFrame
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from timetabler import app
 from timetabler.models import *
 from timetabler.views import *
+import timetabler.benchmark
 
 TEST_DB = 'test.db'
 
@@ -23,6 +26,8 @@ class BaseTest(unittest.TestCase):
         app.config['WTF_CSRF_ENABLED'] = False
         app.config['DEBUG'] = False
         app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + TEST_DB
+        # The session opened when the app was imported is still bound to the real database
+        db.session.remove()
         self.app = app.test_client()
         db.drop_all()
         db.create_all()
@@ -94,6 +99,23 @@ class StudentTests(BaseTest):
         self.assertIn(subject, student.subjects)
         self.assertIn(student, subject.students)
 
+    def test_populate_students_counts(self):
+        schema = appcfg["enrolment_schema"]
+        data = DataFrame({schema['student_first_name']: ['Justin', 'Jemima', 'Jemima', 'Ann', 'Tom'],
+                          schema['student_last_name']: ['Smallwood', 'Capper', 'Capper', 'Lee', 'Cox'],
+                          schema['student_id']: ['542066', '356351', '356351', None, '123595'],
+                          schema['subject_code']: ['ECON10005', 'ECON10005', 'ECON10005', 'ECON10005', 'ECON20003'],
+                          schema['subject_name']: ['Quantitative Methods 1'] * 4 + ['Quantitative Methods 2'],
+                          schema['study_period']: [get_current_studyperiod()] * 4 + ['Another Study Period']})
+        counts = populate_students(data)
+        self.assertEqual(counts, {'students': 1, 'subjects': 1, 'enrolments': 2, 'other_period': 1, 'invalid': 1,
+                                  'existing': 0, 'duplicate': 1})
+        self.assertEqual(len(Student.get_all(studentcode='542066')), 1)
+        self.assertIn(Student.get(name='Jemima Capper'), Subject.get(subcode='ECON10005').students)
+        counts = populate_students(data)
+        self.assertEqual(counts, {'students': 0, 'subjects': 0, 'enrolments': 0, 'other_period': 1, 'invalid': 1,
+                                  'existing': 3, 'duplicate': 0})
+
 
 
 class SubjectTests(BaseTest):
@@ -185,6 +207,18 @@ class TimetableTests(BaseTest):
         student.subjects.append(Subject.get(subcode='ECON10005'))
         db.session.commit()
 
+    def get_solver_args(self):
+        '''
+        Get the arguments the first stage solvers take, for the timetable data set up for the tests.
+
+        :return: A tuple of the arguments, in the order solve_timetable_pulp takes them.
+        '''
+        (STUDENTS, SUBJECTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+         maxclasssize, minclasssize, ROOMS, PROJECTORS, PROJECTORROOMS, numroomsprojector, NONPREFERREDTIMES,
+         CAPACITIES) = get_timetable_data(rooms=True)
+        return (STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY,
+                maxclasssize, minclasssize, ROOMS, PROJECTORS, numroomsprojector, NONPREFERREDTIMES)
+
     def test_timetable(self):
         STUDENTSTEST = ['Justin Smallwood', 'Tom Cox']
         SUBJECTSTEST = ['ECON10005', 'MAST10006']
@@ -233,6 +267,357 @@ class TimetableTests(BaseTest):
                                TUTORAVAILABILITY, maxclasssize, minclasssize, nrooms, non_preferred_times)
         self.assertEqual(result, 'Optimal')
 
+    def test_timetable_with_rooms_report(self):
+        report = {}
+        result = runtimetable_with_rooms_two_step(*get_timetable_data(rooms=True), report=report)
+        self.assertEqual(result, 'Optimal')
+        for phase in ['build', 'solve', 'rooms', 'writeback']:
+            self.assertIn(phase, report)
+        self.assertGreater(report['variables'], 0)
+        self.assertIn('writeback_students', report)
+        self.assertEqual(len(TimetabledClass.get_all()), 2)
+        self.assertEqual(sum(len(timetabledclass.students) for timetabledclass in TimetabledClass.get_all()), 3)
+
+    def test_matrix_backend_matches_pulp(self):
+        args = self.get_solver_args()
+        pulp_report = {}
+        matrix_report = {}
+        pulp_result = solve_timetable_pulp(*args, report=pulp_report)
+        matrix_result = timetabler.matrix.solve_timetable_matrix(*args, report=matrix_report)
+        self.assertEqual(pulp_result[0], 'Optimal')
+        self.assertEqual(pulp_result, matrix_result)
+        self.assertEqual(pulp_report['variables'], matrix_report['variables'])
+        self.assertEqual(pulp_report['constraints'], matrix_report['constraints'])
+
+    def test_pruned_unavailable_times(self):
+        args = self.get_solver_args()
+        results = {}
+        try:
+            for prune in [True, False]:
+                appcfg['prune_unavailable_times'] = prune
+                for solve in [solve_timetable_pulp, timetabler.matrix.solve_timetable_matrix]:
+                    report = {}
+                    results[(prune, solve)] = (solve(*args, report=report), report)
+        finally:
+            appcfg['prune_unavailable_times'] = True
+        for solve in [solve_timetable_pulp, timetabler.matrix.solve_timetable_matrix]:
+            (pruned, report), (unpruned, unprunedreport) = results[(True, solve)], results[(False, solve)]
+            self.assertEqual(pruned, unpruned)
+            self.assertLess(report['variables'], unprunedreport['variables'])
+            self.assertEqual(report['variables_before_pruning'], unprunedreport['variables'])
+            self.assertEqual(report['constraints_before_pruning'], unprunedreport['constraints'])
+        self.assertIn('before pruning', format_build_report(results[(True, solve_timetable_pulp)][1]))
+        # The sizes before pruning are only worked out for the loose formulation without symmetry breaking
+        for solve in [solve_timetable_pulp, timetabler.matrix.solve_timetable_matrix]:
+            for options in [{'tight_formulation': True}, {'symmetry_breaking': True}]:
+                report = {}
+                solve(*args, report=report, **options)
+                self.assertNotIn('variables_before_pruning', report)
+                self.assertNotIn('before pruning', format_build_report(report))
+
+    def test_lazy_clash_constraints(self):
+        args = self.get_solver_args()
+        report = {}
+        appcfg['lazy_clash_constraints'] = True
+        try:
+            lazy = solve_timetable_pulp(*args, report=report)
+        finally:
+            appcfg['lazy_clash_constraints'] = False
+        self.assertEqual(lazy, solve_timetable_pulp(*args, report={}))
+        self.assertGreaterEqual(report['clash_rounds'], 1)
+        self.assertIn('rounds', format_build_report(report))
+
+    def test_lazy_clash_constraints_matrix(self):
+        args = self.get_solver_args()
+        report = {}
+        appcfg['lazy_clash_constraints'] = True
+        try:
+            result = timetabler.matrix.solve_timetable_matrix(*args, report=report)
+        finally:
+            appcfg['lazy_clash_constraints'] = False
+        self.assertEqual(result, solve_timetable_pulp(*args, report={}))
+        self.assertTrue(report['lazy_clash_constraints_ignored'])
+        self.assertNotIn('clash_rounds', report)
+        self.assertIn('not supported', format_build_report(report))
+
+    def test_tight_formulation(self):
+        args = self.get_solver_args()
+        pulp_report = {}
+        matrix_report = {}
+        appcfg['tight_formulation'] = True
+        try:
+            pulp_result = solve_timetable_pulp(*args, report=pulp_report)
+            matrix_result = timetabler.matrix.solve_timetable_matrix(*args, report=matrix_report)
+        finally:
+            appcfg['tight_formulation'] = False
+        self.assertEqual(pulp_result, solve_timetable_pulp(*args, report={}))
+        self.assertEqual(pulp_result, matrix_result)
+        self.assertEqual(pulp_report['constraints'], matrix_report['constraints'])
+
+    def test_symmetry_breaking(self):
+        args = self.get_solver_args()
+        STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING, TUTORAVAILABILITY = args[:9]
+        # A second student taking only ECON10005, which now has two repeats, is interchangeable with Tom Cox, and
+        # a third time ECON10005 can be at
+        STUDENTS = STUDENTS + ['Ann Lee']
+        TIMES = TIMES + ['Tuesday 7:30pm']
+        DAYS = dict(DAYS, Tuesday=DAYS['Tuesday'] | {'Tuesday 7:30pm'})
+        TUTORAVAILABILITY = dict(TUTORAVAILABILITY,
+                                 **{'Jemima Capper': TUTORAVAILABILITY['Jemima Capper'] | {'Tuesday 7:30pm'}})
+        SUBJECTMAPPING = dict(SUBJECTMAPPING, ECON10005=set(SUBJECTMAPPING['ECON10005']) | {'Ann Lee'})
+        REPEATS = dict(REPEATS, ECON10005=2)
+        self.assertEqual(get_symmetric_students(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING, SUBJECTMAPPING, REPEATS),
+                         [('Tom Cox', 'Ann Lee', 'ECON10005', 'Jemima Capper')])
+        args = (STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING,
+                TUTORAVAILABILITY) + args[9:]
+        pulp_report = {}
+        matrix_report = {}
+        status, subject_values, assign_values = solve_timetable_pulp(*args, report=pulp_report,
+                                                                     symmetry_breaking=True)
+        self.assertEqual(status, 'Optimal')
+        # A row for each of the class's times but the last
+        self.assertEqual(pulp_report['symmetry_constraints'], 2)
+        attended = {i: TIMES.index(k) for (i, j, k, m), value in assign_values.items() if j == 'ECON10005' and value}
+        self.assertLessEqual(attended['Tom Cox'], attended['Ann Lee'])
+        self.assertEqual(timetabler.matrix.solve_timetable_matrix(*args, report=matrix_report, symmetry_breaking=True),
+                         (status, subject_values, assign_values))
+        self.assertEqual(pulp_report['constraints'], matrix_report['constraints'])
+        self.assertEqual(pulp_report['symmetry_constraints'], matrix_report['symmetry_constraints'])
+
+    def test_cohort_backend(self):
+        args = self.get_solver_args()
+        STUDENTS, TIMES, day, DAYS, TEACHERS, SUBJECTMAPPING, REPEATS, TEACHERMAPPING = args[:8]
+        report = {}
+        self.assertEqual(solve_timetable_cohorts(*args, report=report), solve_timetable_pulp(*args, report={}))
+        self.assertEqual(report['cohorts'], len(group_cohorts(STUDENTS, TIMES, TEACHERS, TEACHERMAPPING,
+                                                              SUBJECTMAPPING)))
+
+        # Three students sharing two subjects, whose classes at 9:00 are split so that no one has both
+        counts = {('A', 'X'): {'9:00': 2, '10:00': 1}, ('B', 'Y'): {'9:00': 1, '11:00': 2}}
+        assignments = split_cohort(['s1', 's2', 's3'], counts)
+        self.assertEqual(len(assignments), 6)
+        times = [(i, k) for (i, j, k, m) in assignments]
+        self.assertEqual(len(set(times)), 6)
+        self.assertEqual(sorted(i for (i, j, k, m) in assignments if j == 'A'), ['s1', 's2', 's3'])
+
+    def test_decomposed_timetable(self):
+        report = {}
+        status, room_values, assign_values, classpop = solve_timetable_two_step(*get_timetable_data(rooms=True),
+                                                                                report=report, decompose=True)
+        self.assertEqual(status, 'Optimal')
+        self.assertEqual(report['components'], 1)
+        self.assertEqual(len(classpop), 2)
+        self.assertIsNotNone(room_values)
+
+    def test_timetable_job(self):
+        job = timetabler.jobs.submit_timetable_job(username='admin', run=False)
+        self.assertEqual(job.status, 'queued')
+        # A second run while the first is queued gets the same job
+        self.assertEqual(timetabler.jobs.submit_timetable_job(username='admin', run=False).id, job.id)
+        jobid = job.id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        job = Job.query.get(jobid)
+        self.assertIsNotNone(job.elapsed())
+        self.assertEqual(job.gap, 0)
+        self.assertEqual(len(TimetabledClass.get_all()), 2)
+
+    def test_timetable_job_in_process(self):
+        data = get_timetable_data(rooms=True)
+        self.assertEqual(load_timetable_data(snapshot_timetable_data(data)), data)
+        appcfg['job_execution'] = 'process'
+        try:
+            jobid = timetabler.jobs.submit_timetable_job(run=False).id
+            self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        finally:
+            appcfg['job_execution'] = 'thread'
+        self.assertEqual(len(TimetabledClass.get_all()), 2)
+
+    def test_symmetry_breaking_job_in_process(self):
+        snapshot = snapshot_timetable_data(get_timetable_data(rooms=True))
+        self.assertNotIn('symmetry_constraints', solve_timetable_snapshot(snapshot)[-1])
+        self.assertIn('symmetry_constraints', solve_timetable_snapshot(snapshot, symmetry_breaking=True)[-1])
+        appcfg['job_execution'] = 'process'
+        appcfg['symmetry_breaking'] = True
+        try:
+            jobid = timetabler.jobs.submit_timetable_job(run=False).id
+            self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        finally:
+            appcfg['job_execution'] = 'thread'
+            appcfg['symmetry_breaking'] = False
+        self.assertIn('symmetry_constraints', json.loads(Job.query.get(jobid).report))
+
+    def test_warm_start_timetable_job(self):
+        runtimetable_with_rooms_two_step(*get_timetable_data(rooms=True))
+        warm_start = get_timetable_solution()
+        self.assertEqual(len(warm_start[0]), 2)
+        jobid = timetabler.jobs.submit_timetable_job(solver_options={'warm_start': True}, run=False).id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        with open(Job.query.get(jobid).logfile) as log:
+            self.assertIn('MIPStart values read', log.read())
+        # The re-solve replaces the classes it started from
+        self.assertEqual(len(TimetabledClass.get_all()), 2)
+
+    def test_repair_timetable_job(self):
+        jobid = timetabler.jobs.submit_timetable_job(kind='repair', run=False).id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'failed')
+        jobid = timetabler.jobs.submit_timetable_job(run=False).id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        jobid = timetabler.jobs.submit_timetable_job(kind='repair', run=False).id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        self.assertEqual(Job.query.get(jobid).message, "Nothing has changed since the last solve")
+        mastclass = TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='MAST10006').id).one().id
+        unlinksubjectstudent(123595, 'ECON10005')
+        jobid = timetabler.jobs.submit_timetable_job(kind='repair', run=False).id
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'optimal')
+        # Only ECON10005 was re-timetabled, and the MAST10006 class was left where it was
+        self.assertEqual(json.loads(Job.query.get(jobid).report)['kept'], 1)
+        self.assertEqual(TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='MAST10006').id).one().id,
+                         mastclass)
+        econclass = TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='ECON10005').id).one()
+        self.assertEqual([student.name for student in econclass.students], ['Justin Smallwood'])
+
+    def test_populate_availabilities(self):
+        data = DataFrame({'Tutor': ['Omid Kaveh', 'Jemima Capper'], 'Monday 17:30': [0, 1],
+                          'Tuesday 17:30': [1, 1]})
+        self.assertEqual(populate_availabilities(data), {'added': 1, 'removed': 1})
+        self.assertEqual([timeslot.day for timeslot in Tutor.get(name='Omid Kaveh').availabletimes], ['Tuesday'])
+        self.assertEqual(len(Tutor.get(name='Jemima Capper').availabletimes), 2)
+        self.assertEqual(populate_availabilities(data), {'added': 0, 'removed': 0})
+
+    def test_populate_availabilities_rollback(self):
+        data = DataFrame({'Tutor': ['Ann Lee'], 'Wednesday 18:15': [1], 'Thursday': [1]})
+        self.assertRaises(IndexError, populate_availabilities, data)
+        self.assertIsNone(Tutor.get(name='Ann Lee'))
+        self.assertIsNone(Timeslot.get(day='Wednesday', time='18:15'))
+
+    def test_populate_timetabledata(self):
+        data = DataFrame({'x1': ['ECON10005', 'MAST10006', 'PHYC10003'], 'x2': ['', '', ''],
+                          'x3': ['Jemima Capper', 'Omid Kaveh', 'Omid Kaveh'],
+                          'x4': ['Monday 7:30pm', 'Tuesday 9:30pm', 'Monday 7:30pm'], 'x5': ['', '', ''],
+                          'x6': ['Tom Cox', 'Justin Smallwood', 'Tom Cox'], 'x7': ['Jane Doe', None, None]})
+        counts = populate_timetabledata(data)
+        self.assertEqual(counts, {'classes': 2, 'students': 2, 'unmatched': ['Jane Doe'],
+                                  'unknownsubjects': ['PHYC10003']})
+        econclass = TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='ECON10005').id).one()
+        self.assertEqual((econclass.timeslot.day, econclass.timeslot.time), ('Monday', '19:30'))
+        self.assertEqual([student.name for student in econclass.students], ['Tom Cox'])
+        self.assertEqual(populate_timetabledata(data)['students'], 0)
+
+    def test_populate_timetabledata_rollback(self):
+        data = DataFrame({'x1': ['ECON10005', 'MAST10006'], 'x2': ['', ''], 'x3': ['Ann Lee', 'Omid Kaveh'],
+                          'x4': ['Wednesday 6:15pm', 'Monday 25:00pm'], 'x5': ['', ''], 'x6': ['Tom Cox', None]})
+        self.assertRaises(ValueError, populate_timetabledata, data)
+        self.assertIsNone(Tutor.get(name='Ann Lee'))
+        self.assertIsNone(Timeslot.get(day='Wednesday', time='18:15'))
+
+    def test_clash_report(self):
+        data = DataFrame({'x1': ['ECON10005', 'MAST10006'], 'x2': ['', ''], 'x3': ['Jemima Capper', 'Omid Kaveh'],
+                          'x4': ['Monday 7:30pm', 'Monday 7:30pm'], 'x5': ['', ''],
+                          'x6': ['Justin Smallwood', 'Justin Smallwood'], 'x7': ['Tom Cox', None]})
+        populate_timetabledata(data)
+        report = get_clash_report()
+        self.assertEqual(len(report), 1)
+        self.assertEqual(report[0]['student']['name'], 'Justin Smallwood')
+        self.assertEqual(sorted(report[0]['subjects']), ['Calculus 2', 'Quantitative Methods 1'])
+        econclass = TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='ECON10005').id).one()
+        econclass.update(time=Timeslot.get(day='Tuesday', time='21:30').id)
+        self.assertEqual(get_clash_report(), [])
+
+    def test_clash_report_class_lists(self):
+        data = DataFrame({'x1': ['ECON10005', 'MAST10006'], 'x2': ['', ''], 'x3': ['Jemima Capper', 'Omid Kaveh'],
+                          'x4': ['Monday 7:30pm', 'Monday 7:30pm'], 'x5': ['', ''],
+                          'x6': ['Tom Cox', 'Justin Smallwood'], 'x7': ['Justin Smallwood', None]})
+        populate_timetabledata(data)
+        self.assertEqual([row['student']['name'] for row in get_clash_report()], ['Justin Smallwood'])
+        # Justin's place in the Calculus class is the last class list row, whose id the next row added reuses
+        mastclass = TimetabledClass.query.filter_by(subjectid=Subject.get(subcode='MAST10006').id).one()
+        mastclass.students = []
+        db.session.commit()
+        mastclass.students = [Student.get(name='Tom Cox')]
+        db.session.commit()
+        self.assertEqual([row['student']['name'] for row in get_clash_report()], ['Tom Cox'])
+        Student.get(name='Tom Cox').update(name='Thomas Cox')
+        self.assertEqual([row['student']['name'] for row in get_clash_report()], ['Thomas Cox'])
+
+    def test_clash_report_swapped_students(self):
+        data = DataFrame({'x1': ['ECON10005', 'MAST10006', 'ECON10005'], 'x2': ['', '', ''],
+                          'x3': ['Jemima Capper', 'Omid Kaveh', 'Jemima Capper'],
+                          'x4': ['Monday 7:30pm', 'Monday 7:30pm', 'Tuesday 9:30pm'], 'x5': ['', '', ''],
+                          'x6': ['Justin Smallwood', 'Justin Smallwood', 'Tom Cox']})
+        populate_timetabledata(data)
+        self.assertEqual([row['student']['name'] for row in get_clash_report()], ['Justin Smallwood'])
+        # Swapping the students between the Monday classes and the Tuesday class keeps the number of class list rows
+        # and the sum of their student ids times class ids the same
+        justin, tom = Student.get(name='Justin Smallwood').id, Student.get(name='Tom Cox').id
+        db.session.execute(stutimetable.update().values(student_id=db.case([(stutimetable.c.student_id == justin, tom)],
+                                                                           else_=justin)))
+        db.session.commit()
+        self.assertEqual([row['student']['name'] for row in get_clash_report()], ['Tom Cox'])
+
+    def test_serializers(self):
+        tutors = TutorSerializer.dump(TutorSerializer.query().filter(Tutor.name == 'Jemima Capper'))
+        self.assertEqual([subject['subcode'] for subject in tutors[0]['subjects']], ['ECON10005'])
+        self.assertEqual(len(tutors[0]['availabletimes']), 2)
+        subjects = {subject['subcode']: subject['students'] for subject in SubjectSerializer.dump()}
+        self.assertEqual(subjects, {'ECON10005': 2, 'MAST10006': 1})
+        timeslot = Timeslot.get(day='Monday', time='19:30')
+        TimetabledClass.create(subjectid=Subject.get(subcode='ECON10005').id, timetable=get_current_timetable_id(),
+                               time=timeslot.id, tutorid=Tutor.get(name='Jemima Capper').id)
+        self.app.post('/login', data={'user_id': 'admin', 'password': appcfg['adminpassword']})
+        data = json.loads(self.app.get('/viewtimetableajax').data)['data']
+        self.assertEqual(data[0]['subject']['subcode'], 'ECON10005')
+        self.assertEqual((data[0]['timeslot']['day'], data[0]['tutor']['name'], data[0]['room']),
+                         ('Monday', 'Jemima Capper', None))
+
+    def test_server_side_processing(self):
+        self.app.post('/login', data={'user_id': 'admin', 'password': appcfg['adminpassword']})
+        args = {'draw': 3, 'start': 0, 'length': 1, 'search[value]': '', 'columns[0][data]': 'studentcode',
+                'columns[1][data]': 'name', 'order[0][column]': 1, 'order[0][dir]': 'desc'}
+        data = json.loads(self.app.get('/viewstudentsajax', query_string=args).data)
+        self.assertEqual((data['draw'], data['recordsTotal'], data['recordsFiltered']), (3, 2, 2))
+        self.assertEqual([student['name'] for student in data['data']], ['Tom Cox'])
+        args.update({'start': 1, 'search[value]': 'smallwood'})
+        data = json.loads(self.app.get('/viewstudentsajax', query_string=args).data)
+        self.assertEqual((data['recordsTotal'], data['recordsFiltered'], data['data']), (2, 1, []))
+        rows = [{'student': {'name': 'Tom Cox'}}, {'student': {'name': 'Justin Smallwood'}}]
+        page = page_rows(rows, get_datatables_request({'draw': 1, 'columns[0][name]': 'student.name',
+                                                        'order[0][column]': 0}), ['student.name'])
+        self.assertEqual([row['student']['name'] for row in page['data']], ['Justin Smallwood', 'Tom Cox'])
+
+    def test_upload_job(self):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tutors.csv')
+            data = DataFrame({'Tutor': ['Tom Cox', 'Tom Cox'], 'Subject Code': ['MAST10006', 'PHYC10003'],
+                              'Repeats': [2, 1]})
+            data.to_csv(path, index=False)
+            jobid = timetabler.jobs.submit_upload_job('tutors', path, run=False).id
+            self.assertEqual(timetabler.jobs.run_upload_job(jobid), 'failed')
+            # PHYC10003 does not exist, so none of the file was imported
+            self.assertIsNone(Tutor.get(name='Tom Cox'))
+            self.assertEqual(Subject.get(subcode='MAST10006').repeats, 1)
+            data[:1].to_csv(path, index=False)
+            jobid = timetabler.jobs.submit_upload_job('tutors', path, run=False).id
+            self.assertEqual(timetabler.jobs.run_upload_job(jobid), 'finished')
+        self.assertEqual(timetabler.jobs.get_upload_job(jobid)['rows'], 1)
+        self.assertEqual(Subject.get(subcode='MAST10006').tutor.name, 'Tom Cox')
+        self.assertEqual(Subject.get(subcode='MAST10006').repeats, 2)
+
+    def test_upload_disallowed_file(self):
+        self.app.post('/login', data={'user_id': 'admin', 'password': appcfg['adminpassword']})
+        for url in ['/uploadstudentdata', '/uploadtimetableclasslists', '/uploadtutordata',
+                    '/uploadtutoravailabilities']:
+            response = self.app.post(url, data={'file': (io.BytesIO(b'Tutor'), 'tutors.txt')},
+                                     content_type='multipart/form-data')
+            self.assertIn(UPLOAD_MESSAGE, response.data.decode())
+        self.assertEqual(Job.query.filter_by(kind='upload').count(), 0)
+
+    def test_cancel_timetable_job(self):
+        jobid = timetabler.jobs.submit_timetable_job(run=False).id
+        self.assertEqual(timetabler.jobs.cancel_job(jobid).status, 'cancelled')
+        self.assertEqual(timetabler.jobs.run_timetable_job(jobid), 'cancelled')
+        self.assertEqual(len(TimetabledClass.get_all()), 0)
+        self.assertNotEqual(timetabler.jobs.submit_timetable_job(run=False).id, jobid)
+
 
 class TestHelpers(BaseTest):
     def test_checkbox(self):
@@ -248,6 +633,102 @@ class TestHelpers(BaseTest):
         test = allowed_file(filename)
         self.assertEqual(test, True)
 
+    def test_admin_settings_cache(self):
+        with app.app_context():
+            get_current_year()
+            misses = timetabler.models.admin_settings_stats['misses']
+            hits = timetabler.models.admin_settings_stats['hits']
+            Student.get_all()
+            self.assertEqual(timetabler.models.admin_settings_stats['misses'], misses)
+            self.assertEqual(timetabler.models.admin_settings_stats['hits'], hits + 2)
+            update_studyperiod('Semester 2')
+            self.assertEqual(get_current_studyperiod(), 'Semester 2')
+            self.assertEqual(timetabler.models.admin_settings_stats['misses'], misses + 1)
+
+    def test_import_spreadsheet_chunks(self):
+        chunks = []
+        progress = []
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'tutors.csv')
+            DataFrame({'Tutor': ['Omid Kaveh', 'Jemima Capper', 'Tom Cox']}).to_csv(path, index=False)
+            summary = import_spreadsheet(path, lambda df: chunks.append(list(df['Tutor'])), chunksize=2,
+                                         progress=lambda rows, count: progress.append(rows))
+        self.assertEqual(chunks, [['Omid Kaveh', 'Jemima Capper'], ['Tom Cox']])
+        self.assertEqual(progress, [2, 3])
+        self.assertEqual(summary, {'rows': 3, 'chunks': 2})
+
+    def test_init_db_indexes(self):
+        self.assertEqual(init_db_indexes(), [])
+        for index in list(substumap.indexes) + list(Student.__table__.indexes):
+            index.drop(db.engine)
+        self.assertEqual(sorted(init_db_indexes()), ['ix_students_year_studyperiod_name',
+                                                     'ix_students_year_studyperiod_studentcode',
+                                                     'ix_substumap_student_id', 'ix_substumap_subject_id'])
+        self.assertEqual(init_db_indexes(), [])
+
+    def test_benchmark(self):
+        with tempfile.TemporaryDirectory() as directory:
+            output = os.path.join(directory, 'benchmark.json')
+            results = timetabler.benchmark.run_benchmark(output=output, students=12, subjects=3, tutors=2,
+                                                         timeslots=4, rooms=2)
+            with open(output) as f:
+                self.assertEqual(json.load(f), results)
+        self.assertEqual(results['semester']['students'], 12)
+        self.assertEqual(results['model']['status'], 'Optimal')
+        self.assertEqual(results['model']['classes'], 3)
+        for stage in ['timetable_data', 'build', 'solve', 'rooms', 'writeback', 'clash_report', 'export_timetable',
+                      'export_student_timetables', 'export_rolls']:
+            self.assertIn(stage, results['stages'])
+        self.assertEqual(Student.get_all(), [])
+
+    def test_compare_formulations(self):
+        results = timetabler.benchmark.compare_formulations(students=12, subjects=3, tutors=2, timeslots=4, rooms=2)
+        self.assertEqual(results['loose']['settings']['tight_formulation'], False)
+        self.assertEqual(results['tight']['settings']['tight_formulation'], True)
+        self.assertEqual(results['loose']['semester'], results['tight']['semester'])
+        self.assertEqual(results['loose']['model']['objective'], results['tight']['model']['objective'])
+        self.assertGreaterEqual(results['tight']['model']['root_bound'], results['loose']['model']['root_bound'])
+
+    def test_find_timetable_components(self):
+        TEACHERS = ['Omid Kaveh', 'Jemima Capper', 'Tom Cox']
+        TEACHERMAPPING = {'Omid Kaveh': set(['MAST10006']), 'Jemima Capper': set(['ECON10005', 'ECON20003']),
+                          'Tom Cox': set(['PHYC10003'])}
+        SUBJECTMAPPING = {'ECON10005': set(['Justin Smallwood']), 'ECON20003': set(['Jemima Capper']),
+                          'MAST10006': set(['Justin Smallwood']), 'PHYC10003': set(['Tom Cox'])}
+        components = find_timetable_components(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+        self.assertEqual(components, [set(['ECON10005', 'ECON20003', 'MAST10006']), set(['PHYC10003'])])
+
+    def test_build_student_enrolments(self):
+        TEACHERS = ['Omid Kaveh', 'Jemima Capper']
+        TEACHERMAPPING = {'Omid Kaveh': set(['MAST10006']), 'Jemima Capper': set(['ECON10005'])}
+        SUBJECTMAPPING = {'ECON10005': set(['Justin Smallwood', 'Tom Cox']), 'MAST10006': set(['Justin Smallwood'])}
+        enrolments = build_student_enrolments(TEACHERS, TEACHERMAPPING, SUBJECTMAPPING)
+        self.assertCountEqual(enrolments['Justin Smallwood'],
+                              [('MAST10006', 'Omid Kaveh'), ('ECON10005', 'Jemima Capper')])
+        self.assertEqual(enrolments['Tom Cox'], [('ECON10005', 'Jemima Capper')])
+
+
+    def test_solver_options(self):
+        solver_options = timetabler.solver.get_solver_options({'time_limit': 60, 'gap': None, 'threads': 4})
+        self.assertEqual(solver_options['solver'], appcfg['solver'])
+        self.assertEqual(solver_options['gap'], appcfg['solver_gap'])
+        self.assertIn('sec 60', timetabler.solver.get_cbc_options(solver_options))
+        self.assertIn('threads 4', timetabler.solver.get_cbc_options(solver_options))
+
+    def test_parse_stopped_cbc_log(self):
+        with tempfile.NamedTemporaryFile('w', suffix='.log', delete=False) as log:
+            log.write('Continuous objective value is 1001 - 0.11 seconds\n'
+                      'Cbc0012I Integer solution of 4002 found by feasibility pump after 0 iterations and 0 nodes\n'
+                      'Result - Stopped on time limit\n'
+                      'Objective value:                4002.00000000\n'
+                      'Gap:                            0.20\n')
+        stats = timetabler.solver.parse_cbc_log(log.name)
+        os.remove(log.name)
+        self.assertEqual(stats['objective'], 4002)
+        self.assertEqual(stats['root_bound'], 1001)
+        self.assertEqual(stats['gap'], 0.2)
+        self.assertEqual(stats['stopped_by'], 'time limit')
+
 
 class TestViews(BaseTest):
     def setUpTestData(self):
@@ -10,6 +10,9 @@ from timetabler.forms import LoginForm, AddSubjectForm, NameForm, TimeslotForm,
     EditStudentForm, AddTimetableForm, JustNameForm
 from timetabler.helpers import *
 from timetabler.models import *
+import timetabler.jobs
+from timetabler.serializers import *
+import timetabler.solver
 
 
 ### APP ROUTES
@@ -80,14 +83,20 @@ def logout():
 
 #UPLOAD ROUTES
 
+# Shown on the upload pages when upload() refuses a file because of its extension
+UPLOAD_MESSAGE = "Please upload a CSV or Excel (.xls or .xlsx) file"
+
+
 @app.route('/uploadstudentdata', methods=['GET', 'POST'])
 @admin_permission.require()
 def uploadstudentdata():
     if request.method == 'POST':
         try:
-            df = upload_and_return_df(request.files['file'])
-            populate_students(df)
-            return redirect("/students")
+            path = upload(request.files['file'])
+            if path is None:
+                return render_template('/uploadstudentdata.html', msg=UPLOAD_MESSAGE)
+            job = timetabler.jobs.submit_upload_job('students', path, username=current_user.username)
+            return render_template('/uploadstudentdata.html', uploadjob=job)
         except PermissionError as e:
             app.logger.error(e)
             return redirect('/uploadstudentdata')
@@ -103,6 +112,10 @@ def uploadstudentdata():
 
 
 def upload_and_return_df(file):
+    '''
+    Upload a file and read it whole. Uploads are imported with helpers.import_spreadsheet instead, which reads them
+    in chunks.
+    '''
     path_to_file = upload(file)
     if os.path.splitext(path_to_file)[1] == ".csv":
         return read_csv(path_to_file)
@@ -114,9 +127,11 @@ def upload_and_return_df(file):
 @admin_permission.require()
 def uploadtimetableclasslists():
     if request.method == 'POST':
-        df = upload_and_return_df(request.files['file'])
-        populate_timetabledata(df)
-        msg = "Completed Successfully"
+        path = upload(request.files['file'])
+        if path is None:
+            return render_template("uploadtimetabledata.html", msg=UPLOAD_MESSAGE)
+        job = timetabler.jobs.submit_upload_job('timetable', path, username=current_user.username)
+        return render_template("uploadtimetabledata.html", uploadjob=job)
     return render_template("uploadtimetabledata.html")
 
 
@@ -151,6 +166,12 @@ def updateadminsettings():
     return redirect('/admin')
 
 
+@app.route('/adminsettingscacheajax')
+@admin_permission.require()
+def admin_settings_cache_ajax():
+    return json.dumps(timetabler.models.admin_settings_stats)
+
+
 @app.route('/updatetimetable', methods=['POST'])
 @admin_permission.require()
 def updatetimetable():
@@ -166,24 +187,26 @@ def uploadtutordata():
     if request.method == 'GET':
         return render_template('uploadtutordata.html')
     elif request.method == 'POST':
-        df = upload_and_return_df(request.files['file'])
-        populate_tutors(df)
-        # os.remove(filename2)
-        msg = "Completed successfully"
-        return render_template('uploadtutordata.html', msg=msg)
+        path = upload(request.files['file'])
+        if path is None:
+            return render_template('uploadtutordata.html', msg=UPLOAD_MESSAGE)
+        job = timetabler.jobs.submit_upload_job('tutors', path, username=current_user.username)
+        return render_template('uploadtutordata.html', uploadjob=job)
 
 @app.route('/uploadtutoravailabilities', methods=['POST'])
 @admin_permission.require()
 def upload_tutor_availabilities():
-    df = upload_and_return_df(request.files['file'])
-    populate_availabilities(df)
-    msg2 = "Completed Successfully"
-    return render_template("uploadtutordata.html",msg2=msg2)
+    path = upload(request.files['file'])
+    if path is None:
+        return render_template("uploadtutordata.html", msg2=UPLOAD_MESSAGE)
+    job = timetabler.jobs.submit_upload_job('availabilities', path, username=current_user.username)
+    return render_template("uploadtutordata.html", uploadjob2=job)
 
 @app.route('/runtimetabler')
 @admin_permission.require()
 def run_timetabler():
-    return render_template("runtimetabler.html", tutors=Tutor.get_all(), timeslots=Timeslot.get_all())
+    return render_template("runtimetabler.html", tutors=Tutor.get_all(), timeslots=Timeslot.get_all(),
+                           solver_options=timetabler.solver.get_solver_options(), solvers=get_available_solvers())
 
 
 @app.route('/addsubjecttotutor?tutorid=<tutorid>', methods=['GET', 'POST'])
@@ -640,8 +663,51 @@ def view_user(username):
 @app.route('/runtimetableprogram', methods=['GET', 'POST'])
 @admin_permission.require()
 def run_timetable_program():
-    preparetimetable()
-    return "Done"
+    solver_options = {'solver': request.form.get('solver') or None,
+                      'time_limit': formnumber(request.form.get('time_limit'), float),
+                      'gap': formnumber(request.form.get('gap'), float),
+                      'threads': formnumber(request.form.get('threads'), int),
+                      'warm_start': checkboxvalue(request.form.get('warm_start')) == 1}
+    job = preparetimetable(username=current_user.username, solver_options=solver_options)
+    return json.dumps(job.as_dict())
+
+
+@app.route('/repairtimetableprogram', methods=['POST'])
+@admin_permission.require()
+def repair_timetable_program():
+    solver_options = {'solver': request.form.get('solver') or None,
+                      'time_limit': formnumber(request.form.get('time_limit'), float),
+                      'gap': formnumber(request.form.get('gap'), float),
+                      'threads': formnumber(request.form.get('threads'), int)}
+    job = repairtimetable(username=current_user.username, solver_options=solver_options)
+    return json.dumps(job.as_dict())
+
+
+@app.route('/timetablejobajax')
+@admin_permission.require()
+def timetable_job_ajax():
+    job = timetabler.jobs.refresh_job_progress(timetabler.jobs.get_latest_job())
+    if job is None:
+        return json.dumps({})
+    return json.dumps(job.as_dict())
+
+
+@app.route('/uploadjobajax')
+@admin_permission.require()
+def upload_job_ajax():
+    job = timetabler.jobs.get_upload_job(int(request.args['jobid']))
+    if job is None:
+        return json.dumps({})
+    return json.dumps(job)
+
+
+@app.route('/canceltimetablejobajax', methods=['POST'])
+@admin_permission.require()
+def cancel_timetable_job_ajax():
+    job = timetabler.jobs.cancel_job(int(request.form['jobid']))
+    if job is None:
+        return json.dumps({})
+    return json.dumps(job.as_dict())
 
 
 # APP ERROR HANDLERS
@@ -661,165 +727,64 @@ def internal_server_error(error):
 @app.route('/viewtimeslotsajax')
 @admin_permission.require()
 def viewtimeslots_ajax():
-    data = Timeslot.get_all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-        row['timetabledclasses'] = []
-        row['tutor'] = []
-        row['availabiletutors'] = []
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = TimeslotSerializer.query().filter(Timeslot.year == get_current_year(),
+                                              Timeslot.studyperiod == get_current_studyperiod())
+    return datatables_response(TimeslotSerializer.dump(query))
 
 
 @app.route('/viewtimetableajax')
 @login_required
 def viewtimetable_ajax():
-    data = TimetabledClass.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod()).options(
-        joinedload('tutor'), joinedload('room')).all()
-    data2 = []
-
-    for row3 in data:
-        data2.append(row3.__dict__)
-    for i in range(len(data2)):
-        data2[i]['timeslot'] = Timeslot.query.get(data2[i]['time'])
-        data2[i]['tutor'] = Tutor.query.filter_by(id=data2[i]['tutorid']).first()
-        data2[i]['subject'] = Subject.query.filter_by(id=data2[i]['subjectid']).first()
-    for i in range(len(data2)):
-        data2[i]['tutor'] = data2[i]['tutor'].__dict__
-        data2[i]['tutor']['_sa_instance_state'] = ""
-        data2[i]['subject'] = data2[i]['subject'].__dict__
-        data2[i]['subject']['_sa_instance_state'] = ""
-        data2[i]['subject']['students'] = []
-        data2[i]['subject']['tutor'] = ""
-        data2[i]['students'] = []
-        data2[i]['_sa_instance_state'] = ""
-        data2[i]['timeslot'] = data2[i]['timeslot'].__dict__
-        data2[i]['timeslot']['_sa_instance_state'] = ""
-        data2[i]['timeslot']['availabiletutors'] = []
-        data2[i]['timeslot']['timetabledclasses'] = []
-        data2[i]['timetabledclasses'] = []
-        if data2[i]['room'] is not None:
-            data2[i]['room'] = data2[i]['room'].__dict__
-            data2[i]['room']['_sa_instance_state'] = ""
-        else:
-            data2[i]['room'] = {}
-            data2[i]['room']['name'] = ""
-    data = json.dumps(data2)
-
-    return '{ "data" : ' + data + '}'
+    query = TimetabledClassSerializer.query().filter(
+        TimetabledClass.year == get_current_year(), TimetabledClass.studyperiod == get_current_studyperiod())
+    return TimetabledClassSerializer.response(query, request.args)
 
 
 @app.route('/viewtutorsajax')
 @admin_permission.require()
 def viewtutors_ajax():
-    data = Tutor.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod()).options(
-        joinedload('subjects'), joinedload('availabletimes')).all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        data3 = []
-        data4 = []
-        row['_sa_instance_state'] = ""
-        for sub in row['subjects']:
-            q = sub.__dict__
-            q['_sa_instance_state'] = ""
-            data3.append(q)
-        for time in row['availabletimes']:
-            q = time.__dict__
-            q['_sa_instance_state'] = ""
-            data4.append(q)
-        row['subjects'] = data3
-        row['availabletimes'] = data4
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = TutorSerializer.query().filter(Tutor.year == get_current_year(),
+                                           Tutor.studyperiod == get_current_studyperiod())
+    return datatables_response(TutorSerializer.dump(query))
 
 
 @app.route('/viewroomsajax')
 @admin_permission.require()
 def viewrooms_ajax():
-    data = Room.query.all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    return datatables_response(RoomSerializer.dump())
 
 
 @app.route('/viewuniversitiesajax')
 @admin_permission.require()
 def viewuniversities_ajax():
-    data = University.query.all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    return datatables_response(UniversitySerializer.dump())
 
 
 @app.route('/viewcollegesajax')
 @admin_permission.require()
 def viewcolleges_ajax():
-    data = College.query.all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    return datatables_response(CollegeSerializer.dump())
 
 @app.route('/viewusersajax')
 @admin_permission.require()
 def viewusers_ajax():
-    data = User.query.options(joinedload('tutor')).all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-        if row['tutor'] is not None:
-            row['tutor'] = row['tutor'].__dict__
-            row['tutor']['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    return datatables_response(UserSerializer.dump())
 
 
 @app.route('/viewstudentsajax')
 @admin_permission.require()
 def viewstudents_ajax():
-    data = Student.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod())
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = StudentSerializer.query().filter(Student.year == get_current_year(),
+                                             Student.studyperiod == get_current_studyperiod())
+    return StudentSerializer.response(query, request.args)
 
 
 @app.route('/viewcurrentmappedsubjectsajax')
 @admin_permission.require()
 def viewcurrentmappedsubjects_ajax():
-    data = Subject.query.filter(Subject.year == get_current_year(), Subject.studyperiod == get_current_studyperiod(),
-                                Subject.tutor != None).options(joinedload('students')).all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-        row['students'] = len(row['students'])
-        row['tutor'] = row['tutor'].__dict__
-        row['tutor']['_sa_instance_state'] = ""
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = MappedSubjectSerializer.query().filter(Subject.year == get_current_year(),
+                                                   Subject.studyperiod == get_current_studyperiod(), Tutor.id != None)
+    return datatables_response(MappedSubjectSerializer.dump(query))
 
 
 @app.route('/updatepreferredtimeslot', methods=['POST'])
@@ -843,21 +808,10 @@ def update_room_projector2():
 @app.route('/vieweligiblesubjectsajax')
 @admin_permission.require()
 def vieweligiblesubjects_ajax():
-    data = Subject.query.options(joinedload('students')).filter(Subject.year == get_current_year(),
-                                                                Subject.studyperiod == get_current_studyperiod(),
-                                                                Subject.tutor == None).all()
-    data2 = []
-    for subject in data:
-        if len(subject.students) >= 3:
-            data2.append(subject)
-    data3 = []
-    for row in data2:
-        data3.append(row.__dict__)
-    for row in data3:
-        row['_sa_instance_state'] = ""
-        row['students'] = len(row['students'])
-    data = json.dumps(data3)
-    return '{ "data" : ' + data + '}'
+    query = SubjectSerializer.query().filter(Subject.year == get_current_year(),
+                                             Subject.studyperiod == get_current_studyperiod(),
+                                             ~Subject.tutor.has(), enrolments.c.students >= 3)
+    return datatables_response(SubjectSerializer.dump(query))
 
 
 
@@ -880,45 +834,12 @@ def num_eligible_subjects_mapped():
 @app.route('/viewclashesajax')
 @admin_permission.require()
 def viewclashreportajax():
-    timeslots = Timeslot.get_all()
-    clashes = {}
-    for timeslot in timeslots:
-        clashestimeslot = {}
-        students = []
-        clashstudents = []
-        for timeclass in timeslot.timetabledclasses:
-            for student in timeclass.students:
-                if student not in students:
-                    clashestimeslot[student.id] = {}
-                    clashestimeslot[student.id]['student'] = student
-                    clashestimeslot[student.id]['timeslot'] = timeslot
-                    clashestimeslot[student.id]['subjects'] = []
-                    students.append(student)
-                clashestimeslot[student.id]['subjects'].append(timeclass.subject.subname)
-                if len(clashestimeslot[student.id]['subjects']) >= 2:
-                    clashstudents.append(student.id)
-        clashes[timeslot.id] = {key: clashestimeslot[key] for key in clashstudents}
-        clashes[timeslot.id]['time'] = timeslot.day + " " + timeslot.time
-
-    data2 = []
-    for row in clashes.keys():
-        if clashes[row] != {}:
-            for key in clashes[row].keys():
-                if isinstance(clashes[row][key], dict):
-                    data2.append(clashes[row][key])
-
-    for row in data2:
-        # row['_sa_instance_state'] = ""
-
-        row['timeslot'] = row['timeslot'].__dict__
-        row['timeslot']['_sa_instance_state'] = ""
-        row['student'] = row['student'].__dict__
-        row['student']['_sa_instance_state'] = ""
-        row['timeslot']['availabiletutors'] = []
-        row['timeslot']['timetabledclasses'] = []
-
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    report = get_clash_report()
+    datatables = get_datatables_request(request.args)
+    if datatables is None:
+        return datatables_response(report)
+    return datatables_response(**page_rows(report, datatables, ['student.studentcode', 'student.name', 'timeslot.id',
+                                                                'timeslot.day', 'timeslot.time']))
 
 
 @app.route('/updatesubjectrepeats', methods=['POST'])
@@ -970,34 +891,21 @@ def update_room_projector():
 @app.route('/viewsubjectsajax')
 @login_required
 def viewsubjects_ajax():
-    data = Subject.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod()).options(
-        joinedload('students')).all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-        row['students'] = len(row['students'])
-        row['tutor'] = []
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = SubjectSerializer.query().filter(Subject.year == get_current_year(),
+                                             Subject.studyperiod == get_current_studyperiod())
+    return SubjectSerializer.response(query, request.args)
 
 
 @app.route('/viewmysubjectsajax')
 @login_required
 def viewmysubjects_ajax():
-    data = Subject.query.filter_by(year=get_current_year(), studyperiod=get_current_studyperiod(),
-                                   tutor=current_user.tutor).options(
-        joinedload('students')).all()
-    data2 = []
-    for row in data:
-        data2.append(row.__dict__)
-    for row in data2:
-        row['_sa_instance_state'] = ""
-        row['students'] = len(row['students'])
-        row['tutor'] = []
-    data = json.dumps(data2)
-    return '{ "data" : ' + data + '}'
+    query = SubjectSerializer.query().filter(Subject.year == get_current_year(),
+                                             Subject.studyperiod == get_current_studyperiod())
+    if current_user.tutor is None:
+        query = query.filter(~Subject.tutor.has())
+    else:
+        query = query.filter(Subject.tutor.has(Tutor.id == current_user.tutor.id))
+    return datatables_response(SubjectSerializer.dump(query))
 
 
 @app.route('/useradminajax', methods=['POST'])